@@ -9,8 +9,42 @@ import aiohttp
 import json
 import io
 import traceback
+import tempfile
+
+import redis.asyncio as redis
 
 from translations import TEXTS
+from i18n import Translator, LanguageCache, DEFAULT_LANG
+from user_cache import UserCache, TieredUserCache
+from stats import StatsEngine
+from transcode import TranscodePool, probe_video
+from http_client import HttpClient
+from fal_poller import FalPoller
+from fal_webhook import FalWebhookRegistry, start_webhook_server
+from input_assets import InputAssets, create_storage
+from job_queue import RedisJobQueue, QUEUES, queue_for_mode
+from queue_eta import QueueEta, ThroughputMeter
+from scheduler import (
+    PriorityJobQueue,
+    WaitStats,
+    PRIORITIES,
+    PRIORITY_PREMIUM,
+    PRIORITY_PAID,
+    PRIORITY_FREE
+)
+from rate_limit import TokenBucketLimiter
+from progress_renderer import ProgressRenderer
+from result_cache import ResultCache, message_file
+from music_cache import MusicCache, normalize_key as normalize_music_key
+from prompt_index import PromptIndex
+from prompt_sanitizer import PromptSanitizer
+from prompt_rules import PROMPT_RULES, MODE_RULES
+from user_queries import UserQueries
+from media_relay import (
+    MediaRelay,
+    URL_PHOTO_LIMIT,
+    UPLOAD_PHOTO_LIMIT
+)
 
 from telegram.ext import PreCheckoutQueryHandler
 
@@ -19,38 +53,146 @@ from yookassa import Configuration, Payment
 Configuration.account_id = os.getenv("YOOKASSA_SHOP_ID")
 Configuration.secret_key = os.getenv("YOOKASSA_SECRET_KEY")
 
+# ================= TRANSLATIONS =================
+# TEXTS компилируется один раз при импорте, язык пользователя берётся
+# из LANG_CACHE — в штатном режиме перевод не ходит в БД.
+TRANSLATOR = Translator(TEXTS)
+LANG_CACHE = LanguageCache()
+
+
+async def get_user_language(user_id):
+    lang = LANG_CACHE.get(user_id)
+
+    if lang is not None:
+        return lang
+
+    lang = DEFAULT_LANG
+
+    try:
+        async with db_pool.acquire() as conn:
+            lang = await USER_QUERIES.fetchval(conn, "user_language", user_id) or DEFAULT_LANG
+    except Exception:
+        # Пользователь еще не создан / БД недоступна — не кэшируем,
+        # чтобы не залипнуть на дефолтном языке.
+        return DEFAULT_LANG
+
+    LANG_CACHE.set(user_id, lang)
+    return lang
+
+
 async def t(user_id, key, **kwargs):
     """
     Возвращает перевод по языку пользователя.
     Безопасно работает даже если пользователь еще не создан в БД.
     """
-    lang = "ru"
+    lang = await get_user_language(user_id)
+    return TRANSLATOR.get(lang, key, **kwargs)
 
-    try:
-        user = await get_user(user_id)
-        if user:
-            lang = user.get("language", "ru") or "ru"
-    except Exception:
-        lang = "ru"
 
-    item = TEXTS.get(key)
+async def t_many(user_id, keys, **kwargs):
+    """
+    Переводит список ключей за один поиск языка
+    (шаги прогресса, клавиатуры и т.п.).
+    """
+    lang = await get_user_language(user_id)
+    return TRANSLATOR.many(lang, keys, **kwargs)
+
+
+import uuid
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# ================= YOOKASSA POOL =================
+# Payment.create — синхронный HTTP через requests, поэтому вызываем его
+# в отдельном ограниченном пуле потоков, а не в event loop.
+# Повторные нажатия "Купить" в течение PAYMENT_REUSE_WINDOW получают ту же ссылку:
+# одинаковые запросы (user, тип, цена) склеиваются и в полёте, и после —
+# но только пока платеж еще pending (статус проверяется перед выдачей),
+# оплаченную / отмененную ссылку повторно не отдаем.
+PAYMENT_WORKERS = int(os.getenv("PAYMENT_WORKERS", "8"))
+PAYMENT_REUSE_WINDOW = int(os.getenv("PAYMENT_REUSE_WINDOW", "300"))
+
+payment_executor = ThreadPoolExecutor(
+    max_workers=PAYMENT_WORKERS,
+    thread_name_prefix="yookassa"
+)
+pending_payments = {}   # key -> asyncio.Future (создание в процессе)
+recent_payments = {}    # key -> (confirmation_url, payment_id, expires_at)
 
-    if isinstance(item, dict):
-        text = item.get(lang) or item.get("ru") or key
-    else:
-        text = key
+
+async def create_payment(user_id: int, payment_type="premium", price=499):
+
+    price = float(price)
+    key = (user_id, payment_type, f"{price:.2f}")
+
+    in_flight = pending_payments.get(key)
+    if in_flight:
+        return await asyncio.shield(in_flight)
+
+    # future — до первого await: второе нажатие, пока проверяем статус
+    # старой ссылки или создаем новую, ждет этот же результат
+    future = asyncio.get_running_loop().create_future()
+    pending_payments[key] = future
 
     try:
-        return text.format(**kwargs)
-    except Exception:
-        return text
+        url = await _reuse_or_create_payment(key, user_id, payment_type, price)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # помечаем исключение как полученное: если ждущих нет, asyncio не ругается
+        future.exception()
+        raise
+    else:
+        future.set_result(url)
+        return url
+    finally:
+        pending_payments.pop(key, None)
 
 
-import uuid
+async def _reuse_or_create_payment(key, user_id, payment_type, price):
+    now = time.time()
 
-async def create_payment(user_id: int, payment_type="premium", price=499):
+    cached = recent_payments.get(key)
+    if cached and cached[2] > now:
+        if await _payment_pending(cached[1]):
+            return cached[0]
+
+        recent_payments.pop(key, None)
+
+    # чистим протухшие ссылки, чтобы словарь не рос
+    for k, (_, _, expires_at) in list(recent_payments.items()):
+        if expires_at <= now:
+            recent_payments.pop(k, None)
+
+    payment_id, url = await _create_payment_remote(user_id, payment_type, price)
+    recent_payments[key] = (url, payment_id, time.time() + PAYMENT_REUSE_WINDOW)
+
+    return url
+
+
+def forget_payments(user_id):
+    """После успешной оплаты старые ссылки пользователя больше не выдаем."""
+    for key in [k for k in recent_payments if k[0] == user_id]:
+        recent_payments.pop(key, None)
+
+
+async def _payment_pending(payment_id):
+    try:
+        payment = await asyncio.get_running_loop().run_in_executor(
+            payment_executor,
+            functools.partial(Payment.find_one, payment_id)
+        )
+    except Exception as e:
+        # статус неизвестен — безопаснее выдать новую ссылку
+        logging.warning(f"⚠️ PAYMENT STATUS ERROR {payment_id}: {e}")
+        return False
 
-    price = float(price)  
+    return payment.status == "pending"
+
+
+async def _create_payment_remote(user_id, payment_type, price):
 
     description_map = {
         "premium": "Премиум на месяц",
@@ -60,7 +202,7 @@ async def create_payment(user_id: int, payment_type="premium", price=499):
 
     description = description_map.get(payment_type, "Покупка")
 
-    payment = Payment.create({
+    params = {
         "amount": {
             "value": f"{price:.2f}",
             "currency": "RUB"
@@ -93,20 +235,34 @@ async def create_payment(user_id: int, payment_type="premium", price=499):
                 }
             ]
         }
-    })
+    }
+
+    payment = await asyncio.get_running_loop().run_in_executor(
+        payment_executor,
+        functools.partial(Payment.create, params, str(uuid.uuid4()))
+    )
 
-    return payment.confirmation.confirmation_url
+    return payment.id, payment.confirmation.confirmation_url
 
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 db_pool = None
+# Подготовленные запросы к users с нужными колонками (user_queries.py).
+USER_QUERIES = UserQueries()
+
+# Redis общий для bot.py и worker.py (кэш пользователей, инвалидации).
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = None
 
 from telegram import (
     Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
-    BotCommand
+    BotCommand,
+    Chat,
+    Message
 )
+from datetime import datetime, timezone
 
 from telegram.ext import (
     ApplicationBuilder,
@@ -117,7 +273,8 @@ from telegram.ext import (
     filters,
 )
 
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI
 
 logging.basicConfig(level=logging.INFO)
 
@@ -128,6 +285,8 @@ from telegram.ext import ContextTypes
 TG_TOKEN = os.getenv("TG_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 FAL_KEY = os.getenv("FAL_KEY")
+# Базовый адрес FAL queue API (для локального стенда можно переопределить)
+FAL_QUEUE_URL = os.getenv("FAL_QUEUE_URL", "https://queue.fal.run").rstrip("/")
 # Google AI Studio / Gemini API key for Lyria 3 Clip Preview
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
 ADMIN_IDS = [5523265642,7924313002] 
@@ -135,7 +294,29 @@ ADMIN_IDS = [5523265642,7924313002]
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY не установлен")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# ================= OPENAI (ASYNC) =================
+# Один AsyncOpenAI на процесс: общий пул соединений (keep-alive),
+# запрос к ChatGPT больше не блокирует event loop.
+CHAT_MODEL = "gpt-4o-mini"
+CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY", "20"))
+CHAT_TIMEOUT = int(os.getenv("CHAT_TIMEOUT", "120"))
+# Telegram не любит частые правки одного сообщения — не чаще раза в ~1.2 с.
+CHAT_EDIT_INTERVAL = float(os.getenv("CHAT_EDIT_INTERVAL", "1.2"))
+TELEGRAM_TEXT_LIMIT = 4096
+
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    timeout=CHAT_TIMEOUT,
+    max_retries=2,
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=CHAT_CONCURRENCY,
+            max_keepalive_connections=CHAT_CONCURRENCY
+        ),
+        timeout=CHAT_TIMEOUT
+    )
+)
+chat_semaphore = asyncio.Semaphore(CHAT_CONCURRENCY)
 
 FREE_CHAT_LIMIT = 8
 FREE_LIMIT = 2
@@ -170,10 +351,43 @@ SIZE_CONFIG = {
     "phone": "1024x1536"
 }
 
-generation_cache = {}
-CACHE_TIME = 3600
-USER_CACHE = {}
+# Готовые результаты (фото / видео) как file_id Telegram: ключ учитывает
+# референсы, L1 LRU + TTL, L2 Redis (result_cache.py).
+RESULT_CACHE = ResultCache(
+    ttl=int(os.getenv("RESULT_CACHE_TTL", "3600")),
+    maxsize=int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "10000"))
+)
+RESULT_CACHE_MODES = ("image", "video", "cartoon")
+# Почти одинаковые промпты (регистр, пунктуация, эмодзи): SimHash-индекс
+# поверх clean_prompt -> ключ RESULT_CACHE (prompt_index.py).
+# SIMILAR_PROMPT_DISTANCE — порог в битах из 64 (0 = только канонически равные).
+PROMPT_INDEX = PromptIndex(
+    max_distance=int(os.getenv("SIMILAR_PROMPT_DISTANCE", "3")),
+    ttl=int(os.getenv("RESULT_CACHE_TTL", "3600")),
+    maxsize=int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "10000"))
+)
+# SIMILAR_RESULT_OFFER=0 — не предлагать похожий результат (только статистика)
+SIMILAR_RESULT_OFFER = os.getenv("SIMILAR_RESULT_OFFER", "1") != "0"
 USER_CACHE_TTL = 60  # секунд
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "50000"))
+USER_CACHE_MAX_BYTES = int(os.getenv("USER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# L1 в процессе + общий Redis L2 (подключается в post_init, если задан REDIS_URL).
+USER_CACHE = TieredUserCache(
+    UserCache(
+        maxsize=USER_CACHE_MAX_ENTRIES,
+        max_bytes=USER_CACHE_MAX_BYTES,
+        ttl=USER_CACHE_TTL
+    ),
+    redis_ttl=USER_CACHE_TTL
+)
+
+
+def _drop_cached_language(user_id, scope):
+    if scope == "language":
+        LANG_CACHE.pop(user_id)
+
+
+USER_CACHE.on_invalidate(_drop_cached_language)
 no_mode_cooldown = {}
 NO_MODE_COOLDOWN_TIME = 10
 
@@ -235,94 +449,32 @@ async def generation_cleanup_worker():
             logging.error(f"❌ CLEANER ERROR: {e}")
             await asyncio.sleep(5)
 
-# ================= CACHE CLEANER =================
-MAX_CACHE_SIZE = 500
-
-async def user_cache_cleaner():
-    while True:
-        await asyncio.sleep(120)
-
-        now = time.time()
-        to_delete = []
-
-        for k, v in USER_CACHE.items():
-            if now - v["time"] > USER_CACHE_TTL:
-                to_delete.append(k)
-
-        for k in to_delete:
-            USER_CACHE.pop(k, None)
-
-async def cache_cleaner():
-
-    while True:
-
-        await asyncio.sleep(600)
-
-        now = time.time()
-        remove_keys = []
-
-        # Удаляем устаревшие элементы
-        for k, v in generation_cache.items():
-            if now - v["time"] > CACHE_TIME:
-                remove_keys.append(k)
-
-        for k in remove_keys:
-            del generation_cache[k]
-
-        # ===== Ограничение максимального размера кэша =====
-        while len(generation_cache) > MAX_CACHE_SIZE:
-            # удаляем самый старый элемент
-            generation_cache.pop(next(iter(generation_cache)))
-
-        gc.collect()
-
 # ================= DB LOCK =================
 
 db_lock = asyncio.Lock()
 
-RATE_LIMIT_SECONDS = 1.5
-user_last_message = {}
-
 GENERATION_LIMIT = 3
 generation_semaphore = asyncio.Semaphore(GENERATION_LIMIT)
 
+# ================= RATE LIMITS =================
+# Token bucket (rate_limit.py): O(1) на сообщение, неактивные ключи
+# удаляются сами; с Redis (RATE_LIMIT_BACKEND=redis) лимит общий для всех
+# процессов бота.
+RATE_LIMIT_SECONDS = 1.5
 
-def check_rate_limit(user_id):
-
-    now = time.time()
-    last = user_last_message.get(user_id, 0)
-
-    if now - last < RATE_LIMIT_SECONDS:
-        return False
-
-    user_last_message[user_id] = now
-    return True
-
-def check_global_spam(user_id):
-
-    now = time.time()
-
-    # ===== ЕСЛИ ЗАБЛОКАН =====
-    blocked_until = user_blocked_until.get(user_id, 0)
-    if now < blocked_until:
-        return False
-
-    # ===== ЛОГ СООБЩЕНИЙ =====
-    log = user_message_log.get(user_id, [])
+SPAM_WINDOW = 10        # секунд
+SPAM_LIMIT = 6         # сообщений за окно
+SPAM_BLOCK_TIME = 30   # бан (сек)
 
-    # очищаем старые
-    log = [t for t in log if now - t < SPAM_WINDOW]
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "redis" if REDIS_URL else "memory")
 
-    log.append(now)
-    user_message_log[user_id] = log
+# не чаще одного запроса на генерацию в RATE_LIMIT_SECONDS
+MESSAGE_LIMITER = TokenBucketLimiter("message", 1, RATE_LIMIT_SECONDS)
 
-    # ===== ЕСЛИ СПАМ =====
-    if len(log) > SPAM_LIMIT:
-        user_blocked_until[user_id] = now + SPAM_BLOCK_TIME
-        user_message_log[user_id] = []
-        return False
+# глобальный антиспам: больше SPAM_LIMIT сообщений за SPAM_WINDOW -> бан
+SPAM_LIMITER = TokenBucketLimiter("spam", SPAM_LIMIT, SPAM_WINDOW, block=SPAM_BLOCK_TIME)
 
-    return True
+RATE_LIMITERS = (MESSAGE_LIMITER, SPAM_LIMITER)
 
 
 # ================= DATABASE =================
@@ -335,7 +487,8 @@ async def init_db():
         DATABASE_URL,
         min_size=5,
         max_size=20,
-        command_timeout=60
+        command_timeout=60,
+        init=USER_QUERIES.prepare
     )
 
     async with db_pool.acquire() as conn:
@@ -434,62 +587,67 @@ async def init_db():
         CREATE INDEX IF NOT EXISTS idx_users_ref_by ON users(ref_by)
         """)
 
-        await conn.execute("""
-        CREATE TABLE IF NOT EXISTS music_cache (
-            prompt TEXT PRIMARY KEY,
-            audio_url TEXT,
-            created_at BIGINT
-        )
-        """)
+    # music_cache (+ новые колонки file_id / size / mime / LRU)
+    await MUSIC_CACHE.start(db_pool)
 
-async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+# ================= STATS =================
+STATS = StatsEngine(
+    flush_interval=int(os.getenv("STATS_FLUSH_INTERVAL", "30")),
+    rollup_interval=int(os.getenv("STATS_ROLLUP_INTERVAL", "300"))
+)
 
-    if user_id not in ADMIN_IDS:
-        await update.message.reply_text(await t(user_id, "no_access"))
-        return
+async def init_stats():
+    await STATS.start(db_pool)
 
-    now = int(time.time())
-    day_ago = now - 86400
 
-    async with db_pool.acquire() as conn:
+async def init_redis(client=None):
+    """
+    Подключает общий Redis и L2 кэш пользователей.
+    worker.py передает свой клиент, bot.py создает его по REDIS_URL.
+    """
+    global redis_client
+
+    if client is None:
+        if not REDIS_URL:
+            logging.info("ℹ️ REDIS_URL не задан — кэш пользователей только в памяти")
+            return
 
-        total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
+        client = redis.from_url(REDIS_URL, decode_responses=True)
 
-        new_users_24h = await conn.fetchval("""
-            SELECT COUNT(*) FROM users WHERE created_at > $1
-        """, day_ago)
+    redis_client = client
+    await USER_CACHE.start(redis_client)
+    RESULT_CACHE.start(redis_client)
+    PROMPT_INDEX.start(redis_client)
 
-        active_24h = await conn.fetchval("""
-            SELECT COUNT(*) FROM users WHERE last_active > $1
-        """, day_ago)
+    logging.info("✅ Redis кэш пользователей подключен")
 
-        total_images = await conn.fetchval("SELECT SUM(image_count) FROM users")
-        total_videos = await conn.fetchval("SELECT SUM(video_count) FROM users")
-        total_music = await conn.fetchval("SELECT SUM(music_count) FROM users")
+    if RATE_LIMIT_BACKEND == "redis":
+        for limiter in RATE_LIMITERS:
+            limiter.use_redis(redis_client)
 
-        paid_video = await conn.fetchval("SELECT SUM(paid_video) FROM users")
-        paid_music = await conn.fetchval("SELECT SUM(paid_music) FROM users")
+        logging.info("✅ Rate limit в Redis")
 
-        # ✅ НОВОЕ: premium пользователи
-        premium_users = await conn.fetchval("""
-            SELECT COUNT(*) FROM users WHERE premium = 1
-        """)
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
 
-        # ✅ НОВОЕ: все генерации за всё время
-        total_generations_all = await conn.fetchval("""
-            SELECT 
-                COALESCE(SUM(image_count),0) +
-                COALESCE(SUM(video_count),0) +
-                COALESCE(SUM(music_count),0)
-            FROM users
-        """)
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text(await t(user_id, "no_access"))
+        return
 
-    total_images = total_images or 0
-    total_videos = total_videos or 0
-    total_music = total_music or 0
+    # 🔥 ВСЁ ИЗ ПАМЯТИ: счётчики STATS + срез, который обновляется фоном
+    snap = STATS.snapshot
 
-    total_generations = total_images + total_videos + total_music
+    total_images = STATS.total("images")
+    total_videos = STATS.total("videos")
+    total_music = STATS.total("music")
+    total_generations_all = total_images + total_videos + total_music
+
+    images_24h = STATS.last_24h("images")
+    videos_24h = STATS.last_24h("videos")
+    music_24h = STATS.last_24h("music")
+    total_generations_24h = images_24h + videos_24h + music_24h
+
+    snapshot_age = int(time.time()) - STATS.snapshot_at if STATS.snapshot_at else 0
 
     # 🔥 ОНЛАЙН ИЗ ПАМЯТИ
     online = sum(
@@ -497,86 +655,208 @@ async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if time.time() - t < ONLINE_TTL
     )
 
+    cache_stats = USER_CACHE.stats()
+    spam_stats = SPAM_LIMITER.stats()
+    message_stats = MESSAGE_LIMITER.stats()
+    progress_stats = PROGRESS.stats()
+    result_stats = RESULT_CACHE.stats()
+    music_stats = MUSIC_CACHE.stats()
+    similar_stats = PROMPT_INDEX.stats()
+    sanitizer_stats = PROMPT_SANITIZER.stats()
+    query_stats = USER_QUERIES.stats()
+
+    throughput = QUEUE_ETA.stats()
+    queue_lines = {
+        name: f"{queue_depth(name)} (~{QUEUE_ETA.eta_minutes(name, queue_depth(name) + 1)} мин, "
+              f"{throughput[name]['rate_per_min']}/мин)"
+        for name in QUEUES
+    }
+
+    wait = queue_wait_stats().summary()
+    wait_lines = " | ".join(
+        f"{name}: {wait[name]['p95']:.0f}s ({wait[name]['count']})"
+        if wait[name]["p95"] is not None else f"{name}: —"
+        for name in PRIORITIES
+    )
+
     text = f"""
 📊 <b>СТАТИСТИКА БОТА</b>
 
-👤 Всего пользователей: {total_users}
-🆕 Новые за 24ч: {new_users_24h}
-🔥 Активные за 24ч: {active_24h}
+👤 Всего пользователей: {snap.get("total_users", 0)}
+🆕 Новые за 24ч: {snap.get("new_24h", 0)}
+🔥 Активные за 24ч: {snap.get("active_24h", 0)}
 👀 Онлайн сейчас: {online}
 
-🎨 Генерации:
-🖼 Фото: {total_images}
-🎬 Видео: {total_videos}
-🎵 Музыка: {total_music}
-📦 Всего: {total_generations}
+🎨 Генерации за 24ч:
+🖼 Фото: {images_24h}
+🎬 Видео: {videos_24h}
+🎵 Музыка: {music_24h}
+📦 Всего: {total_generations_24h}
 
 💳 Куплено:
-🎬 Видео: {paid_video or 0}
-🎵 Музыка: {paid_music or 0}
-💰 Premium: {premium_users}
+🎬 Видео: {snap.get("paid_video", 0)}
+🎵 Музыка: {snap.get("paid_music", 0)}
+💰 Premium: {snap.get("premium_users", 0)}
 
 📦 Всего генераций за всё время: {total_generations_all}
+🖼 {total_images} | 🎬 {total_videos} | 🎵 {total_music}
 
 ⚙️ Очередь:
-🖼 Image: {generation_queue_image.qsize()}
-🎬 Video: {generation_queue_video.qsize()}
-🎵 Music: {generation_queue_music.qsize()}
+🖼 Image: {queue_lines["image"]}
+🎬 Video: {queue_lines["video"]}
+🎵 Music: {queue_lines["music"]}
+
+⏱ Ожидание в очереди (p95):
+{wait_lines}
+
+🧠 Кэш пользователей:
+Записей: {cache_stats["size"]} ({cache_stats["bytes"] // 1024} KB)
+Hit rate: {cache_stats["hit_rate"]:.0%} | Вытеснено: {cache_stats["evictions"]}
+
+♻️ Кэш результатов (file_id):
+Записей: {result_stats["size"]} | Hit rate: {result_stats["hit_rate"]:.0%} ({result_stats["hits"]})
+
+✨ Похожие промпты:
+Уже были (можно не генерировать): {similar_stats["avoidable"]:.0%} ({similar_stats["exact"] + similar_stats["similar"]}/{similar_stats["lookups"]})
+Почти такие же: {similar_stats["similar"]} | Предложено: {similar_stats["offered"]} | Выдано сразу: {similar_stats["accepted"]} | Устарело: {similar_stats["stale"]}
+
+🧽 Очистка промптов:
+Memo hit rate: {sanitizer_stats["hit_rate"]:.0%} | Замен: {sanitizer_stats["replaced"]}
+
+🗄 Запросы users (prepared):
+Вызовов: {query_stats["calls"]} | PREPARE: {query_stats["prepares"]} | Соединений: {query_stats["connections"]}
+
+🎵 Кэш музыки:
+Hit rate: {music_stats["hit_rate"]:.0%} ({music_stats["hits"]}/{music_stats["lookups"]})
+Предложено: {music_stats["offered"]} | Выдано сразу: {music_stats["served"]} | Вытеснено: {music_stats["evicted"]}
+
+🚦 Лимиты сообщений:
+Антиспам: отклонено {spam_stats["throttled"]}, банов {spam_stats["blocked"]}
+Частота генераций: отклонено {message_stats["throttled"]}
+
+⏳ Статусы генераций:
+Правок: {progress_stats["edits"]} | Схлопнуто: {progress_stats["coalesced"]} | 429: {progress_stats["flood_waits"]}
+
+🕒 Срез пользователей обновлен {snapshot_age} с назад
 """
 
     await update.message.reply_text(text, parse_mode="HTML")
 
 # ================= MUSIC CACHE FUNCTIONS =================
+# Готовые треки Lyria по нормализованному промпту (music_cache.py).
+MUSIC_CACHE = MusicCache(
+    ttl=int(os.getenv("MUSIC_CACHE_TTL", str(7 * 24 * 60 * 60))),
+    max_rows=int(os.getenv("MUSIC_CACHE_MAX_ROWS", "5000"))
+)
+# MUSIC_CACHE_OFFER=0 — не предлагать готовый трек (только наполнять кэш)
+MUSIC_CACHE_OFFER = os.getenv("MUSIC_CACHE_OFFER", "1") != "0"
 
-async def get_cached_music(prompt):
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT audio_url FROM music_cache WHERE prompt=$1",
-            prompt
-        )
 
-        if row:
-            return row["audio_url"]
+def music_cache_key(prompt):
+    # тот же путь, что проходит промпт до Lyria: generation_prompt (очистка в
+    # режиме music) -> _prepare_lyria3_clip_prompt (она чистит тоже в music)
+    return normalize_music_key(_prepare_lyria3_clip_prompt(prompt or ""))
 
-        return None
 
+def music_pay_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("💳 Buy track (69₽)", callback_data="buy_music")],
+        [InlineKeyboardButton("🍩 Premium", callback_data="buy_spb")]
+    ])
 
-async def save_music_cache(prompt, audio_url):
+
+async def charge_music(user_id, premium):
+    """
+    Списание после выдачи трека — сгенерированного или из кэша.
+    False — купленных треков уже нет (параллельная выдача успела раньше).
+    """
     async with db_pool.acquire() as conn:
+        charged = True
+
+        if not premium:
+            # условное списание: двойное нажатие не уводит баланс в минус
+            charged = await conn.fetchval(
+                """
+                UPDATE users
+                SET paid_music = paid_music - 1
+                WHERE user_id=$1 AND paid_music > 0
+                RETURNING paid_music
+                """,
+                user_id
+            ) is not None
+
+        # Дополнительно считаем генерации музыки для /stats.
         await conn.execute(
-            """
-            INSERT INTO music_cache (prompt, audio_url, created_at)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (prompt) DO UPDATE
-            SET audio_url = EXCLUDED.audio_url,
-                created_at = EXCLUDED.created_at
-            """,
-            prompt, audio_url, int(time.time())
+            "UPDATE users SET music_count = music_count + 1 WHERE user_id=$1",
+            user_id
         )
 
+    await USER_CACHE.invalidate(user_id)
+    STATS.incr("music")
+
+    if not charged:
+        logging.warning(f"⚠️ MUSIC CHARGE SKIPPED user={user_id}: paid_music = 0")
+
+    return charged
+
+
+async def send_cached_music(query, context, user_id):
+    """Кнопка "получить сразу": трек из music_cache по file_id."""
+    prompt = context.user_data.get("last_prompt")
+    key = music_cache_key(prompt) if prompt else None
+
+    if user_id in active_generations:
+        await query.message.reply_text(await already_in_queue_text(user_id))
+        return
+
+    # на время выдачи — как генерация: второе нажатие не выдаст трек еще раз
+    lock_user_generation(user_id)
+
+    try:
+        # обращение уже посчитано, когда трек предлагали
+        cached = await MUSIC_CACHE.get(key, count=False) if key else None
+
+        if not cached:
+            await query.message.reply_text(await t(user_id, "music_cache_expired"))
+            return
+
+        user = await get_user(user_id)
+        premium = is_premium(user)
+
+        if not premium and (user.get("paid_music") or 0) <= 0:
+            await query.message.reply_text(
+                await t(user_id, "music_need_pay"),
+                reply_markup=music_pay_keyboard()
+            )
+            return
+
+        if not await send_cached_result(cached, context.bot, query.message.chat_id):
+            await MUSIC_CACHE.invalidate(key)
+            await query.message.reply_text(await t(user_id, "music_cache_expired"))
+            return
+
+        await MUSIC_CACHE.touch(key)
+        await charge_music(user_id, premium)
+
+    finally:
+        unlock_user_generation(user_id)
+
 
 # ================= USER FUNCTIONS =================
 
 async def get_user(user_id):
 
-    now = time.time()
-
-    cached = USER_CACHE.get(user_id)
+    cached = await USER_CACHE.get(user_id)
 
-    if cached and now - cached["time"] < USER_CACHE_TTL:
-        return cached["data"]
+    if cached is not None:
+        return cached
 
     async with db_pool.acquire() as conn:
-        user = await conn.fetchrow(
-            "SELECT * FROM users WHERE user_id=$1",
-            user_id
-        )
+        user = await USER_QUERIES.fetchrow(conn, "user_profile", user_id)
 
     if user:
-        USER_CACHE[user_id] = {
-            "data": user,
-            "time": now
-        }
+        await USER_CACHE.set(user_id, user)
+        LANG_CACHE.set(user_id, user["language"])
 
     return user
 
@@ -585,6 +865,10 @@ async def ensure_user(user_id: int, ref_by: int | None = None):
     """
     Создает пользователя при первом /start и возвращает актуальную запись.
     Это исправляет падение /start из-за db_user, который раньше не создавался.
+
+    Один подготовленный запрос (user_queries.ENSURE_USER): INSERT ... ON CONFLICT
+    DO UPDATE last_active ... RETURNING нужные колонки, начисление реферала —
+    в том же запросе через CTE (только для новой строки).
     """
     now = int(time.time())
 
@@ -592,83 +876,23 @@ async def ensure_user(user_id: int, ref_by: int | None = None):
         ref_by = None
 
     async with db_pool.acquire() as conn:
-        existing = await conn.fetchrow(
-            "SELECT * FROM users WHERE user_id=$1",
-            user_id
-        )
+        user = await USER_QUERIES.fetchrow(conn, "ensure_user", user_id, now, ref_by)
 
-        if existing:
-            await conn.execute(
-                "UPDATE users SET last_active=$1 WHERE user_id=$2",
-                now, user_id
-            )
-            USER_CACHE.pop(user_id, None)
-            return await conn.fetchrow(
-                "SELECT * FROM users WHERE user_id=$1",
-                user_id
-            )
+    if not user:
+        return None
 
-        await conn.execute(
-            """
-            INSERT INTO users (
-                user_id,
-                week_start,
-                image_count,
-                video_count,
-                music_count,
-                chat_count,
-                accepted_terms,
-                referrals,
-                bonus_images,
-                ref_by,
-                is_active,
-                premium,
-                premium_until,
-                paid_video,
-                paid_music,
-                premium_images,
-                premium_videos,
-                premium_music,
-                created_at,
-                last_active,
-                ref_rewarded,
-                language
-            )
-            VALUES (
-                $1, $2,
-                0, 0, 0, 0,
-                0, 0, 0,
-                $3,
-                1, 0, 0,
-                0, 0,
-                0, 0, 0,
-                $2, $2, 0,
-                'ru'
-            )
-            ON CONFLICT (user_id) DO NOTHING
-            """,
-            user_id,
-            now,
-            ref_by
-        )
+    if user["inserted"]:
+        STATS.incr("signups")
 
         if ref_by:
-            await conn.execute(
-                """
-                UPDATE users
-                SET referrals = referrals + 1
-                WHERE user_id=$1
-                  AND user_id <> $2
-                """,
-                ref_by,
-                user_id
-            )
+            await USER_CACHE.invalidate(ref_by)
 
-        USER_CACHE.pop(user_id, None)
-        return await conn.fetchrow(
-            "SELECT * FROM users WHERE user_id=$1",
-            user_id
-        )
+    await USER_CACHE.set(user_id, user)
+    LANG_CACHE.set(user_id, user["language"])
+    # last_active уже записан этим запросом.
+    LAST_ACTIVE_CACHE.set(user_id, True)
+
+    return user
 
 
 async def reset_week_if_needed(user):
@@ -686,7 +910,7 @@ async def reset_week_if_needed(user):
                 """,
                 now, user["user_id"]
             )
-            USER_CACHE.pop(user["user_id"], None)
+            await USER_CACHE.invalidate(user["user_id"])
 
 
 def is_premium(user):
@@ -718,7 +942,7 @@ async def reset_user_limits(user_id):
             int(time.time()),
             user_id
         )
-        USER_CACHE.pop(user_id, None)
+        await USER_CACHE.invalidate(user_id)
 
 async def is_user_subscribed(bot, user_id):
     try:
@@ -735,71 +959,37 @@ def get_subscribe_keyboard():
 
 # ================= ULTRA PROMPT ENGINE =================
 
-def clean_prompt(prompt: str, mode: str = "image"):
+# Правила замен — prompt_rules.py: картинкам / видео — все, музыке — только
+# SAFETY (стили и "экшн" Lyria не нужны).
+PROMPT_SANITIZER = PromptSanitizer(PROMPT_RULES, modes=MODE_RULES)
 
-    if not prompt:
-        return prompt
-
-    # ===== SAFE REPLACEMENTS (БЕЗ ЛОМАНИЯ СМЫСЛА) =====
-    replacements = {
-
-        # оружие → нейтрально
-        "стреляет": "испускает свет",
-        "стрельба": "энергетический эффект",
-        "оружие": "устройство",
-        "пистолет": "устройство",
-        "бластер": "фантастическое устройство",
-
-        "gun": "futuristic device",
-        "weapon": "tool",
-        "shoot": "emit light",
-        "shooting": "light effect",
-
-        # насилие → cinematic
-        "убивает": "побеждает",
-        "кровь": "красная энергия",
-
-        "kill": "defeat",
-        "killing": "defeating",
-        "blood": "red energy",
-        "murder": "dramatic action",
-
-        # бренды → стили
-        "simpsons": "yellow cartoon sitcom style",
-        "pixar": "3d animated cinematic style",
-        "disney": "fantasy animation style",
-        "rick and morty": "crazy sci-fi cartoon style",
-
-        # sora sensitive
-        "laser": "light beam",
-        "attack": "fast action movement",
-        "battle": "epic cinematic scene",
-        "fight": "dynamic action sequence",
-        "explosion": "bright cinematic flash",
-    }
 
-    cleaned = prompt
+def clean_prompt(prompt: str, mode: str = "image"):
+    # один проход скомпилированной регуляркой; повторный вызов бесплатный
+    # НЕ делаем lower() ❗ — регистр замен следует оригиналу
+    return PROMPT_SANITIZER(prompt, mode)
+
 
-    # НЕ делаем lower() ❗
-    for bad, good in replacements.items():
-        cleaned = cleaned.replace(bad, good)
-        cleaned = cleaned.replace(bad.capitalize(), good)
+def generation_prompt(prompt, mode, cartoon_style=None):
+    """Итоговый промпт задачи: стиль мультфильма + clean_prompt."""
+    if prompt and mode in ["cartoon", "video", "remix"] and cartoon_style:
+        prompt = f"{cartoon_style}, {prompt}"
 
-    # ===== MODE SWITCH (БЕЗ БУСТЕРОВ) =====
-    mode = (mode or "").lower()
+    if prompt:
+        prompt = clean_prompt(prompt, mode)
 
-    return cleaned
+    return prompt
 # ================= FAL MODELS CONFIG =================
 
 FAL_MODELS = {
 
     "banana1": {
-        "url": "https://queue.fal.run/fal-ai/nano-banana-pro",
+        "url": f"{FAL_QUEUE_URL}/fal-ai/nano-banana-pro",
         "edit": True
     },
 
     "banana2": {
-        "url": "https://queue.fal.run/fal-ai/nano-banana-2",
+        "url": f"{FAL_QUEUE_URL}/fal-ai/nano-banana-2",
         "edit": True
     }
 
@@ -829,24 +1019,138 @@ CARTOON_STYLES = {
 FAL_VIDEO_MODELS = {
 
     "text": {
-        "url": "https://queue.fal.run/fal-ai/sora-2/text-to-video"
+        "url": f"{FAL_QUEUE_URL}/fal-ai/sora-2/text-to-video"
     },
 
     "image": {
-        "url": "https://queue.fal.run/fal-ai/sora-2/image-to-video"
+        "url": f"{FAL_QUEUE_URL}/fal-ai/sora-2/image-to-video"
     }
 
 }
-# ================= DOWNLOAD FAL IMAGE =================
+# ================= HTTP =================
+# Общая aiohttp-сессия для FAL / Gemini / скачивания результатов
+# (создается в post_init, закрывается в post_shutdown).
+HTTP = HttpClient(
+    limit=int(os.getenv("HTTP_POOL_LIMIT", "200")),
+    limit_per_host=int(os.getenv("HTTP_POOL_PER_HOST", "50"))
+)
 
-async def download_fal_image(session, url):
+# Таймауты на отдельный запрос. Общее ожидание генерации ограничено
+# циклами опроса (max_wait) и таймаутами задач в handle_generation_job.
+FAL_REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=120, sock_connect=60, sock_read=120)
 
-    async with session.get(url) as resp:
+# Один адаптивный планировщик опроса статусов FAL на процесс (fal_poller.py).
+FAL_POLLER = FalPoller(
+    lambda: HTTP.session,
+    concurrency=int(os.getenv("FAL_POLL_CONCURRENCY", "32"))
+)
 
-        if resp.status != 200:
-            raise Exception(f"Failed to download image: {resp.status}")
+# ================= FAL WEBHOOKS =================
+# Опционально: если задан FAL_WEBHOOK_URL (публичный адрес этого процесса),
+# задачи отправляются с ?fal_webhook=..., FAL присылает результат сам,
+# а опрос статуса остается только страховкой с длинным интервалом.
+FAL_WEBHOOKS = FalWebhookRegistry(
+    public_url=os.getenv("FAL_WEBHOOK_URL"),
+    secret=os.getenv("FAL_WEBHOOK_SECRET", "")
+)
+FAL_WEBHOOK_HOST = os.getenv("FAL_WEBHOOK_HOST", "0.0.0.0")
+FAL_WEBHOOK_PORT = int(os.getenv("FAL_WEBHOOK_PORT", "8080"))
+
+fal_webhook_server = None
+
+
+async def init_fal_webhooks():
+    global fal_webhook_server
+
+    if not FAL_WEBHOOKS.public_url or fal_webhook_server:
+        return
+
+    try:
+        fal_webhook_server, _ = await start_webhook_server(
+            FAL_WEBHOOKS,
+            host=FAL_WEBHOOK_HOST,
+            port=FAL_WEBHOOK_PORT
+        )
+    except Exception as e:
+        logging.error(f"❌ FAL WEBHOOK SERVER ERROR (используем опрос): {e}")
+
+
+async def close_fal_webhooks():
+    if fal_webhook_server:
+        fal_webhook_server.should_exit = True
+
+
+async def wait_fal_completion(status_url, request_id, headers, max_wait, profile="image", label="",
+                              queue_position=None):
+    """
+    Ждёт завершения задачи FAL: вебхук (если включен) или опрос статуса.
+    Возвращает статус COMPLETED; при вебхуке в нём уже есть результат.
+    queue_position — из ответа на отправку задачи (первый опрос позже).
+    """
+    if not FAL_WEBHOOKS.enabled:
+        return await FAL_POLLER.wait(
+            status_url,
+            headers=headers,
+            max_wait=max_wait,
+            profile=profile,
+            label=label,
+            queue_position=queue_position
+        )
+
+    hook = FAL_WEBHOOKS.register(request_id)
+    poll = asyncio.ensure_future(FAL_POLLER.wait(
+        status_url,
+        headers=headers,
+        max_wait=max_wait,
+        profile="webhook",
+        label=label
+    ))
+
+    try:
+        done, _ = await asyncio.wait({hook, poll}, return_when=asyncio.FIRST_COMPLETED)
+        return (hook if hook in done else poll).result()
+
+    finally:
+        FAL_WEBHOOKS.discard(request_id)
+        poll.cancel()
 
-        return await resp.read()
+
+async def fal_fetch_result(session, result_url, headers, completion):
+    # Результат уже пришел вебхуком — лишний GET не нужен.
+    if completion.get("webhook_payload"):
+        return completion["webhook_payload"]
+
+    async with session.get(result_url, headers=headers, timeout=FAL_REQUEST_TIMEOUT) as r:
+        result_text = await r.text()
+
+        if r.status != 200:
+            raise Exception(f"Fal result failed: HTTP {r.status}: {result_text[:1000]}")
+
+        try:
+            return json.loads(result_text)
+        except Exception:
+            raise Exception(f"Fal result returned non-JSON: {result_text[:1000]}")
+
+# ================= MEDIA RELAY =================
+# Результаты FAL отдаются в Telegram ссылкой или потоком через временный
+# файл (media_relay.py) — без чтения видео целиком в память.
+MEDIA = MediaRelay(lambda: HTTP.session)
+
+# ================= INPUT ASSETS =================
+# Референсы загружаются в хранилище один раз (input_assets.py), в payload
+# уходит URL; повтор и smart_retry берут URL из кэша по хэшу содержимого.
+# INPUT_STORAGE: fal (по умолчанию) | local | inline (старые data URI).
+ASSETS = InputAssets(
+    create_storage(
+        os.getenv("INPUT_STORAGE", "fal"),
+        lambda: HTTP.session,
+        fal_key=FAL_KEY,
+        fal_storage_url=os.getenv("FAL_STORAGE_URL", "https://rest.alpha.fal.ai"),
+        local_dir=os.getenv("INPUT_STORAGE_DIR"),
+        local_url=os.getenv("INPUT_STORAGE_URL")
+    ),
+    ttl=int(os.getenv("INPUT_ASSET_TTL", str(6 * 60 * 60)))
+)
 # ================= UNIVERSAL FAL GENERATOR =================
 
 async def retry(func, *args, retries=3):
@@ -889,102 +1193,61 @@ async def fal_generate(model, prompt, images=None, max_wait=None):
         "Content-Type": "application/json"
     }
 
-    timeout = aiohttp.ClientTimeout(
-        total=max_wait + 90,
-        sock_connect=60,
-        sock_read=120
-    )
-
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        image_urls = []
+    session = HTTP.session
+    image_urls = await ASSETS.urls_for((images or [])[:MAX_INPUT_IMAGES])
 
-        for img in (images or [])[:MAX_INPUT_IMAGES]:
-            img_base64 = base64.b64encode(bytes(img)).decode("utf-8")
-            image_urls.append(f"data:image/jpeg;base64,{img_base64}")
+    payload = {
+        "prompt": prompt,
+        "num_images": 1,
+        "output_format": "png",
+        "safety_tolerance": 5
+    }
 
-        payload = {
-            "prompt": prompt,
-            "num_images": 1,
-            "output_format": "png",
-            "safety_tolerance": 5
-        }
+    if image_urls:
+        payload["image_urls"] = image_urls
 
-        if image_urls:
-            payload["image_urls"] = image_urls
+    async with session.post(
+        FAL_WEBHOOKS.submit_url(url),
+        json=payload,
+        headers=headers,
+        timeout=FAL_REQUEST_TIMEOUT
+    ) as resp:
+        create_text = await resp.text()
 
-        async with session.post(url, json=payload, headers=headers) as resp:
-            create_text = await resp.text()
+        if resp.status not in (200, 201, 202):
+            raise Exception(f"Fal create failed: HTTP {resp.status}: {create_text[:1000]}")
 
-            if resp.status not in (200, 201, 202):
-                raise Exception(f"Fal create failed: HTTP {resp.status}: {create_text[:1000]}")
-
-            try:
-                data = json.loads(create_text)
-            except Exception:
-                raise Exception(f"Fal create returned non-JSON: {create_text[:1000]}")
-
-        request_id = data.get("request_id")
-        status_url = data.get("status_url")
-        result_url = data.get("response_url")
-
-        if not request_id or not status_url or not result_url:
-            raise Exception(f"Fal bad create response: {data}")
-
-        start_time = time.time()
-        last_status_log = 0
-
-        while True:
-            elapsed = time.time() - start_time
-
-            if elapsed > max_wait:
-                raise Exception(f"Fal generation timeout after {int(elapsed)}s")
-
-            async with session.get(status_url, headers=headers) as s:
-                status_text = await s.text()
-
-                if s.status not in (200, 202):
-                    raise Exception(f"Fal status failed: HTTP {s.status}: {status_text[:1000]}")
-
-                try:
-                    status_data = json.loads(status_text)
-                except Exception:
-                    raise Exception(f"Fal status returned non-JSON: {status_text[:1000]}")
-
-            state = status_data.get("status")
-            queue_position = status_data.get("queue_position")
-
-            # Не спамим логами каждую секунду.
-            if time.time() - last_status_log > 15:
-                logging.info(
-                    f"🖼 FAL IMAGE STATUS user_wait={int(elapsed)}s "
-                    f"state={state} queue={queue_position} request_id={request_id}"
-                )
-                last_status_log = time.time()
-
-            if state == "COMPLETED":
-                async with session.get(result_url, headers=headers) as r:
-                    result_text = await r.text()
-
-                    if r.status != 200:
-                        raise Exception(f"Fal result failed: HTTP {r.status}: {result_text[:1000]}")
-
-                    try:
-                        result = json.loads(result_text)
-                    except Exception:
-                        raise Exception(f"Fal result returned non-JSON: {result_text[:1000]}")
-
-                result_images = result.get("images") or []
+        try:
+            data = json.loads(create_text)
+        except Exception:
+            raise Exception(f"Fal create returned non-JSON: {create_text[:1000]}")
+
+    request_id = data.get("request_id")
+    status_url = data.get("status_url")
+    result_url = data.get("response_url")
+
+    if not request_id or not status_url or not result_url:
+        raise Exception(f"Fal bad create response: {data}")
+
+    completion = await wait_fal_completion(
+        status_url,
+        request_id,
+        headers=headers,
+        max_wait=max_wait,
+        profile="image",
+        label=f"image request_id={request_id}",
+        queue_position=data.get("queue_position")
+    )
 
-                if not result_images or not result_images[0].get("url"):
-                    raise Exception(f"Fal bad image result: {result}")
+    result = await fal_fetch_result(session, result_url, headers, completion)
 
-                image_url = result_images[0]["url"]
-                return await download_fal_image(session, image_url)
+    result_images = result.get("images") or []
 
-            if state == "FAILED":
-                raise Exception(f"Fal generation failed: {status_data}")
+    if not result_images or not result_images[0].get("url"):
+        raise Exception(f"Fal bad image result: {result}")
 
-            await asyncio.sleep(2)
+    # URL результата: в Telegram отправляет MEDIA (ссылкой или потоком)
+    return result_images[0]["url"]
 
 import asyncio
 import aiohttp
@@ -1052,17 +1315,17 @@ async def lyria3_clip_generate(prompt, max_wait=600):
 
     logging.info(f"🎵 LYRIA3 CLIP START prompt={prompt[:300]}")
 
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(url, json=payload, headers=headers) as resp:
-            response_text = await resp.text()
+    session = HTTP.session
+    async with session.post(url, json=payload, headers=headers, timeout=timeout) as resp:
+        response_text = await resp.text()
 
-            if resp.status != 200:
-                raise Exception(f"lyria3 clip failed: HTTP {resp.status} {response_text[:2000]}")
+        if resp.status != 200:
+            raise Exception(f"lyria3 clip failed: HTTP {resp.status} {response_text[:2000]}")
 
-            try:
-                data = json.loads(response_text)
-            except Exception:
-                raise Exception(f"lyria3 clip returned non-JSON: {response_text[:2000]}")
+        try:
+            data = json.loads(response_text)
+        except Exception:
+            raise Exception(f"lyria3 clip returned non-JSON: {response_text[:2000]}")
 
     parts = (
         data.get("candidates", [{}])[0]
@@ -1126,179 +1389,438 @@ async def fal_video_generate(prompt, images=None):
         "Content-Type": "application/json"
     }
 
-    # 🔥 ДОБАВЛЕНО: Таймаут на видео
-    timeout = aiohttp.ClientTimeout(total=600)
+    session = HTTP.session
+
+    # стартовый кадр нужен только первый — остальные не загружаем
+    image_urls = await ASSETS.urls_for((images or [])[:1])
+
+    payload = {
+        "prompt": prompt,
+        "duration": 4,
+        "resolution": "720p"
+    }
+
+    logging.info(f"🎬 Video generation started for prompt: {prompt}")
 
-    async with aiohttp.ClientSession(timeout=timeout) as session:
+    # если есть картинка — используем как стартовый кадр
+    if images and image_urls:
+        payload["image_url"] = image_urls[0]
 
-        image_urls = []
+    async with session.post(
+        FAL_WEBHOOKS.submit_url(base_url),
+        json=payload,
+        headers=headers,
+        timeout=FAL_REQUEST_TIMEOUT
+    ) as resp:
 
-        if images:
+        data = await resp.json()
 
-            for img in images:
+        if "request_id" not in data:
+            raise Exception(f"Fal video error: {data}")
 
-                img_base64 = base64.b64encode(img).decode()
+        request_id = data["request_id"]
 
-                data_uri = f"data:image/jpeg;base64,{img_base64}"
+    status_url = f"{FAL_QUEUE_URL}/fal-ai/sora-2/requests/{request_id}/status"
+    result_url = f"{FAL_QUEUE_URL}/fal-ai/sora-2/requests/{request_id}"
 
-                image_urls.append(data_uri)
+    # sora-2 может генерировать долго
+    completion = await wait_fal_completion(
+        status_url,
+        request_id,
+        headers=headers,
+        max_wait=FAL_VIDEO_MAX_WAIT,
+        profile="video",
+        label=f"sora request_id={request_id}",
+        queue_position=data.get("queue_position")
+    )
 
-        payload = {
-            "prompt": prompt,
-            "duration": 4,
-            "resolution": "720p"
-        }
+    result = await fal_fetch_result(session, result_url, headers, completion)
+
+    video_url = None
+
+    if "video" in result:
+        video_url = result["video"]["url"]
+
+    elif "videos" in result:
+        video_url = result["videos"][0]["url"]
+
+    if not video_url:
+        raise Exception(f"Fal video bad response: {result}")
+
+    return video_url
+
+# ================= FAL VIDEO REMIX =================
+async def fal_video_remix(video_bytes, prompt, images=None):
+
+    prompt = clean_prompt(prompt)
+
+    headers = {
+        "Authorization": f"Key {FAL_KEY}"
+    }
 
-        logging.info(f"🎬 Video generation started for prompt: {prompt}")
+    session = HTTP.session
+
+    # 🔥 1. видео и референсы — один раз в хранилище, в payload только URL
+    video_url = await ASSETS.url_for(video_bytes, "video/mp4")
+    image_urls = await ASSETS.urls_for((images or [])[:4])
+
+    # 🔥 2. REMIX REQUEST
+    payload = {
+        "prompt": prompt,
+        "video_url": video_url,
+        "image_urls": image_urls
+    }
 
-        # если есть картинка — используем как стартовый кадр
-        if images and image_urls:
-            payload["image_url"] = image_urls[0]
+    async with session.post(
+        FAL_WEBHOOKS.submit_url(f"{FAL_QUEUE_URL}/fal-ai/kling-video/o1/standard/video-to-video/edit"),
+        json=payload,
+        headers={**headers, "Content-Type": "application/json"},
+        timeout=FAL_REQUEST_TIMEOUT
+    ) as resp:
 
-        async with session.post(base_url, json=payload, headers=headers) as resp:
+        text = await resp.text()
 
+        try:
             data = await resp.json()
+        except:
+            raise Exception(f"Kling response not JSON: {text}")
 
-            if "request_id" not in data:
-                raise Exception(f"Fal video error: {data}")
+        request_id = data.get("request_id")
 
-            request_id = data["request_id"]
+        if not request_id:
+            raise Exception(f"No request_id: {data}")
+
+    # 🔥 3. STATUS CHECK
+    status_url = f"{FAL_QUEUE_URL}/fal-ai/kling-video/requests/{request_id}/status"
+    result_url = f"{FAL_QUEUE_URL}/fal-ai/kling-video/requests/{request_id}"
+
+    completion = await wait_fal_completion(
+        status_url,
+        request_id,
+        headers=headers,
+        max_wait=FAL_VIDEO_MAX_WAIT,
+        profile="video",
+        label=f"kling request_id={request_id}",
+        queue_position=data.get("queue_position")
+    )
 
-        status_url = f"https://queue.fal.run/fal-ai/sora-2/requests/{request_id}/status"
-        result_url = f"https://queue.fal.run/fal-ai/sora-2/requests/{request_id}"
+    result = await fal_fetch_result(session, result_url, headers, completion)
 
-        # sora-2 может генерировать долго
-        for _ in range(300):
+    video_url = result.get("video", {}).get("url")
 
-            async with session.get(status_url, headers=headers) as s:
+    if not video_url:
+        raise Exception(f"Bad result: {result}")
 
-                status = await s.json()
+    return video_url
+# ================= PROGRESS RENDERER =================
+# Статусы задач и chat action правит один планировщик на процесс
+# (progress_renderer.py): общий бюджет запросов, не чаще раза в
+# PROGRESS_CHAT_INTERVAL в чат, промежуточные кадры схлопываются.
+PROGRESS = ProgressRenderer(
+    rate=float(os.getenv("PROGRESS_EDITS_PER_SEC", "10")),
+    chat_interval=float(os.getenv("PROGRESS_CHAT_INTERVAL", "3"))
+)
 
-                if status.get("status") == "COMPLETED":
 
-                    async with session.get(result_url, headers=headers) as r:
+# ================= QUEUES AND SEMAPHORES =================
+# Без Redis задачи идут в очереди процесса; порядок тот же, что в Redis:
+# premium > paid > free, справедливо между пользователями (scheduler.py).
+LOCAL_WAIT_STATS = WaitStats()
+generation_queue_image = PriorityJobQueue(maxsize=5000, wait_stats=LOCAL_WAIT_STATS)
+generation_queue_video = PriorityJobQueue(maxsize=2000, wait_stats=LOCAL_WAIT_STATS)
+generation_queue_music = PriorityJobQueue(maxsize=2000, wait_stats=LOCAL_WAIT_STATS)
+user_locks = {}
 
-                        result = await r.json()
+LOCAL_QUEUES = {
+    "image": generation_queue_image,
+    "video": generation_queue_video,
+    "music": generation_queue_music,
+}
+LOCAL_THROUGHPUT = ThroughputMeter()
 
-                        video_url = None
+# С Redis — общие потоки задач (job_queue.py): их разбирают и воркеры
+# бота, и отдельные процессы worker.py на других машинах.
+# JOB_QUEUE=memory оставляет старый режим даже при заданном REDIS_URL.
+JOB_QUEUE_MODE = os.getenv("JOB_QUEUE", "redis" if REDIS_URL else "memory")
+JOB_VISIBILITY_TIMEOUT = int(os.getenv("JOB_VISIBILITY_TIMEOUT", "300"))
+JOBS = None
+jobs_redis = None
 
-                        if "video" in result:
-                            video_url = result["video"]["url"]
+# Задачи, поставленные этим процессом: job_id -> живые update/context/status.
+# Если задачу берет воркер бота — работаем с ними (user_data сохраняется);
+# если другой процесс — он восстанавливает их по id (restore_job).
+LOCAL_JOBS = {}
 
-                        elif "videos" in result:
-                            video_url = result["videos"][0]["url"]
+# Ключи user_data, которые нужны обработчику задачи в другом процессе.
+JOB_USER_DATA_KEYS = ("cartoon_style", "sub_checked", "mode", "size", "model")
 
-                        if not video_url:
-                            raise Exception(f"Fal video bad response: {result}")
 
-                        async with session.get(video_url) as v:
-                            return await v.read()
+async def init_job_queue(listen_done=False):
+    """Подключает Redis-очередь задач (если JOB_QUEUE=redis и есть REDIS_URL)."""
+    global JOBS, jobs_redis
 
-                if status.get("status") == "FAILED":
-                    raise Exception("Sora video generation failed")
+    if JOBS:
+        return JOBS
 
-            await asyncio.sleep(2)
+    if JOB_QUEUE_MODE != "redis" or not REDIS_URL:
+        return None
 
-        raise Exception("Sora video timeout")
+    # отдельный клиент без decode_responses: в очереди лежат байты файлов
+    jobs_redis = redis.from_url(REDIS_URL)
 
-# ================= FAL VIDEO REMIX =================
-async def fal_video_remix(video_bytes, prompt, images=None):
+    JOBS = RedisJobQueue(
+        jobs_redis,
+        visibility_timeout=JOB_VISIBILITY_TIMEOUT,
+        blob_ttl=QUEUE_JOB_TTL + VIDEO_JOB_TIMEOUT
+    )
+    JOBS.on_done(_on_job_done)
 
-    import base64
+    await JOBS.start(listen_done=listen_done)
 
-    prompt = clean_prompt(prompt)
+    return JOBS
 
-    headers = {
-        "Authorization": f"Key {FAL_KEY}"
+
+async def close_job_queue():
+    if JOBS:
+        await JOBS.stop()
+
+    if jobs_redis:
+        await jobs_redis.close()
+
+
+def _on_job_done(job_id, user_id):
+    # Задачу этого процесса выполнил другой воркер — снимаем блокировку здесь.
+    if LOCAL_JOBS.pop(job_id, None) and user_id:
+        unlock_user_generation(user_id)
+
+
+def queue_depth(name):
+    if JOBS:
+        return JOBS.depth.get(name, 0)
+
+    return LOCAL_QUEUES[name].qsize()
+
+
+async def queue_position(name, job_id):
+    """Реальное место задачи в очереди (с учетом приоритетов) или None."""
+    if JOBS:
+        return await JOBS.position(job_id, name)
+
+    return LOCAL_QUEUES[name].rank(job_id)
+
+
+# ================= QUEUE ETA / ADMISSION =================
+# Позиция и ожидание считаются по своей очереди (queue_eta.py).
+# QUEUE_CONCURRENCY_* — сколько задач очереди выполняется одновременно во
+# всей системе (воркеры бота + worker.py): нужно для ETA, пока нет
+# наблюдаемой скорости. QUEUE_MAX_WAIT_* — с каким ожиданием (сек) еще
+# принимаем задачу; больше — "сервер перегружен".
+QUEUE_CONCURRENCY = {
+    "image": int(os.getenv("QUEUE_CONCURRENCY_IMAGE", "20")),
+    "video": int(os.getenv("QUEUE_CONCURRENCY_VIDEO", "6")),
+    "music": int(os.getenv("QUEUE_CONCURRENCY_MUSIC", "4")),
+}
+
+QUEUE_MAX_WAIT = {
+    "image": int(os.getenv("QUEUE_MAX_WAIT_IMAGE", "900")),
+    "video": int(os.getenv("QUEUE_MAX_WAIT_VIDEO", "3600")),
+    "music": int(os.getenv("QUEUE_MAX_WAIT_MUSIC", "1800")),
+}
+
+QUEUE_ETA = QueueEta(
+    queue_position,
+    lambda: JOBS.throughput if JOBS else LOCAL_THROUGHPUT,
+    QUEUE_CONCURRENCY
+)
+
+
+def queue_overloaded(mode):
+    """Новая задача режима mode ждала бы дольше QUEUE_MAX_WAIT своей очереди."""
+    name = queue_for_mode(mode)
+    return QUEUE_ETA.eta(name, queue_depth(name) + 1) > QUEUE_MAX_WAIT[name]
+
+
+def queue_estimate(mode):
+    """(позиция, минуты) для новой задачи — до фактической постановки."""
+    name = queue_for_mode(mode)
+    position = queue_depth(name) + 1
+    return position, QUEUE_ETA.eta_minutes(name, position)
+
+
+async def already_in_queue_text(user_id):
+    try:
+        queued = await QUEUE_ETA.lookup(user_id)
+    except Exception as e:
+        logging.warning(f"⚠️ QUEUE POSITION ERROR {user_id}: {e}")
+        queued = None
+
+    if not queued:
+        return await t(user_id, "already_in_queue")
+
+    name, position = queued
+    return await t(
+        user_id,
+        "already_in_queue_position",
+        position=position,
+        eta=QUEUE_ETA.eta_minutes(name, position)
+    )
+
+
+def serialize_job(job):
+    """Живые объекты Telegram -> id; остальное как есть (job_queue.JOB_FIELDS)."""
+    update = job.get("update")
+    context = job.get("context")
+    status = job.get("status")
+
+    msg = getattr(update, "message", None)
+    if not msg and getattr(update, "callback_query", None):
+        msg = update.callback_query.message
+
+    user_data = getattr(context, "user_data", None) or {}
+
+    return {
+        **{k: v for k, v in job.items() if k not in ("update", "context", "status")},
+        "chat_id": msg.chat_id if msg else None,
+        "message_id": msg.message_id if msg else None,
+        "status_message_id": status.message_id if status else None,
+        "user_data": {k: user_data.get(k) for k in JOB_USER_DATA_KEYS if k in user_data},
     }
 
-    timeout = aiohttp.ClientTimeout(total=600)
 
-    async with aiohttp.ClientSession(timeout=timeout) as session:
+class JobContext:
+    """Минимальная замена ContextTypes для задачи из другого процесса."""
 
-        # 🔥 1. FIX: NO UPLOAD API (убираем источник 502)
-        video_b64 = base64.b64encode(video_bytes).decode("utf-8")
-        video_url = f"data:video/mp4;base64,{video_b64}"
+    def __init__(self, bot, user_data):
+        self.bot = bot
+        self.user_data = user_data
 
-        # 🔥 2. REMIX REQUEST
-        payload = {
-            "prompt": prompt,
-            "video_url": video_url,
-            "image_urls": images[:4] if images else []
-        }
 
-        async with session.post(
-            "https://queue.fal.run/fal-ai/kling-video/o1/standard/video-to-video/edit",
-            json=payload,
-            headers={**headers, "Content-Type": "application/json"}
-        ) as resp:
+def _job_message(bot, chat_id, message_id):
+    message = Message(
+        message_id=message_id,
+        date=datetime.now(timezone.utc),
+        chat=Chat(id=chat_id, type=Chat.PRIVATE)
+    )
+    message.set_bot(bot)
+    return message
 
-            text = await resp.text()
 
-            try:
-                data = await resp.json()
-            except:
-                raise Exception(f"Kling response not JSON: {text}")
+def restore_job(job, bot):
+    """Задача из Redis -> формат handle_generation_job (update/context/status)."""
+    local = LOCAL_JOBS.pop(job.get("job_id"), None)
 
-            request_id = data.get("request_id")
+    if local:
+        update, context, status = local
+    else:
+        chat_id = job.get("chat_id")
+        message = _job_message(bot, chat_id, job.get("message_id"))
 
-            if not request_id:
-                raise Exception(f"No request_id: {data}")
+        update = Update(update_id=0, message=message)
+        context = JobContext(bot, dict(job.get("user_data") or {}))
 
-        # 🔥 3. STATUS CHECK
-        status_url = f"https://queue.fal.run/fal-ai/kling-video/requests/{request_id}/status"
-        result_url = f"https://queue.fal.run/fal-ai/kling-video/requests/{request_id}"
+        status = None
+        if job.get("status_message_id"):
+            status = _job_message(bot, chat_id, job["status_message_id"])
 
-        for _ in range(300):
+    return {**job, "update": update, "context": context, "status": status}
 
-            async with session.get(status_url, headers=headers) as s:
 
-                if s.status != 200:
-                    await asyncio.sleep(2)
-                    continue
+async def job_priority(user_id, mode):
+    """Класс задачи для планировщика: premium > paid (купленные) > free."""
+    user = await get_user(user_id)
 
-                status = await s.json()
-                state = status.get("status")
+    if not user:
+        return PRIORITY_FREE
 
-                if state == "COMPLETED":
+    if is_premium(user):
+        return PRIORITY_PREMIUM
 
-                    async with session.get(result_url, headers=headers) as r:
+    if mode in ("video", "cartoon", "remix") and (user.get("paid_video") or 0) > 0:
+        return PRIORITY_PAID
 
-                        result = await r.json()
+    if mode == "music" and (user.get("paid_music") or 0) > 0:
+        return PRIORITY_PAID
 
-                        video_url = result.get("video", {}).get("url")
+    return PRIORITY_FREE
 
-                        if not video_url:
-                            raise Exception(f"Bad result: {result}")
 
-                        async with session.get(video_url) as v:
-                            return await v.read()
+def queue_wait_stats():
+    return JOBS.wait_stats if JOBS else LOCAL_WAIT_STATS
 
-                if state == "FAILED":
-                    raise Exception(f"Kling failed: {status}")
 
-            await asyncio.sleep(2)
+async def enqueue_generation_job(job):
+    """
+    Единая точка постановки задачи генерации.
+    Возвращает реальную позицию задачи в ее очереди (с учетом приоритета).
+    """
+    name = queue_for_mode(job.get("mode"))
+
+    job_id = uuid.uuid4().hex
+
+    job = {
+        **job,
+        "job_id": job_id,
+        "priority": job.get("priority") or await job_priority(job["user_id"], job.get("mode")),
+    }
+
+    if not JOBS:
+        position = await LOCAL_QUEUES[name].put(job)
+        QUEUE_ETA.issue(job["user_id"], name, job_id)
+        return position
+
+    LOCAL_JOBS[job_id] = (job.get("update"), job.get("context"), job.get("status"))
 
-        raise Exception("Remix timeout")
-# ================= FAKE PHOTO UPLOAD ACTION =================
-async def fake_photo_upload(bot, chat_id):
     try:
-        while True:
-            await bot.send_chat_action(
-                chat_id=chat_id,
-                action="upload_photo"
-            )
-            await asyncio.sleep(4)
-    except asyncio.CancelledError:
+        position = await JOBS.put({**serialize_job(job), "job_id": job_id})
+    except Exception:
+        LOCAL_JOBS.pop(job_id, None)
+        raise
+
+    _prune_local_jobs()
+    QUEUE_ETA.issue(job["user_id"], name, job_id)
+
+    return position
+
+
+async def enqueue_failed(status, user_id, error):
+    """
+    Постановка не удалась (очередь процесса полна — asyncio.QueueFull, ошибка
+    Redis): снимаем блокировку и отвечаем в статусе, иначе пользователь
+    остается в active_generations без ответа.
+    """
+    logging.error(f"❌ QUEUE PUT ERROR user={user_id}: {error!r}")
+
+    unlock_user_generation(user_id)
+
+    key = "server_overloaded" if isinstance(error, asyncio.QueueFull) else "queue_error"
+
+    if status:
+        try:
+            await status.edit_text(await t(user_id, key))
+        except Exception:
+            pass
+
+
+async def show_queue_position(status, user_id, key, mode, estimate, position):
+    # Статус отправлен до постановки (его id едет в задаче) — уточняем место.
+    if not status or not position or position == estimate:
+        return
+
+    eta = QUEUE_ETA.eta_minutes(queue_for_mode(mode), position)
+
+    try:
+        await safe_edit(status, await t(user_id, key, position=position, eta=eta))
+    except Exception:
         pass
 
 
+def _prune_local_jobs():
+    # Ссылки на задачи, чье событие done потерялось, не держим вечно.
+    if len(LOCAL_JOBS) < 1000:
+        return
 
-# ================= QUEUES AND SEMAPHORES =================
-generation_queue_image = asyncio.Queue(maxsize=5000)
-generation_queue_video = asyncio.Queue(maxsize=2000)
-generation_queue_music = asyncio.Queue(maxsize=2000)
-user_locks = {}
+    for job_id in list(LOCAL_JOBS)[:len(LOCAL_JOBS) // 2]:
+        LOCAL_JOBS.pop(job_id, None)
 
 # ================= HANDLE IMAGE (REMIX) =================
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1328,14 +1850,122 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await t(user_id, "photo_added_reference")
     )
 
+# ================= TRANSCODE =================
+# ffmpeg идет через общий асинхронный пул (transcode.py): event loop
+# не блокируется, параллельно работает не больше TRANSCODE_WORKERS процессов.
+TRANSCODE_TIMEOUT = int(os.getenv("TRANSCODE_TIMEOUT", "300"))
+
+TRANSCODER = TranscodePool(
+    workers=int(os.getenv("TRANSCODE_WORKERS", "0")) or None,
+    queue_size=int(os.getenv("TRANSCODE_QUEUE_SIZE", "100")),
+    timeout=TRANSCODE_TIMEOUT
+)
+
+
+def _write_temp_file(data, suffix):
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        tmp.write(data)
+        return tmp.name
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# ================= REMIX VIDEO NORMALIZATION =================
+# Видео для Kling приводится к 720x720 h264/yuv420p ровно один раз — при загрузке.
+# Результат пробы хранится рядом с байтами (input_video_meta) и едет в задаче,
+# поэтому шаг генерации перекодирует только то, что еще не соответствует.
+REMIX_SIZE = 720
+
+REMIX_ENCODE_ARGS = [
+    "-vf", f"scale={REMIX_SIZE}:{REMIX_SIZE}:force_original_aspect_ratio=increase,crop={REMIX_SIZE}:{REMIX_SIZE}",
+    "-c:v", "libx264",
+    "-preset", "fast",
+    "-crf", "23",
+    "-pix_fmt", "yuv420p",
+    "-movflags", "+faststart",
+    "-c:a", "aac",
+    "-b:a", "128k",
+]
+
+# видео уже подходит: без перекодирования, только moov в начало файла
+REMIX_REMUX_ARGS = ["-c", "copy", "-movflags", "+faststart"]
+
+
+def remix_video_conforms(meta):
+    return bool(meta) and (
+        meta.get("width") == REMIX_SIZE
+        and meta.get("height") == REMIX_SIZE
+        and meta.get("codec") == "h264"
+        and meta.get("pix_fmt") == "yuv420p"
+    )
+
+
+async def normalize_remix_video(video_bytes, meta=None):
+    """
+    Возвращает (bytes, meta). Если видео уже 720x720 h264 — не перекодируем,
+    только дешевый remux (-c copy) ради +faststart; иначе один проход libx264
+    через TRANSCODER.
+    """
+    if remix_video_conforms(meta) and meta.get("normalized"):
+        return video_bytes, meta
+
+    input_path = await asyncio.to_thread(_write_temp_file, video_bytes, ".mp4")
+    output_path = input_path.replace(".mp4", "_720.mp4")
+
+    try:
+        if not remix_video_conforms(meta):
+            try:
+                meta = await probe_video(input_path)
+            except Exception as e:
+                logging.warning(f"⚠️ FFPROBE ERROR: {e}")
+                meta = None
+
+        if remix_video_conforms(meta):
+            logging.info("⚡ SKIP RESIZE (already 720x720 h264), remux +faststart")
+
+            try:
+                await TRANSCODER.run(
+                    ["ffmpeg", "-y", "-i", input_path, *REMIX_REMUX_ARGS, output_path]
+                )
+                video_bytes = await asyncio.to_thread(_read_file, output_path)
+            except Exception as e:
+                # moov в конце файла — не повод терять видео
+                logging.warning(f"⚠️ REMUX ERROR: {e}")
+
+            return video_bytes, {**meta, "normalized": True}
+
+        await TRANSCODER.run(
+            ["ffmpeg", "-y", "-i", input_path, *REMIX_ENCODE_ARGS, output_path]
+        )
+
+        normalized = await asyncio.to_thread(_read_file, output_path)
+
+        return normalized, {
+            "width": REMIX_SIZE,
+            "height": REMIX_SIZE,
+            "codec": "h264",
+            "pix_fmt": "yuv420p",
+            "normalized": True,
+        }
+
+    finally:
+        await asyncio.to_thread(_remove_files, input_path, output_path)
+
+
 # ================= HANDLE VIDEO =================
 async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
-    import logging
-    import tempfile
-    import subprocess
-    import os
-
     # 🔥 FIX: защита от каналов и системных апдейтов
     user = update.effective_user
     message = update.message
@@ -1347,7 +1977,7 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ONLINE_USERS[user_id] = time.time()
 
     logging.info(f"🎬 HANDLE VIDEO START user={user_id}")
-    if not check_global_spam(user_id):
+    if not await SPAM_LIMITER.allow(user_id):
         logging.warning(f"🚫 SPAM BLOCK user={user_id}")
         return
 
@@ -1411,55 +2041,24 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         logging.info(f"✅ VIDEO DOWNLOADED user={user_id} size={len(video_bytes)}")
 
-        # ================= АВТО РЕСАЙЗ ДО 720x720 =================
+        # ================= НОРМАЛИЗАЦИЯ ДО 720x720 (ОДИН РАЗ) =================
         try:
+            logging.info(f"🔄 NORMALIZE START user={user_id}")
 
-            # 🔥 если уже 720x720 — не трогаем
-            if original_w == 720 and original_h == 720:
-                logging.info(f"⚡ SKIP RESIZE (already 720x720) user={user_id}")
-                processed_bytes = video_bytes
+            processed_bytes, video_meta = await normalize_remix_video(video_bytes)
 
-            else:
-                logging.info(f"🔄 RESIZE START user={user_id}")
-
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as input_tmp:
-                    input_tmp.write(video_bytes)
-                    input_path = input_tmp.name
-
-                output_path = input_path.replace(".mp4", "_720.mp4")
-
-                command = [
-                    "ffmpeg",
-                    "-i", input_path,
-                    "-vf",
-                    "scale=720:720:force_original_aspect_ratio=increase,crop=720:720",
-                    "-c:v", "libx264",
-                    "-preset", "fast",
-                    "-crf", "23",
-                    "-c:a", "aac",
-                    "-b:a", "128k",
-                    "-y",
-                    output_path
-                ]
-
-                subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-                with open(output_path, "rb") as f:
-                    processed_bytes = f.read()
-
-                os.remove(input_path)
-                os.remove(output_path)
-
-                logging.info(f"✅ RESIZED TO 720x720 user={user_id}")
+            logging.info(f"✅ NORMALIZED user={user_id} meta={video_meta}")
 
         except Exception as e:
-            logging.error(f"❌ RESIZE ERROR user={user_id}: {e}")
+            stderr = getattr(e, "stderr", "")
+            logging.error(f"❌ RESIZE ERROR user={user_id}: {e} {stderr[-500:]}")
             await update.message.reply_text(await t(user_id, "video_processing_error"))
             return
 
         # ================= СОХРАНЯЕМ =================
         context.user_data["input_video"] = processed_bytes
         context.user_data["input_video_bytes"] = processed_bytes
+        context.user_data["input_video_meta"] = video_meta
         context.user_data["input_video_ready"] = True
 
         context.user_data["input_video_url"] = None
@@ -1511,7 +2110,7 @@ async def consume_video(conn, user_id, premium, free_limit):
             WHERE user_id=$1 AND video_count < $2
             RETURNING video_count
         """, user_id, PREMIUM_VIDEO_LIMIT)
-        USER_CACHE.pop(user_id, None)
+        await USER_CACHE.invalidate(user_id)
 
         return bool(result)
 
@@ -1522,7 +2121,7 @@ async def consume_video(conn, user_id, premium, free_limit):
         WHERE user_id=$1 AND paid_video > 0
         RETURNING paid_video
     """, user_id)
-    USER_CACHE.pop(user_id, None)
+    await USER_CACHE.invalidate(user_id)
 
     if result:
         return True
@@ -1534,10 +2133,64 @@ async def consume_video(conn, user_id, premium, free_limit):
         WHERE user_id=$1 AND video_count < $2
         RETURNING video_count
     """, user_id, free_limit)
-    USER_CACHE.pop(user_id, None)
+    await USER_CACHE.invalidate(user_id)
 
     return bool(result)
 
+async def charge_image(user_id):
+    """Списание картинки после выдачи — сгенерированной или из кэша."""
+    async with db_pool.acquire() as conn:
+        await conn.execute(
+            """
+            UPDATE users
+            SET image_count = image_count + 1
+            WHERE user_id=$1
+            """,
+            user_id
+        )
+
+    await USER_CACHE.invalidate(user_id)
+    STATS.incr("images")
+
+
+async def charge_video(user_id):
+    """Списание видео после выдачи — сгенерированного или из кэша."""
+    async with db_pool.acquire() as conn:
+
+        user = await USER_QUERIES.fetchrow(conn, "user_video_balance", user_id)
+
+        paid_video = user.get("paid_video") or 0
+
+        if paid_video > 0:
+            await conn.execute(
+                """
+                UPDATE users
+                SET paid_video = paid_video - 1
+                WHERE user_id=$1
+                """,
+                user_id
+            )
+        else:
+            await conn.execute(
+                """
+                UPDATE users
+                SET video_count = video_count + 1
+                WHERE user_id=$1
+                """,
+                user_id
+            )
+
+    await USER_CACHE.invalidate(user_id)
+    STATS.incr("videos")
+
+
+async def charge_cached_result(user_id, mode):
+    """Готовый результат из RESULT_CACHE (тот же или похожий запрос)."""
+    if mode == "image":
+        await charge_image(user_id)
+    else:
+        await charge_video(user_id)
+
 async def safe_edit(message, text, **kwargs):
     try:
         if getattr(message, "text", None) == text:
@@ -1551,13 +2204,6 @@ async def safe_edit(message, text, **kwargs):
 
 # ================== UNIVERSAL HANDLER (FIXED FINAL) ==================
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-# ===== GLOBAL ANTISPAM =====
-user_message_log = {}
-user_blocked_until = {}
-
-SPAM_WINDOW = 10        # секунд
-SPAM_LIMIT = 6         # сообщений за окно
-SPAM_BLOCK_TIME = 30   # бан (сек)
 ADMIN_REPLY_STATE = {}
 SUPPORT_REPLY_MAP = {}
 ONLINE_USERS = {}
@@ -1577,6 +2223,8 @@ IMAGE_JOB_TIMEOUT = int(os.getenv("IMAGE_JOB_TIMEOUT", "1200")) # полный 
 VIDEO_JOB_TIMEOUT = int(os.getenv("VIDEO_JOB_TIMEOUT", "1800"))
 MUSIC_JOB_TIMEOUT = int(os.getenv("MUSIC_JOB_TIMEOUT", "1200"))
 FAL_IMAGE_MAX_WAIT = int(os.getenv("FAL_IMAGE_MAX_WAIT", "900"))
+FAL_VIDEO_MAX_WAIT = int(os.getenv("FAL_VIDEO_MAX_WAIT", "600"))
+FAL_REMIX_MAX_WAIT = int(os.getenv("FAL_REMIX_MAX_WAIT", "1200"))
 
 # cancel_button оставлен как fallback для мест, где нет user_id.
 cancel_button = InlineKeyboardMarkup([
@@ -1627,6 +2275,8 @@ async def handle_generation_job(job):
         except asyncio.TimeoutError:
             logging.error(f"⏰ GENERATION TIMEOUT user={user_id} mode={mode} limit={job_timeout}s")
 
+            PROGRESS.finish(status)
+
             try:
                 if status:
                     await status.edit_text(await t(user_id, "generation_timeout"))
@@ -1653,6 +2303,7 @@ async def handle_generation_job(job):
                 if context and hasattr(context, "user_data"):
                     context.user_data.pop("input_video", None)
                     context.user_data.pop("input_video_bytes", None)
+                    context.user_data.pop("input_video_meta", None)
             except Exception as e:
                 logging.error(f"USER_DATA CLEAN ERROR: {e}")
 
@@ -1669,163 +2320,282 @@ async def handle_generation_job(job):
             logging.info(f"🧹 CLEANUP user {user_id}")
 # ================= ВНУТРЕННЯЯ ЛОГИКА =================
 
-async def _handle_generation_inner(job):
+async def result_keyboard(user_id):
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton(await t(user_id, "repeat"), callback_data="repeat"),
+            InlineKeyboardButton(await t(user_id, "start_over"), callback_data="restart")
+        ],
+        [
+            InlineKeyboardButton(await t(user_id, "finish"), callback_data="finish")
+        ]
+    ])
 
-    update = job["update"]
-    context = job["context"]
-    prompt = job.get("prompt")
-    size = job.get("size", "1024x1024")
-    model = job.get("model", "banana2")
-    images = job.get("images", [])
-    user_id = job["user_id"]
-    status = job.get("status")
-    mode = job.get("mode", "image")
 
-    msg = getattr(update, "message", None)
-    if not msg and getattr(update, "callback_query", None):
-        msg = update.callback_query.message
+async def send_cached_result(cached, bot, chat_id, reply_markup=None):
+    """Повторная отправка результата по file_id (без скачивания и загрузки)."""
+    kind = cached["kind"]
 
-    # ===== СЕМАФОРЫ =====
-    sem = semaphore_image
-    if mode in ["video", "cartoon", "remix"]:
-        sem = semaphore_video
-    elif mode == "music":
-        sem = semaphore_music
+    senders = {
+        "photo": bot.send_photo,
+        "video": bot.send_video,
+        "animation": bot.send_animation,
+        "audio": bot.send_audio,
+        "document": bot.send_document,
+    }
 
-    async with GLOBAL_RATE_LIMIT:
-        async with GLOBAL_SEMAPHORE:
-            async with sem:
-                try:
-                    # ===== 🔥 DB =====
-                    async with db_pool.acquire() as conn:
+    try:
+        await senders[kind](chat_id=chat_id, reply_markup=reply_markup, **{kind: cached["file_id"]})
+        return True
+
+    except Exception as e:
+        logging.warning(f"⚠️ CACHED RESULT SEND FAILED ({kind}): {e}")
+        return False
+
+
+async def find_similar_result(mode, prompt, model, size, images, cartoon_style=None):
+    """Ключ RESULT_CACHE похожего (не того же самого) запроса или None."""
+    prompt = generation_prompt(prompt, mode, cartoon_style)
+
+    scope = await RESULT_CACHE.scope(mode, model, size, images[:MAX_INPUT_IMAGES])
+
+    async def alive(result_key):
+        return await RESULT_CACHE.get(result_key, count=False) is not None
+
+    found = await PROMPT_INDEX.find(scope, prompt, alive=alive)
+
+    if not found:
+        return None
+
+    result_key = found[0]
+
+    # точно такой же запрос воркер и так отдаст из кэша сам
+    if result_key == await RESULT_CACHE.key(mode, prompt, model, size, scope=scope):
+        return None
+
+    return result_key
 
-                        user = await conn.fetchrow(
-                            "SELECT * FROM users WHERE user_id=$1",
-                            user_id
+
+async def send_similar_result(query, context, user_id):
+    """
+    Кнопка "получить сразу": похожий готовый результат по file_id.
+    Те же лимиты, подписка и списание, что у генерации (check_generation_limits,
+    charge_cached_result) — бесплатным обходом лимитов кнопка не становится.
+    """
+    offer = context.user_data.pop("similar_result", None) or {}
+    result_key = offer.get("key")
+    mode = offer.get("mode", "image")
+
+    if user_id in active_generations:
+        await query.message.reply_text(await already_in_queue_text(user_id))
+        return
+
+    lock_user_generation(user_id)
+
+    try:
+        cached = await RESULT_CACHE.get(result_key) if result_key else None
+
+        if cached:
+            async with db_pool.acquire() as conn:
+                user = await USER_QUERIES.fetchrow(conn, "user_limits", user_id)
+
+                if not user:
+                    return
+
+                await reset_week_if_needed(user)
+                user = await check_generation_limits(conn, user, mode, context, query.message)
+
+            if not user:
+                return
+
+            reply_markup = await result_keyboard(user_id) if mode == "image" else None
+
+            if await send_cached_result(cached, context.bot, query.message.chat_id, reply_markup):
+                PROMPT_INDEX.accepted += 1
+                await charge_cached_result(user_id, mode)
+                return
+
+            await RESULT_CACHE.invalidate(result_key)
+
+        await query.message.reply_text(await t(user_id, "similar_result_expired"))
+
+    finally:
+        unlock_user_generation(user_id)
+
+
+async def check_generation_limits(conn, user, mode, context, msg):
+    """
+    Лимиты, подписка и оплата перед выдачей результата (генерация или
+    готовый похожий результат). Актуальная запись users или None — отказ,
+    пользователю уже ответили.
+    """
+    user_id = user["user_id"]
+    premium = is_premium(user)
+
+    # ===== IMAGE =====
+    if mode == "image":
+
+        if not premium:
+            free_limit = 1
+
+            if user["image_count"] >= free_limit:
+
+                if not context.user_data.get("sub_checked"):
+
+                    subscribed = await is_user_subscribed(context.bot, user_id)
+
+                    if not subscribed:
+                        await msg.reply_text(
+                            await t(user_id, "free_image_limit_subscribe"),
+                            reply_markup=get_subscribe_keyboard()
                         )
+                        return None
 
-                        if not user:
-                            return
+                    context.user_data["sub_checked"] = True
 
-                        logging.info(f"USER DATA: {dict(user)}")
+                limit = FREE_LIMIT + user.get("bonus_images", 0)
+            else:
+                limit = free_limit
+        else:
+            limit = PREMIUM_IMAGE_LIMIT
 
-                        await reset_week_if_needed(user)
-                        premium = is_premium(user)
+        if user["image_count"] >= limit:
+            await msg.reply_text(
+                await t(user_id, "image_limit_exhausted"),
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🍩 Buy Premium", callback_data="buy_spb")]
+                ])
+            )
+            return None
 
-                        # ===== IMAGE =====
-                        if mode == "image":
+    # ================= VIDEO / CARTOON =================
+    elif mode in ["video", "cartoon", "remix"]:
 
-                            if not premium:
-                                free_limit = 1
+        if not premium:
+            subscribed = await is_user_subscribed(context.bot, user_id)
 
-                                if user["image_count"] >= free_limit:
+            # ===== ЖЁСТКАЯ БЛОКИРОВКА ДО ПРОВЕРКИ =====
+            if not context.user_data.get("sub_checked"):
 
-                                    if not context.user_data.get("sub_checked"):
+                context.user_data["pending_video"] = True
 
-                                        subscribed = await is_user_subscribed(context.bot, user_id)
+                await msg.reply_text(
+                    await t(user_id, "video_sub_required"),
+                    reply_markup=get_subscribe_keyboard()
+                )
+                return None
 
-                                        if not subscribed:
-                                            await msg.reply_text(
-                                                await t(user_id, "free_image_limit_subscribe"),
-                                                reply_markup=get_subscribe_keyboard()
-                                            )
-                                            return
+        logging.info(f"🎬 START VIDEO FLOW user={user_id}")
 
-                                        context.user_data["sub_checked"] = True
+        user = await USER_QUERIES.fetchrow(conn, "user_limits", user_id)
 
-                                    limit = FREE_LIMIT + user.get("bonus_images", 0)
-                                else:
-                                    limit = free_limit
-                            else:
-                                limit = PREMIUM_IMAGE_LIMIT
-
-                            if user["image_count"] >= limit:
-                                await msg.reply_text(
-                                    await t(user_id, "image_limit_exhausted"),
-                                    reply_markup=InlineKeyboardMarkup([
-                                        [InlineKeyboardButton("🍩 Buy Premium", callback_data="buy_spb")]
-                                    ])
-                                )
-                                return
+        premium = is_premium(user)
 
-                        # ================= VIDEO / CARTOON =================
-                        elif mode in ["video", "cartoon", "remix"]:
+        logging.info(f"USER BEFORE CHECK: {dict(user)}")
 
-                            if not premium:
-                                subscribed = await is_user_subscribed(context.bot, user_id)
+        paid_video = user.get("paid_video") or 0
+        video_count = user.get("video_count") or 0
 
-                                # ===== ЖЁСТКАЯ БЛОКИРОВКА ДО ПРОВЕРКИ =====
-                                if not context.user_data.get("sub_checked"):
+        logging.info(
+            f"🎯 DECISION user={user_id} "
+            f"paid={paid_video} video_count={video_count} premium={premium}"
+        )
 
-                                    context.user_data["pending_video"] = True
+        # ===== ТОЛЬКО ПРОВЕРКА (БЕЗ СПИСАНИЯ) =====
 
-                                    await msg.reply_text(
-                                        await t(user_id, "video_sub_required"),
-                                        reply_markup=get_subscribe_keyboard()
-                                    )
-                                    return
+        if paid_video > 0:
+            logging.info(f"💰 PAID VIDEO AVAILABLE user={user_id}")
 
-                            logging.info(f"🎬 START VIDEO FLOW user={user_id}")
+        elif premium:
+            logging.info(f"🍩 USING PREMIUM LIMIT user={user_id}")
 
-                            user = await conn.fetchrow(
-                                "SELECT * FROM users WHERE user_id=$1",
-                                user_id
-                            )
+            if video_count >= PREMIUM_VIDEO_LIMIT:
+                await msg.reply_text(await t(user_id, "video_premium_limit"))
+                return None
 
-                            premium = is_premium(user)
+        else:
+            logging.info(f"🆓 USING FREE LIMIT user={user_id}")
 
-                            logging.info(f"USER BEFORE CHECK: {dict(user)}")
+            if video_count >= FREE_VIDEO_LIMIT:
+                keyboard = InlineKeyboardMarkup([
+                    [InlineKeyboardButton("💳 Buy 1 video", callback_data="buy_video")],
+                    [InlineKeyboardButton("🍩 Premium", callback_data="buy_spb")]
+                ])
 
-                            paid_video = user.get("paid_video") or 0
-                            video_count = user.get("video_count") or 0
+                await msg.reply_text(
+                    await t(user_id, "video_limit_over"),
+                    reply_markup=keyboard
+                )
+                return None
 
-                            logging.info(
-                                f"🎯 DECISION user={user_id} "
-                                f"paid={paid_video} video_count={video_count} premium={premium}"
-                            )
+    return user
+
+
+async def _handle_generation_inner(job):
+
+    update = job["update"]
+    context = job["context"]
+    prompt = job.get("prompt")
+    size = job.get("size", "1024x1024")
+    model = job.get("model", "banana2")
+    images = job.get("images", [])
+    user_id = job["user_id"]
+    status = job.get("status")
+    mode = job.get("mode", "image")
 
-                            # ===== ТОЛЬКО ПРОВЕРКА (БЕЗ СПИСАНИЯ) =====
+    msg = getattr(update, "message", None)
+    if not msg and getattr(update, "callback_query", None):
+        msg = update.callback_query.message
+
+    # ===== СЕМАФОРЫ =====
+    sem = semaphore_image
+    if mode in ["video", "cartoon", "remix"]:
+        sem = semaphore_video
+    elif mode == "music":
+        sem = semaphore_music
+
+    async with GLOBAL_RATE_LIMIT:
+        async with GLOBAL_SEMAPHORE:
+            async with sem:
+                try:
+                    # ===== 🔥 DB =====
+                    async with db_pool.acquire() as conn:
 
-                            if paid_video > 0:
-                                logging.info(f"💰 PAID VIDEO AVAILABLE user={user_id}")
+                        user = await USER_QUERIES.fetchrow(conn, "user_limits", user_id)
 
-                            elif premium:
-                                logging.info(f"🍩 USING PREMIUM LIMIT user={user_id}")
+                        if not user:
+                            return
 
-                                if video_count >= PREMIUM_VIDEO_LIMIT:
-                                    await msg.reply_text(await t(user_id, "video_premium_limit"))
-                                    return
+                        logging.info(f"USER DATA: {dict(user)}")
 
-                            else:
-                                logging.info(f"🆓 USING FREE LIMIT user={user_id}")
+                        await reset_week_if_needed(user)
+                        user = await check_generation_limits(conn, user, mode, context, msg)
 
-                                if video_count >= FREE_VIDEO_LIMIT:
-                                    keyboard = InlineKeyboardMarkup([
-                                        [InlineKeyboardButton("💳 Buy 1 video", callback_data="buy_video")],
-                                        [InlineKeyboardButton("🍩 Premium", callback_data="buy_spb")]
-                                    ])
+                        if not user:
+                            return
 
-                                    await msg.reply_text(
-                                        await t(user_id, "video_limit_over"),
-                                        reply_markup=keyboard
-                                    )
-                                    return
+                        premium = is_premium(user)
 
 
                         model_name = "NanoBanana 2" if model == "banana1" else "NanoBanana 3(NEW)"
 
-                        text_map = {
-                            "image": await t(user_id, "image_status", model_name=model_name),
-                            "video": await t(user_id, "video_status"),
-                            "cartoon": await t(user_id, "cartoon_status"),
-                            "remix": await t(user_id, "remix_status"),
-                            "music": await t(user_id, "music_status")
+                        status_keys = {
+                            "image": "image_status",
+                            "video": "video_status",
+                            "cartoon": "cartoon_status",
+                            "remix": "remix_status",
+                            "music": "music_status"
                         }
+                        status_text = await t(
+                            user_id,
+                            status_keys.get(mode, "generation_default"),
+                            model_name=model_name
+                        )
 
                         if status:
                             try:
                                 await status.edit_text(
-                                    text_map.get(mode, await t(user_id, "generation_default")),
+                                    status_text,
                                     reply_markup=cancel_button,
                                     parse_mode="HTML"
                                 )
@@ -1833,33 +2603,43 @@ async def _handle_generation_inner(job):
                                 pass
                         else:
                             status = await msg.reply_text(
-                                text_map.get(mode, await t(user_id, "generation_default")),
+                                status_text,
                                 reply_markup=cancel_button,
                                 parse_mode="HTML"
                             )
 
                         images_local = images[:MAX_INPUT_IMAGES]
 
-                        cartoon_style = context.user_data.get("cartoon_style")
+                        prompt = generation_prompt(prompt, mode, context.user_data.get("cartoon_style"))
 
-                        if prompt:
-                            if mode in ["cartoon", "video", "remix"] and cartoon_style:
-                                prompt = f"{cartoon_style}, {prompt}"
+                        # Тот же запрос (текст + референсы) уже отправлялся — шлем по file_id.
+                        cache_scope = cache_key = None
+                        if prompt and mode in RESULT_CACHE_MODES:
+                            cache_scope = await RESULT_CACHE.scope(mode, model, size, images_local)
+                            cache_key = await RESULT_CACHE.key(mode, prompt, model, size, scope=cache_scope)
 
-                        if prompt:
-                            prompt = clean_prompt(prompt)
+                        cached = None
+                        if cache_key and not job.get("repeat"):
+                            cached = await RESULT_CACHE.get(cache_key)
 
-                        cache_key = f"{prompt}_{model}_{size}" if prompt else None
-                        cached = generation_cache.get(cache_key) if cache_key else None
+                        if cached:
+                            reply_markup = await result_keyboard(user_id) if mode == "image" else None
+
+                            if await send_cached_result(cached, context.bot, update.effective_chat.id, reply_markup):
+                                PROGRESS.finish(status)
+                                try:
+                                    if status:
+                                        await status.delete()
+                                except:
+                                    pass
+
+                                # результат из кэша списывается как обычная генерация
+                                # (лимиты проверены выше) — как трек из music_cache
+                                await charge_cached_result(user_id, mode)
+                                return
+
+                            await RESULT_CACHE.invalidate(cache_key)
 
-                        if cached and time.time() - cached["time"] < CACHE_TIME and mode not in ["video", "music"]:
-                            try:
-                                if status:
-                                    await status.delete()
-                            except:
-                                pass
-                            await msg.reply_photo(photo=cached["image"])
-                            return
                         # ================= IMAGE =================
                         if mode == "image":
 
@@ -1871,20 +2651,17 @@ async def _handle_generation_inner(job):
                                     while True:
                                         dots = dots_list[i % len(dots_list)]
                                         text = await t(user_id, "image_wait_dots", model_name=model_name, dots=dots)
-                                        try:
-                                            await safe_edit(status, text, parse_mode="HTML")
-                                        except:
-                                            pass
+                                        PROGRESS.publish(status, text, parse_mode="HTML")
                                         i += 1
-                                        await asyncio.sleep(1.5)
+                                        # чаще кадры все равно схлопнутся
+                                        await asyncio.sleep(PROGRESS.chat_interval)
                                 except asyncio.CancelledError:
                                     pass
 
                             animation_task = asyncio.create_task(dots_animation())
 
-                            upload_task = asyncio.create_task(
-                                fake_photo_upload(context.bot, update.effective_chat.id)
-                            )
+                            chat_id = update.effective_chat.id
+                            PROGRESS.start_action(context.bot, chat_id, "upload_photo")
 
                             try:
                                 async def generate():
@@ -1905,15 +2682,9 @@ async def _handle_generation_inner(job):
                                 )
 
                             finally:
-                                upload_task.cancel()
                                 animation_task.cancel()
-
-                                try:
-                                    await upload_task
-                                except asyncio.CancelledError:
-                                    pass
-                                except Exception:
-                                    pass
+                                PROGRESS.stop_action(chat_id)
+                                PROGRESS.finish(status)
 
                                 try:
                                     await animation_task
@@ -1927,30 +2698,22 @@ async def _handle_generation_inner(job):
                             except:
                                 pass
 
-                            keyboard = InlineKeyboardMarkup([
-                                [
-                                    InlineKeyboardButton(await t(user_id, "repeat"), callback_data="repeat"),
-                                    InlineKeyboardButton(await t(user_id, "start_over"), callback_data="restart")
-                                ],
-                                [
-                                    InlineKeyboardButton(await t(user_id, "finish"), callback_data="finish")
-                                ]
-                            ])
+                            sent = await MEDIA.send(
+                                result,
+                                msg.reply_photo,
+                                "photo",
+                                "image.png",
+                                url_limit=URL_PHOTO_LIMIT,
+                                max_bytes=UPLOAD_PHOTO_LIMIT,
+                                reply_markup=await result_keyboard(user_id)
+                            )
 
-                            await msg.reply_photo(photo=result, reply_markup=keyboard)
+                            await RESULT_CACHE.set(cache_key, sent)
+                            if cache_key:
+                                await PROMPT_INDEX.add(cache_scope, prompt, cache_key)
 
                             # ✅ СПИСАНИЕ ТОЛЬКО ПОСЛЕ УСПЕШНОЙ ГЕНЕРАЦИИ
-                            async with db_pool.acquire() as conn:
-                                await conn.execute(
-                                    """
-                                    UPDATE users
-                                    SET image_count = image_count + 1
-                                    WHERE user_id=$1
-                                    """,
-                                    user_id
-                                )
-
-                            USER_CACHE.pop(user_id, None)
+                            await charge_image(user_id)
 
                             async with db_pool.acquire() as conn:
                                 async with conn.transaction():
@@ -1999,7 +2762,7 @@ async def _handle_generation_inner(job):
                                                 user_id
                                             )
 
-                                            USER_CACHE.pop(referrer_id, None)
+                                            await USER_CACHE.invalidate(referrer_id)
 
                                         else:
                                             await conn.execute(
@@ -2011,7 +2774,7 @@ async def _handle_generation_inner(job):
                                                 user_id
                                             )
 
-                            USER_CACHE.pop(user_id, None)
+                            await USER_CACHE.invalidate(user_id)
 
                             context.user_data["last_prompt"] = prompt
                             context.user_data["last_images"] = images_local
@@ -2022,46 +2785,35 @@ async def _handle_generation_inner(job):
                             import random
 
                             async def progress_updater():
-                                steps = [
-                                    await t(user_id, "progress_analyze_prompt"),
-                                    await t(user_id, "progress_prepare_model"),
-                                    await t(user_id, "progress_generate_scenes"),
-                                    await t(user_id, "progress_render_frames"),
-                                    await t(user_id, "progress_magic_help"),
-                                    await t(user_id, "progress_magic"),
-                                    await t(user_id, "progress_dots"),
-                                    await t(user_id, "progress_lunch"),
-                                    await t(user_id, "progress_render_frames_2"),
-                                    await t(user_id, "progress_rabbit_frame"),
-                                    await t(user_id, "progress_find_rabbit"),
-                                    await t(user_id, "progress_clean_extra"),
-                                    await t(user_id, "progress_postprocess"),
-                                    await t(user_id, "progress_almost_ready"),
-                                    await t(user_id, "progress_little_left"),
-                                    await t(user_id, "progress_final_assembly")
-                                ]
+                                steps = await t_many(user_id, [
+                                    "progress_analyze_prompt",
+                                    "progress_prepare_model",
+                                    "progress_generate_scenes",
+                                    "progress_render_frames",
+                                    "progress_magic_help",
+                                    "progress_magic",
+                                    "progress_dots",
+                                    "progress_lunch",
+                                    "progress_render_frames_2",
+                                    "progress_rabbit_frame",
+                                    "progress_find_rabbit",
+                                    "progress_clean_extra",
+                                    "progress_postprocess",
+                                    "progress_almost_ready",
+                                    "progress_little_left",
+                                    "progress_final_assembly"
+                                ])
 
                                 idx = 0
-                                last_text = ""
 
                                 try:
                                     while idx < len(steps):
-                                        new_text = steps[idx]
-
-                                        if new_text != last_text:
-                                            try:
-                                                await safe_edit(status, new_text)
-                                                last_text = new_text
-                                            except:
-                                                pass
+                                        PROGRESS.publish(status, steps[idx])
 
                                         await asyncio.sleep(random.randint(5, 10))
                                         idx += 1
 
-                                    try:
-                                        await status.edit_text(await t(user_id, "progress_finish_processing"))
-                                    except:
-                                        pass
+                                    PROGRESS.publish(status, await t(user_id, "progress_finish_processing"))
 
                                 except asyncio.CancelledError:
                                     pass
@@ -2083,7 +2835,7 @@ async def _handle_generation_inner(job):
                                     return result
 
 
-                                result_bytes = await smart_retry(
+                                result_url = await smart_retry(
                                     generate_video,
                                     retries=2,
                                     base_delay=5,
@@ -2092,110 +2844,69 @@ async def _handle_generation_inner(job):
 
                             finally:
                                 progress_task.cancel()
+                                PROGRESS.finish(status)
 
                             try:
                                 await status.delete()
                             except:
                                 pass
 
-                            result_file = io.BytesIO(result_bytes)
-                            result_file.name = "video.mp4"
-                            result_file.seek(0)
+                            sent = await MEDIA.send(
+                                result_url,
+                                context.bot.send_video,
+                                "video",
+                                "video.mp4",
+                                fallback=(context.bot.send_document, "document"),
+                                chat_id=update.effective_chat.id
+                            )
 
-                            try:
-                                await context.bot.send_video(
-                                    chat_id=update.effective_chat.id,
-                                    video=result_file
-                                )
-                            except:
-                                result_file.seek(0)
-                                await context.bot.send_document(
-                                    chat_id=update.effective_chat.id,
-                                    document=result_file
-                                )
+                            await RESULT_CACHE.set(cache_key, sent)
+                            if cache_key:
+                                await PROMPT_INDEX.add(cache_scope, prompt, cache_key)
 
                             # ✅ СПИСАНИЕ ТОЛЬКО ПОСЛЕ УСПЕШНОЙ ОТПРАВКИ
-                            async with db_pool.acquire() as conn:
-
-                                user = await conn.fetchrow(
-                                    "SELECT paid_video, video_count FROM users WHERE user_id=$1",
-                                    user_id
-                                )
-
-                                paid_video = user.get("paid_video") or 0
-                                video_count = user.get("video_count") or 0
-
-                                if paid_video > 0:
-                                    await conn.execute(
-                                        """
-                                        UPDATE users
-                                        SET paid_video = paid_video - 1
-                                        WHERE user_id=$1
-                                        """,
-                                        user_id
-                                    )
-                                else:
-                                    await conn.execute(
-                                        """
-                                        UPDATE users
-                                        SET video_count = video_count + 1
-                                        WHERE user_id=$1
-                                        """,
-                                        user_id
-                                    )
-
-                            USER_CACHE.pop(user_id, None)
+                            await charge_video(user_id)
 
 
                         # ================= REMIX =================
                         elif mode == "remix":
 
                             import random
-                            import tempfile
-                            import subprocess
 
                             async def progress_updater():
-                                steps = [
-                                    await t(user_id, "remix_progress_analyze_video"),
-                                    await t(user_id, "remix_progress_search_material"),
-                                    await t(user_id, "remix_progress_prepare_kling"),
-                                    await t(user_id, "remix_progress_resize"),
-                                    await t(user_id, "remix_progress_processing"),
-                                    await t(user_id, "remix_progress_alien"),
-                                    await t(user_id, "remix_progress_remove_extra"),
-                                    await t(user_id, "remix_progress_processing"),
-                                    await t(user_id, "remix_progress_effects"),
-                                    await t(user_id, "remix_progress_tiktok"),
-                                    await t(user_id, "remix_progress_magic"),
-                                    await t(user_id, "remix_progress_star"),
-                                    await t(user_id, "remix_progress_wish"),
-                                    await t(user_id, "progress_render_frames"),
-                                    await t(user_id, "remix_progress_almost"),
-                                    await t(user_id, "remix_progress_light"),
-                                    await t(user_id, "remix_progress_elephant"),
-                                    await t(user_id, "remix_progress_save"),
-                                    await t(user_id, "remix_progress_finish"),
-                                    await t(user_id, "remix_progress_masterpiece"),
-                                    await t(user_id, "remix_progress_more"),
-                                    await t(user_id, "remix_progress_sloth"),
-                                    await t(user_id, "remix_progress_speedup"),
-                                    await t(user_id, "remix_progress_popcorn"),
-                                    await t(user_id, "progress_final_assembly")
-                                ]
+                                steps = await t_many(user_id, [
+                                    "remix_progress_analyze_video",
+                                    "remix_progress_search_material",
+                                    "remix_progress_prepare_kling",
+                                    "remix_progress_resize",
+                                    "remix_progress_processing",
+                                    "remix_progress_alien",
+                                    "remix_progress_remove_extra",
+                                    "remix_progress_processing",
+                                    "remix_progress_effects",
+                                    "remix_progress_tiktok",
+                                    "remix_progress_magic",
+                                    "remix_progress_star",
+                                    "remix_progress_wish",
+                                    "progress_render_frames",
+                                    "remix_progress_almost",
+                                    "remix_progress_light",
+                                    "remix_progress_elephant",
+                                    "remix_progress_save",
+                                    "remix_progress_finish",
+                                    "remix_progress_masterpiece",
+                                    "remix_progress_more",
+                                    "remix_progress_sloth",
+                                    "remix_progress_speedup",
+                                    "remix_progress_popcorn",
+                                    "progress_final_assembly"
+                                ])
 
                                 idx = 0
-                                last_text = ""
 
                                 try:
                                     while True:
-                                        new_text = steps[idx % len(steps)]
-
-                                        if new_text != last_text:
-                                            try:
-                                                await safe_edit(status, new_text)
-                                                last_text = new_text
-                                            except:
-                                                pass
+                                        PROGRESS.publish(status, steps[idx % len(steps)])
 
                                         await asyncio.sleep(random.randint(4, 8))
                                         idx += 1
@@ -2204,6 +2915,7 @@ async def _handle_generation_inner(job):
                                     pass
 
                             video_bytes = job.get("video")
+                            video_meta = job.get("video_meta")
                             images = job.get("images", [])
 
                             # 🔥 HARD FALLBACK
@@ -2212,6 +2924,7 @@ async def _handle_generation_inner(job):
                                     context.user_data.get("input_video")
                                     or context.user_data.get("input_video_bytes")
                                 )
+                                video_meta = context.user_data.get("input_video_meta")
 
                             if not images:
                                 images = context.user_data.get("input_images", [])
@@ -2221,33 +2934,13 @@ async def _handle_generation_inner(job):
                                     await msg.reply_text(await t(user_id, "send_video_first"))
                                 return
 
-                            # ================= AUTO RESIZE 720x720 =================
+                            # ================= 720x720 (ТОЛЬКО ЕСЛИ ЕЩЕ НЕ ПРИВЕДЕНО) =================
+                            # Обычно видео уже нормализовано в handle_video — тогда это no-op.
                             try:
-                                with tempfile.NamedTemporaryFile(suffix=".mp4") as inp, \
-                                     tempfile.NamedTemporaryFile(suffix=".mp4") as out:
-
-                                    inp.write(video_bytes)
-                                    inp.flush()
-
-                                    cmd = [
-                                        "ffmpeg",
-                                        "-y",
-                                        "-i", inp.name,
-                                        "-vf", "scale=720:720:force_original_aspect_ratio=decrease,pad=720:720:(ow-iw)/2:(oh-ih)/2",
-                                        "-c:v", "libx264",
-                                        "-preset", "veryfast",
-                                        "-crf", "23",
-                                        "-pix_fmt", "yuv420p",
-                                        "-movflags", "+faststart",
-                                        "-c:a", "aac",
-                                        "-b:a", "128k",
-                                        out.name
-                                    ]
-
-                                    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-                                    with open(out.name, "rb") as f:
-                                        video_bytes = f.read()
+                                video_bytes, video_meta = await normalize_remix_video(
+                                    video_bytes,
+                                    video_meta
+                                )
 
                             except Exception as e:
                                 print("⚠️ RESIZE ERROR:", e)
@@ -2260,89 +2953,81 @@ async def _handle_generation_inner(job):
                             if images and "@Image" not in prompt:
                                 prompt = prompt + " Use @Image1 for style reference"
 
-                            # 🔥 FIX: convert images bytes -> base64 urls
-                            image_urls = []
-
-                            if images:
-                                for img in images:
-                                    try:
-                                        img_b64 = base64.b64encode(img).decode("utf-8")
-                                        image_urls.append(f"data:image/jpeg;base64,{img_b64}")
-                                    except Exception as e:
-                                        print("⚠️ IMAGE BASE64 ERROR:", e)
-
                             progress_task = asyncio.create_task(progress_updater())
 
-                            result_bytes = None
                             video_url = None
 
                             try:
                                 # ================= REQUEST =================
-                                video_b64 = base64.b64encode(video_bytes).decode("utf-8")
-                                video_url = f"data:video/mp4;base64,{video_b64}"
-
-                                async with aiohttp.ClientSession() as session:
-
-                                    async with session.post(
-                                        "https://queue.fal.run/fal-ai/kling-video/o1/standard/video-to-video/edit",
-                                        json={
-                                            "prompt": prompt,
-                                            "video_url": video_url,
-                                            "image_urls": image_urls
-                                        },
-                                        headers={
-                                            "Authorization": f"Key {FAL_KEY}",
-                                            "Content-Type": "application/json"
-                                        }
-                                    ) as resp:
+                                # видео и референсы — один раз в хранилище (кэш по хэшу)
+                                video_url = await ASSETS.url_for(video_bytes, "video/mp4")
+                                image_urls = await ASSETS.urls_for(images or [])
+
+                                session = HTTP.session
+
+                                async with session.post(
+                                    FAL_WEBHOOKS.submit_url(
+                                        f"{FAL_QUEUE_URL}/fal-ai/kling-video/o1/standard/video-to-video/edit"
+                                    ),
+                                    json={
+                                        "prompt": prompt,
+                                        "video_url": video_url,
+                                        "image_urls": image_urls
+                                    },
+                                    headers={
+                                        "Authorization": f"Key {FAL_KEY}",
+                                        "Content-Type": "application/json"
+                                    },
+                                    timeout=FAL_REQUEST_TIMEOUT
+                                ) as resp:
+
+                                    text = await resp.text()
 
-                                        text = await resp.text()
-
-                                        try:
-                                            data = await resp.json()
-                                        except:
-                                            raise Exception(f"Kling not JSON: {text}")
+                                    try:
+                                        data = await resp.json()
+                                    except:
+                                        raise Exception(f"Kling not JSON: {text}")
 
-                                        request_id = data.get("request_id")
+                                    request_id = data.get("request_id")
 
-                                        if not request_id:
-                                            raise Exception(f"No request_id: {data}")
+                                    if not request_id:
+                                        raise Exception(f"No request_id: {data}")
 
                                 # ================= POLL =================
-                                status_url = f"https://queue.fal.run/fal-ai/kling-video/requests/{request_id}/status"
-                                result_url = f"https://queue.fal.run/fal-ai/kling-video/requests/{request_id}"
-
-                                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=600)) as session:
-
-                                    for _ in range(600):  # 🔥 было 300 → стало 600 (до 20 минут)
-
-                                        async with session.get(status_url, timeout=60) as s:
-
-                                            status_json = await s.json()
-                                            state = status_json.get("status")
-
-                                            if state == "COMPLETED":
-
-                                                async with session.get(result_url, timeout=60) as r:
-                                                    result = await r.json()
-
-                                                    video_file_url = result.get("video", {}).get("url")
+                                status_url = f"{FAL_QUEUE_URL}/fal-ai/kling-video/requests/{request_id}/status"
+                                result_url = f"{FAL_QUEUE_URL}/fal-ai/kling-video/requests/{request_id}"
+
+                                completion = await wait_fal_completion(
+                                    status_url,
+                                    request_id,
+                                    headers={"Authorization": f"Key {FAL_KEY}"},
+                                    max_wait=FAL_REMIX_MAX_WAIT,  # до 20 минут
+                                    profile="video",
+                                    label=f"remix request_id={request_id} user={user_id}",
+                                    queue_position=data.get("queue_position")
+                                )
 
-                                                    if not video_file_url:
-                                                        raise Exception(f"Bad result: {result}")
+                                result = await fal_fetch_result(
+                                    session,
+                                    result_url,
+                                    {"Authorization": f"Key {FAL_KEY}"},
+                                    completion
+                                )
 
-                                                    # 🔥 НЕ качаем сразу — сначала попробуем отправить по URL
-                                                    break
+                                video_file_url = result.get("video", {}).get("url")
 
-                                            if state == "FAILED":
-                                                raise Exception(f"FAL failed: {status_json}")
+                                if not video_file_url:
+                                    raise Exception(f"Bad result: {result}")
 
-                                        await asyncio.sleep(2)
+                                # 🔥 НЕ качаем сразу — сначала попробуем отправить по URL
 
                             except Exception as e:
 
                                 err = traceback.format_exc()
 
+                                # иначе отложенный кадр анимации перетрет ошибку
+                                PROGRESS.finish(status)
+
                                 try:
                                     await safe_edit(status, await t(user_id, "remix_error", error=e))
                                 except:
@@ -2353,6 +3038,7 @@ async def _handle_generation_inner(job):
 
                             finally:
                                 progress_task.cancel()
+                                PROGRESS.finish(status)
                                 try:
                                     await progress_task
                                 except:
@@ -2371,52 +3057,29 @@ async def _handle_generation_inner(job):
 
                             # ================= SEND VIDEO =================
                             try:
-                                # 🔥 1. ПЫТАЕМСЯ отправить напрямую по URL (ЛУЧШИЙ ВАРИАНТ)
-                                await context.bot.send_video(
+                                # 🔥 1. по URL (Telegram качает сам), 2. потоком через временный файл
+                                await MEDIA.send(
+                                    video_file_url,
+                                    context.bot.send_video,
+                                    "video",
+                                    "video.mp4",
                                     chat_id=update.effective_chat.id,
-                                    video=video_file_url,
                                     supports_streaming=True,
-                                    filename="video.mp4",
                                     read_timeout=120,
                                     write_timeout=120
                                 )
 
                             except Exception as e:
-                                logging.error(f"❌ SEND URL VIDEO ERROR: {e}")
+                                logging.error(f"❌ SEND VIDEO ERROR: {e}")
 
-                                # 🔥 2. ЕСЛИ НЕ ПОЛУЧИЛОСЬ — скачиваем
+                                # 🔥 3. ФИНАЛЬНЫЙ ФОЛБЭК — отправляем ССЫЛКУ (а не document)
                                 try:
-                                    async with aiohttp.ClientSession() as session:
-                                        async with session.get(video_file_url, timeout=600) as v:
-                                            result_bytes = await v.read()
-
-                                    if not result_bytes:
-                                        raise Exception("Empty video bytes")
-
-                                    result_file = io.BytesIO(result_bytes)
-                                    result_file.name = "video.mp4"
-                                    result_file.seek(0)
-
-                                    await context.bot.send_video(
+                                    await context.bot.send_message(
                                         chat_id=update.effective_chat.id,
-                                        video=result_file,
-                                        supports_streaming=True,
-                                        filename="video.mp4",
-                                        read_timeout=120,
-                                        write_timeout=120
+                                        text=await t(user_id, "video_too_big_link", url=video_file_url)
                                     )
-
-                                except Exception as e2:
-                                    logging.error(f"❌ SEND DOWNLOADED VIDEO ERROR: {e2}")
-
-                                    # 🔥 3. ФИНАЛЬНЫЙ ФОЛБЭК — отправляем ССЫЛКУ (а не document)
-                                    try:
-                                        await context.bot.send_message(
-                                            chat_id=update.effective_chat.id,
-                                            text=await t(user_id, "video_too_big_link", url=video_file_url)
-                                        )
-                                    except:
-                                        pass
+                                except:
+                                    pass
                             # ✅ СПИСАНИЕ ПОСЛЕ УСПЕХА
                             async with db_pool.acquire() as conn:
 
@@ -2431,7 +3094,8 @@ async def _handle_generation_inner(job):
                                         user_id
                                     )
 
-                            USER_CACHE.pop(user_id, None)
+                            await USER_CACHE.invalidate(user_id)
+                            STATS.incr("videos")
                 
                         # ================= MUSIC =================
                         elif mode == "music":
@@ -2440,13 +3104,9 @@ async def _handle_generation_inner(job):
                             if not premium:
                                 paid_music = user.get("paid_music", 0)
                                 if paid_music <= 0:
-                                    keyboard = InlineKeyboardMarkup([
-                                        [InlineKeyboardButton("💳 Buy track (69₽)", callback_data="buy_music")],
-                                        [InlineKeyboardButton("🍩 Premium", callback_data="buy_spb")]
-                                    ])
                                     await msg.reply_text(
                                         await t(user_id, "music_need_pay"),
-                                        reply_markup=keyboard
+                                        reply_markup=music_pay_keyboard()
                                     )
                                     return
 
@@ -2454,7 +3114,6 @@ async def _handle_generation_inner(job):
 
                             async def progress_updater():
                                 pct = 0
-                                last_text = ""
 
                                 try:
                                     while True:
@@ -2473,19 +3132,12 @@ async def _handle_generation_inner(job):
                                         bars = pct // 10
                                         bar = "🟩" * bars + "⬜" * (10 - bars)
 
-                                        new_text = await t(
+                                        PROGRESS.publish(status, await t(
                                             user_id,
                                             "music_generating_progress",
                                             bar=bar,
                                             pct=pct
-                                        )
-
-                                        if new_text != last_text:
-                                            try:
-                                                await safe_edit(status, new_text)
-                                                last_text = new_text
-                                            except:
-                                                pass
+                                        ))
 
                                 except asyncio.CancelledError:
                                     pass
@@ -2508,6 +3160,7 @@ async def _handle_generation_inner(job):
 
                             finally:
                                 progress_task.cancel()
+                                PROGRESS.finish(status)
                                 try:
                                     await progress_task
                                 except asyncio.CancelledError:
@@ -2526,44 +3179,40 @@ async def _handle_generation_inner(job):
                             audio_file.name = result.get("filename", "song.mp3")
                             audio_file.seek(0)
 
-                            sent_ok = False
+                            sent = None
 
                             try:
-                                await context.bot.send_audio(
+                                sent = await context.bot.send_audio(
                                     chat_id=chat_id,
                                     audio=audio_file,
                                     filename=audio_file.name
                                 )
-                                sent_ok = True
 
                             except Exception as e:
                                 logging.error(f"❌ SEND LYRIA3 AUDIO ERROR: {e}")
 
                                 audio_file.seek(0)
-                                await context.bot.send_document(
+                                sent = await context.bot.send_document(
                                     chat_id=chat_id,
                                     document=audio_file,
                                     filename=audio_file.name
                                 )
-                                sent_ok = True
 
                             # ✅ СПИСАНИЕ ТОЛЬКО ПОСЛЕ УСПЕШНОЙ ОТПРАВКИ
-                            if sent_ok and not premium:
-                                async with db_pool.acquire() as conn:
-                                    await conn.execute(
-                                        "UPDATE users SET paid_music = paid_music - 1 WHERE user_id=$1",
-                                        user_id
-                                    )
-                                    USER_CACHE.pop(user_id, None)
+                            await charge_music(user_id, premium)
 
-                            # Дополнительно считаем генерации музыки для /stats.
-                            if sent_ok:
-                                async with db_pool.acquire() as conn:
-                                    await conn.execute(
-                                        "UPDATE users SET music_count = music_count + 1 WHERE user_id=$1",
-                                        user_id
+                            # file_id трека — в music_cache для следующих таких же запросов
+                            found = message_file(sent)
+                            if found:
+                                try:
+                                    await MUSIC_CACHE.save(
+                                        music_cache_key(job.get("prompt")),
+                                        *found,
+                                        file_size=len(result["audio_bytes"]),
+                                        mime_type=result.get("mime_type")
                                     )
-                                    USER_CACHE.pop(user_id, None)
+                                except Exception as e:
+                                    logging.warning(f"⚠️ MUSIC CACHE SAVE ERROR: {e}")
 
 
                 except Exception as e:
@@ -2595,81 +3244,58 @@ async def smart_retry(coro, retries=3, base_delay=1, max_delay=10):
             await asyncio.sleep(delay)
 
 # ================== WORKERS ==================
-async def image_worker():
-    while True:
-        try:
-            job = await generation_queue_image.get()
-            user_id = job.get("user_id")
-
-            try:
-                if time.time() - job.get("created_at", 0) > QUEUE_JOB_TTL:
-                    logging.warning(f"⏳ IMAGE JOB EXPIRED: {user_id}")
-                    if user_id:
-                        unlock_user_generation(user_id)
-                    continue
-
-                await handle_generation_job(job)
+async def run_generation_job(job):
+    user_id = job.get("user_id")
 
-            except Exception as e:
-                logging.error(f"❌ IMAGE WORKER ERROR: {e}", exc_info=True)
+    if time.time() - (job.get("created_at") or 0) > QUEUE_JOB_TTL:
+        logging.warning(f"⏳ {job.get('mode', 'image').upper()} JOB EXPIRED: {user_id}")
+        if user_id:
+            unlock_user_generation(user_id)
+        return
 
-            finally:
-                generation_queue_image.task_done()
+    await handle_generation_job(job)
 
-        except Exception as e:
-            logging.critical(f"💀 IMAGE WORKER CRASH: {e}", exc_info=True)
-            await asyncio.sleep(1)
 
+async def generation_worker(name):
+    label = name.upper()
 
-async def video_worker():
     while True:
         try:
-            job = await generation_queue_video.get()
-            user_id = job.get("user_id")
+            if JOBS:
+                entry = await JOBS.get(name)
 
-            try:
-                if time.time() - job.get("created_at", 0) > QUEUE_JOB_TTL:
-                    logging.warning(f"⏳ VIDEO JOB EXPIRED: {user_id}")
-                    if user_id:
-                        unlock_user_generation(user_id)
+                if entry is None:
                     continue
 
-                await handle_generation_job(job)
-
-            except Exception as e:
-                logging.error(f"❌ VIDEO WORKER ERROR: {e}", exc_info=True)
-
-            finally:
-                generation_queue_video.task_done()
-
-        except Exception as e:
-            logging.critical(f"💀 VIDEO WORKER CRASH: {e}", exc_info=True)
-            await asyncio.sleep(1)
+                entry_id, job = entry
 
+                await JOBS.run(
+                    name,
+                    entry_id,
+                    job,
+                    lambda j: run_generation_job(restore_job(j, app.bot))
+                )
+                continue
 
-async def music_worker():
-    while True:
-        try:
-            job = await generation_queue_music.get()
-            user_id = job.get("user_id")
+            queue = LOCAL_QUEUES[name]
+            job = await queue.get()
+            started = time.monotonic()
 
             try:
-                if time.time() - job.get("created_at", 0) > QUEUE_JOB_TTL:
-                    logging.warning(f"⏳ MUSIC JOB EXPIRED: {user_id}")
-                    if user_id:
-                        unlock_user_generation(user_id)
-                    continue
-
-                await handle_generation_job(job)
+                await run_generation_job(job)
 
             except Exception as e:
-                logging.error(f"❌ MUSIC WORKER ERROR: {e}", exc_info=True)
+                logging.error(f"❌ {label} WORKER ERROR: {e}", exc_info=True)
 
             finally:
-                generation_queue_music.task_done()
+                queue.task_done()
+                LOCAL_THROUGHPUT.record(name, time.monotonic() - started)
+
+        except asyncio.CancelledError:
+            raise
 
         except Exception as e:
-            logging.critical(f"💀 MUSIC WORKER CRASH: {e}", exc_info=True)
+            logging.critical(f"💀 {label} WORKER CRASH: {e}", exc_info=True)
             await asyncio.sleep(1)
 
 async def worker_watchdog():
@@ -2714,9 +3340,9 @@ async def worker_watchdog():
             logging.warning(f"🔓 Разблокировано пользователей: {unlocked}")
 
         # ================= 📊 ОЧЕРЕДИ =================
-        img_q = generation_queue_image.qsize()
-        vid_q = generation_queue_video.qsize()
-        mus_q = generation_queue_music.qsize()
+        img_q = queue_depth("image")
+        vid_q = queue_depth("video")
+        mus_q = queue_depth("music")
         total = img_q + vid_q + mus_q
 
         if total > 0:
@@ -2882,7 +3508,9 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
                         premium_until, user_id
                     )
 
-                USER_CACHE.pop(user_id, None)
+                await USER_CACHE.invalidate(user_id)
+                forget_payments(user_id)
+                STATS.incr("premium_payments")
 
                 await update.message.reply_text(
                     await t(user_id, "payment_stars_success")
@@ -2922,7 +3550,9 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
                         premium_until, user_id
                     )
 
-                USER_CACHE.pop(user_id, None)
+                await USER_CACHE.invalidate(user_id)
+                forget_payments(user_id)
+                STATS.incr("premium_payments")
 
                 await update.message.reply_text(
                     await t(user_id, "payment_spb_success")
@@ -2986,7 +3616,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 lang, user_id
             )
 
-        USER_CACHE.pop(user_id, None)
+        await USER_CACHE.invalidate(user_id, scope="language")
+        LANG_CACHE.set(user_id, lang)
 
         text_key = "lang_changed_ru" if lang == "ru" else "lang_changed_en"
 
@@ -3110,7 +3741,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 """,
                 user_id
             )
-            USER_CACHE.pop(user_id, None)
+            await USER_CACHE.invalidate(user_id)
         await query.edit_message_text(await t(user_id, "terms_accepted"))
         return
 
@@ -3121,10 +3752,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id = query.from_user.id
 
             async with db_pool.acquire() as conn:
-                user = await conn.fetchrow(
-                    "SELECT * FROM users WHERE user_id=$1",
-                    user_id
-                )
+                user = await USER_QUERIES.fetchrow(conn, "user_premium", user_id)
 
             if not user or not is_premium(user):
                 await query.message.reply_text(
@@ -3255,8 +3883,19 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
+    # ================= MUSIC CACHE =================
+    elif data == "music_cached":
+        await send_cached_music(query, context, user_id)
+        return
+
+    # ================= SIMILAR RESULT =================
+    elif data == "similar_cached":
+        await send_similar_result(query, context, user_id)
+        return
+
     # ================= REPEAT (ИСПРАВЛЕН) =================
-    elif data == "repeat":
+    # music_new / similar_new — "сгенерировать новый" вместо готового результата
+    elif data in ("repeat", "music_new", "similar_new"):
         prompt = context.user_data.get("last_prompt")
         images = context.user_data.get("last_images", [])
         mode = context.user_data.get("mode", "image")
@@ -3271,7 +3910,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if user_id in active_generations:
             try:
-                await query.message.reply_text(await t(user_id, "already_in_queue"))
+                await query.message.reply_text(await already_in_queue_text(user_id))
             except:
                 pass
             return
@@ -3286,7 +3925,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # 🔥 ДОБАВЛЕНО: защита от перегрузки
-        if get_queue_position() > 300:
+        if queue_overloaded(mode):
             try:
                 await query.message.reply_text(await t(user_id, "server_overloaded"))
             except:
@@ -3296,26 +3935,18 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # 🔥 ДОБАВЛЕНО: блокировка
         lock_user_generation(user_id)
 
-        position = get_queue_position() + 1
+        estimate, eta = queue_estimate(mode)
 
         status = None
         try:
             status = await query.message.reply_text(
-                await t(user_id, "queue_masterpiece", position=position)
+                await t(user_id, "queue_masterpiece", position=estimate, eta=eta)
             )
         except:
             status = None
 
-        queue_map = {
-            "image": generation_queue_image,
-            "video": generation_queue_video,
-            "cartoon": generation_queue_video,
-            "remix": generation_queue_video,
-            "music": generation_queue_music
-        }
-
         try:
-            await queue_map.get(mode, generation_queue_image).put({
+            position = await enqueue_generation_job({
                 "update": update,
                 "context": context,
                 "prompt": prompt,
@@ -3325,25 +3956,17 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "user_id": user_id,
                 "mode": mode,
                 "status": status,
+                # "Повторить" = новый вариант, а не тот же результат из кэша
+                "repeat": True,
                 "created_at": time.time()
             })
 
         except Exception as e:
-            logging.error(f"❌ QUEUE PUT ERROR: {e}")
-
-            try:
-                unlock_user_generation(user_id)
-            except:
-                pass
-
-            if status:
-                try:
-                    await status.edit_text(await t(user_id, "queue_error"))
-                except:
-                    pass
-
+            await enqueue_failed(status, user_id, e)
             return
 
+        await show_queue_position(status, user_id, "queue_masterpiece", mode, estimate, position)
+
     # ================= CLEAR OLD STYLES =================
     if context.user_data.get("mode") not in ["cartoon"]:
         context.user_data["cartoon_style"] = None
@@ -3352,10 +3975,6 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
 
 # ================= PHOTO / TEXT HANDLERS =================
-def get_queue_position():
-    video_cartoon_queue = generation_queue_video.qsize()
-    return generation_queue_image.qsize() + video_cartoon_queue + generation_queue_music.qsize()
-
 async def use_paid_video(user_id):
     async with db_pool.acquire() as conn:
         user = await conn.fetchrow(
@@ -3368,23 +3987,34 @@ async def use_paid_video(user_id):
                 "UPDATE users SET paid_video = paid_video - 1 WHERE user_id=$1",
                 user_id
             )
-            USER_CACHE.pop(user_id, None)
+            await USER_CACHE.invalidate(user_id)
             return True
 
         return False
 
 
-LAST_ACTIVE_CACHE = {}
+LAST_ACTIVE_INTERVAL = 60  # обновляем раз в минуту
+LAST_ACTIVE_CACHE = UserCache(maxsize=USER_CACHE_MAX_ENTRIES, ttl=LAST_ACTIVE_INTERVAL)
 
 async def update_last_active(user_id):
     now = time.time()
 
-    last = LAST_ACTIVE_CACHE.get(user_id, 0)
-
-    if now - last < 60:  # обновляем раз в минуту
+    if LAST_ACTIVE_CACHE.get(user_id) is not None:
         return
 
-    LAST_ACTIVE_CACHE[user_id] = now
+    LAST_ACTIVE_CACHE.set(user_id, True)
+
+    # Между репликами: пишет только тот процесс, который первым занял ключ.
+    if redis_client:
+        try:
+            acquired = await redis_client.set(
+                f"last_active:{user_id}", 1,
+                nx=True, ex=LAST_ACTIVE_INTERVAL
+            )
+            if not acquired:
+                return
+        except Exception as e:
+            logging.warning(f"⚠️ LAST_ACTIVE REDIS ERROR: {e}")
 
     async with db_pool.acquire() as conn:
         await conn.execute(
@@ -3447,7 +4077,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     ONLINE_USERS[user_id] = time.time()
    
-    if not check_global_spam(user_id):
+    if not await SPAM_LIMITER.allow(user_id):
         return
         
     mode = context.user_data.get("mode")
@@ -3503,10 +4133,10 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["last_images"] = context.user_data["input_images"]
 
         if user_id in active_generations:
-            await update.message.reply_text(await t(user_id, "already_in_queue"))
+            await update.message.reply_text(await already_in_queue_text(user_id))
             return
 
-        if get_queue_position() > 300:
+        if queue_overloaded(mode):
             await update.message.reply_text(await t(user_id, "server_overloaded"))
             return
 
@@ -3515,9 +4145,9 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(await t(user_id, "remix_need_video"))
             return
 
-        position = get_queue_position() + 1
+        estimate, eta = queue_estimate(mode)
         status = await update.message.reply_text(
-            await t(user_id, "queue_wait", position=position)
+            await t(user_id, "queue_wait", position=estimate, eta=eta)
         )
 
         allowed, msg = check_user_generation_limit(user_id)
@@ -3527,29 +4157,87 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         lock_user_generation(user_id)
 
-        queue_map = {
-            "image": generation_queue_image,
-            "video": generation_queue_video,
-            "cartoon": generation_queue_video,
-            "remix": generation_queue_video,
-            "music": generation_queue_music
-        }
+        try:
+            position = await enqueue_generation_job({
+                "update": update,
+                "context": context,
+                "prompt": caption,
+                "size": context.user_data.get("size", "1024x1024"),
+                "model": context.user_data.get("model", "banana2"),
+                "images": context.user_data.get("input_images", []),
+                "video": context.user_data.get("input_video"),
+                "video_meta": context.user_data.get("input_video_meta"),
+                "video_ready": context.user_data.get("input_video_ready"),
+                "user_id": user_id,
+                "mode": mode,
+                "status": status,
+                "created_at": time.time()
+            })
+
+        except Exception as e:
+            await enqueue_failed(status, user_id, e)
+            return
+
+        await show_queue_position(status, user_id, "queue_wait", mode, estimate, position)
+
+
+# ================= CHATGPT STREAMING =================
+
+async def stream_chat_reply(message, messages):
+    """
+    Стримит ответ ChatGPT в одно сообщение: первое сообщение уходит на первом
+    токене, дальше правим его не чаще CHAT_EDIT_INTERVAL.
+    Хвост длиннее лимита Telegram досылается отдельными сообщениями.
+    Возвращает полный текст ответа.
+    """
+    answer = ""
+    reply = None
+    last_edit = 0.0
+    last_sent = ""
+
+    async with chat_semaphore:
+        stream = await client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=messages,
+            stream=True
+        )
+
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+
+            answer += delta
+            visible = answer[:TELEGRAM_TEXT_LIMIT]
+            now = time.monotonic()
+
+            if reply is None:
+                reply = await message.reply_text(visible)
+                last_sent = visible
+                last_edit = now
+
+            elif now - last_edit >= CHAT_EDIT_INTERVAL and visible != last_sent:
+                await safe_edit(reply, visible)
+                last_sent = visible
+                last_edit = now
+
+    if not answer:
+        return answer
+
+    # ===== ФИНАЛЬНАЯ ПРАВКА + ХВОСТ =====
+    head = answer[:TELEGRAM_TEXT_LIMIT]
+
+    if head != last_sent:
+        await safe_edit(reply, head)
+
+    for i in range(TELEGRAM_TEXT_LIMIT, len(answer), TELEGRAM_TEXT_LIMIT):
+        await message.reply_text(answer[i:i + TELEGRAM_TEXT_LIMIT])
+
+    return answer
 
-        await queue_map.get(mode, generation_queue_image).put({
-            "update": update,
-            "context": context,
-            "prompt": caption,
-            "size": context.user_data.get("size", "1024x1024"),
-            "model": context.user_data.get("model", "banana2"),
-            "images": context.user_data.get("input_images", []),
-            "video": context.user_data.get("input_video"),
-            "video_ready": context.user_data.get("input_video_ready"),
-            "user_id": user_id,
-            "mode": mode,
-            "status": status,
-            "created_at": time.time()
-        })
-        
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
@@ -3697,7 +4385,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
         # ===== ✅ ГЛОБАЛЬНЫЙ АНТИ-СПАМ =====
-    if not check_global_spam(user_id):
+    if not await SPAM_LIMITER.allow(user_id):
         return
 
     prompt = message.text if message.text else None
@@ -3728,7 +4416,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await message.reply_text(await t(user_id, "wait_current_generations"))
         return
 
-    if not check_rate_limit(user_id):
+    if not await MESSAGE_LIMITER.allow(user_id):
         await message.reply_text(await t(user_id, "not_so_fast"))
         return
 
@@ -3761,9 +4449,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
+            answer = await stream_chat_reply(
+                message,
+                [
                     {
                         "role": "system",
                         "content": context.user_data.get("system_prompt", "")
@@ -3775,16 +4463,17 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ]
             )
 
-            answer = response.choices[0].message.content
+            if not answer:
+                raise Exception("empty ChatGPT answer")
 
             async with db_pool.acquire() as conn:
                 await conn.execute(
                     "UPDATE users SET chat_count = chat_count + 1 WHERE user_id=$1",
                     user_id
                 )
-                USER_CACHE.pop(user_id, None)
+                await USER_CACHE.invalidate(user_id)
 
-            await message.reply_text(answer)
+            STATS.incr("chat")
 
         except Exception as e:
             logging.error(f"ChatGPT error: {e}")
@@ -3804,42 +4493,90 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await reset_week_if_needed(user)
 
-    queue_map = {
-        "image": generation_queue_image,
-        "video": generation_queue_video,
-        "cartoon": generation_queue_video,
-        "remix": generation_queue_video,
-        "music": generation_queue_music
-    }
-
     context.user_data["last_prompt"] = prompt
     context.user_data["last_images"] = images
-    
-    if get_queue_position() > 300:
+
+    # 🎵 такой трек уже есть — пользователь сам выбирает: сразу или новый
+    if mode == "music" and prompt and MUSIC_CACHE_OFFER:
+        try:
+            cached_music = await MUSIC_CACHE.get(music_cache_key(prompt))
+        except Exception as e:
+            logging.warning(f"⚠️ MUSIC CACHE LOOKUP ERROR: {e}")
+            cached_music = None
+
+        if cached_music:
+            MUSIC_CACHE.offered += 1
+
+            await message.reply_text(
+                await t(user_id, "music_cache_offer"),
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton(await t(user_id, "music_cache_instant"), callback_data="music_cached")],
+                    [InlineKeyboardButton(await t(user_id, "music_cache_new"), callback_data="music_new")]
+                ])
+            )
+            return
+
+    # ✨ похожий запрос уже генерировали — готовый результат по желанию
+    if mode in RESULT_CACHE_MODES and prompt:
+        try:
+            similar = await find_similar_result(
+                mode,
+                prompt,
+                context.user_data.get("model", "banana2"),
+                context.user_data.get("size", "1024x1024"),
+                context.user_data.get("input_images", images),
+                context.user_data.get("cartoon_style")
+            )
+        except Exception as e:
+            logging.warning(f"⚠️ SIMILAR PROMPT LOOKUP ERROR: {e}")
+            similar = None
+
+        if similar and SIMILAR_RESULT_OFFER:
+            PROMPT_INDEX.offered += 1
+            context.user_data["similar_result"] = {"key": similar, "mode": mode}
+
+            await message.reply_text(
+                await t(user_id, "similar_result_offer"),
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton(await t(user_id, "similar_result_instant"), callback_data="similar_cached")],
+                    [InlineKeyboardButton(await t(user_id, "similar_result_new"), callback_data="similar_new")]
+                ])
+            )
+            return
+
+    if queue_overloaded(mode):
         await message.reply_text(await t(user_id, "server_overloaded"))
         return
 
-    position = get_queue_position() + 1
+    estimate, eta = queue_estimate(mode)
     status = await message.reply_text(
-        await t(user_id, "queue_wait", position=position)
+        await t(user_id, "queue_wait", position=estimate, eta=eta)
     )
     lock_user_generation(user_id)
 
-    await queue_map.get(mode, generation_queue_image).put({
-        "update": update,
-        "context": context,
-        "prompt": prompt,
-        "size": context.user_data.get("size", "1024x1024"),
-        "model": context.user_data.get("model", "banana2"),
-        "images": context.user_data.get("input_images", images),
-        "video": context.user_data.get("input_video"),
-        "video_ready": context.user_data.get("input_video_ready"),
-        "user_id": user_id,
-        "mode": mode,
-        "status": status,
-        "created_at": time.time()
-    })
-    
+    try:
+        position = await enqueue_generation_job({
+            "update": update,
+            "context": context,
+            "prompt": prompt,
+            "size": context.user_data.get("size", "1024x1024"),
+            "model": context.user_data.get("model", "banana2"),
+            "images": context.user_data.get("input_images", images),
+            "video": context.user_data.get("input_video"),
+            "video_meta": context.user_data.get("input_video_meta"),
+            "video_ready": context.user_data.get("input_video_ready"),
+            "user_id": user_id,
+            "mode": mode,
+            "status": status,
+            "created_at": time.time()
+        })
+
+    except Exception as e:
+        await enqueue_failed(status, user_id, e)
+        return
+
+    await show_queue_position(status, user_id, "queue_wait", mode, estimate, position)
+
 
 # ================= COMMANDS =================
 
@@ -4107,6 +4844,11 @@ async def post_init(app):
     global generation_queue_image, generation_queue_video, generation_queue_music
 
     await init_db()
+    await init_redis()
+    await init_stats()
+    await HTTP.start()
+    await init_fal_webhooks()
+    await init_job_queue(listen_done=True)
 
     global generation_queue
     generation_queue = asyncio.Queue(maxsize=10000)
@@ -4116,18 +4858,18 @@ async def post_init(app):
     VIDEO_WORKERS = 6
     MUSIC_WORKERS = 4
 
-    for _ in range(IMAGE_WORKERS):
-        asyncio.create_task(image_worker())
+    # BOT_JOB_WORKERS=0: бот только ставит задачи в Redis, выполняет worker.py
+    if JOBS is None or os.getenv("BOT_JOB_WORKERS", "1") != "0":
+        for _ in range(IMAGE_WORKERS):
+            asyncio.create_task(generation_worker("image"))
 
-    for _ in range(VIDEO_WORKERS):
-        asyncio.create_task(video_worker())
+        for _ in range(VIDEO_WORKERS):
+            asyncio.create_task(generation_worker("video"))
 
-    for _ in range(MUSIC_WORKERS):
-        asyncio.create_task(music_worker())
+        for _ in range(MUSIC_WORKERS):
+            asyncio.create_task(generation_worker("music"))
 
     # ================= ФОНОВЫЕ ЗАДАЧИ =================
-    asyncio.create_task(user_cache_cleaner())
-    asyncio.create_task(cache_cleaner())
     asyncio.create_task(worker_watchdog())
     asyncio.create_task(generation_cleanup_worker())
 
@@ -4143,6 +4885,41 @@ async def post_init(app):
 app.post_init = post_init
 
 
+# ================= POST SHUTDOWN =================
+
+async def post_shutdown(app):
+    # Дописываем счетчики и аккуратно закрываем общие клиенты.
+    for name, close in (
+        ("stats", STATS.stop),
+        ("user cache", USER_CACHE.stop),
+        ("job queue", close_job_queue),
+        ("fal webhooks", close_fal_webhooks),
+        ("fal poller", FAL_POLLER.close),
+        ("progress", PROGRESS.close),
+        ("http", HTTP.close),
+        ("openai", client.close),
+        ("transcoder", TRANSCODER.close),
+    ):
+        try:
+            await close()
+        except Exception as e:
+            logging.error(f"❌ SHUTDOWN {name} ERROR: {e}")
+
+    payment_executor.shutdown(wait=False)
+
+    if redis_client:
+        try:
+            await redis_client.close()
+        except Exception:
+            pass
+
+    if db_pool:
+        await db_pool.close()
+
+
+app.post_shutdown = post_shutdown
+
+
 
 
 if __name__ == "__main__":
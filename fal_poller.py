@@ -0,0 +1,324 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import random
+import time
+
+import aiohttp
+
+# ================= FAL STATUS POLLER =================
+# Вместо отдельного цикла "GET status каждые 2 с" в каждой задаче —
+# один планировщик на процесс. Все ожидающие request_id лежат в куче
+# по времени следующего опроса, интервал подбирается по состоянию:
+# - IN_QUEUE: чем дальше в очереди (queue_position), тем реже;
+# - IN_PROGRESS: часто в начале, постепенно реже;
+# - Retry-After / 429 / 5xx: уважаем паузу, экспоненциальный backoff;
+# - ко всем интервалам добавляется jitter, чтобы опросы не шли пачкой.
+
+# Было: GET status каждые 2 с, 10 запросов на фото за 20 с, 45 — за 90 с.
+# Профиль image: первый опрос через 4 с (позже, если FAL вернул место в
+# очереди), дальше интервал растет на половину прошедшего времени до 10 с —
+# около 5 запросов на фото за 20 с и 11 за 90 с при опоздании результата
+# в среднем на 1–2 с. С вебхуком (профиль webhook) — 0–1 запрос.
+POLL_PROFILES = {
+    # фото: обычно 5–60 с
+    "image": {
+        "first": 4.0,
+        "min": 2.0,
+        "max_queue": 20.0,
+        "per_position": 1.5,
+        "max_progress": 10.0,
+        "growth": 0.5,
+    },
+    # видео (Sora / Kling): минуты, опрашиваем реже
+    "video": {
+        "first": 3.0,
+        "min": 2.0,
+        "max_queue": 30.0,
+        "per_position": 2.0,
+        "max_progress": 8.0,
+        "growth": 0.05,
+    },
+    # результат придет вебхуком (fal_webhook.py), опрос — только страховка
+    "webhook": {
+        "first": 30.0,
+        "min": 30.0,
+        "max_queue": 60.0,
+        "per_position": 0.0,
+        "max_progress": 60.0,
+        "growth": 0.0,
+    },
+}
+
+JITTER = 0.2
+MAX_BACKOFF = 60.0
+STATUS_TIMEOUT = aiohttp.ClientTimeout(total=60, sock_connect=30, sock_read=60)
+
+
+class FalPollError(Exception):
+    pass
+
+
+class _Entry:
+
+    __slots__ = (
+        "status_url", "headers", "profile", "label",
+        "deadline", "started", "progress_since",
+        "errors", "future", "polls",
+    )
+
+    def __init__(self, status_url, headers, profile, label, max_wait, future):
+        now = time.monotonic()
+
+        self.status_url = status_url
+        self.headers = headers
+        self.profile = profile
+        self.label = label
+        self.deadline = now + max_wait
+        self.started = now
+        self.progress_since = None
+        self.errors = 0
+        self.future = future
+        self.polls = 0
+
+
+class FalPoller:
+
+    def __init__(self, session_getter, concurrency=32, profiles=None):
+        self.session_getter = session_getter
+        self.profiles = profiles or POLL_PROFILES
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._sem = asyncio.Semaphore(concurrency)
+        self._task = None
+        # ссылки на запросы в полете: иначе задачу может собрать GC
+        self._inflight = set()
+
+        self.requests = 0
+        self.completed = 0
+        self.failed = 0
+        self.errors = 0
+
+    # ---------- public ----------
+
+    async def wait(self, status_url, headers=None, max_wait=600, profile="image", label="",
+                   queue_position=None):
+        """
+        Ждёт финального статуса (COMPLETED) и возвращает JSON статуса.
+        FAILED / таймаут / неустранимая HTTP-ошибка — исключение.
+        queue_position — место в очереди из ответа на отправку: первый
+        опрос откладывается так же, как следующие в IN_QUEUE.
+        """
+        future = asyncio.get_running_loop().create_future()
+        entry = _Entry(
+            status_url,
+            headers or {},
+            self.profiles.get(profile) or self.profiles["image"],
+            label,
+            max_wait,
+            future
+        )
+
+        self._schedule(entry, entry.profile["first"] + self._queue_delay(entry.profile, queue_position))
+        self._ensure_running()
+
+        try:
+            return await future
+        finally:
+            # Отмена вызывающего: запись просто выпадет из кучи при следующем pop.
+            if not future.done():
+                future.cancel()
+
+    def stats(self):
+        return {
+            "pending": sum(1 for _, _, e in self._heap if not e.future.done()),
+            "inflight": len(self._inflight),
+            "requests": self.requests,
+            "completed": self.completed,
+            "failed": self.failed,
+            "errors": self.errors,
+        }
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+        for task in list(self._inflight):
+            task.cancel()
+
+        for _, _, entry in self._heap:
+            if not entry.future.done():
+                entry.future.cancel()
+
+        self._heap = []
+
+    # ---------- scheduling ----------
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _schedule(self, entry, delay):
+        delay *= 1 + random.uniform(-JITTER, JITTER)
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), entry))
+        self._wakeup.set()
+
+    def _next_interval(self, entry, state, queue_position):
+        p = entry.profile
+        now = time.monotonic()
+
+        if state == "IN_QUEUE":
+            entry.progress_since = None
+            return min(p["max_queue"], p["min"] + self._queue_delay(p, queue_position))
+
+        # IN_PROGRESS (и любые промежуточные состояния)
+        if entry.progress_since is None:
+            entry.progress_since = now
+
+        in_progress = now - entry.progress_since
+        return min(p["max_progress"], p["min"] + in_progress * p["growth"])
+
+    @staticmethod
+    def _queue_delay(profile, queue_position):
+        position = queue_position if isinstance(queue_position, int) else 0
+        return min(profile["max_queue"], position * profile["per_position"])
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            due, _, entry = self._heap[0]
+            delay = due - time.monotonic()
+
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+
+            if entry.future.done():
+                continue
+
+            if time.monotonic() > entry.deadline:
+                self.failed += 1
+                entry.future.set_exception(FalPollError(
+                    f"Fal timeout after {int(time.monotonic() - entry.started)}s {entry.label}"
+                ))
+                continue
+
+            task = asyncio.create_task(self._poll(entry))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    # ---------- one status request ----------
+
+    async def _poll(self, entry):
+        retry_after = None
+
+        try:
+            async with self._sem:
+                self.requests += 1
+                entry.polls += 1
+
+                session = self.session_getter()
+
+                async with session.get(
+                    entry.status_url,
+                    headers=entry.headers,
+                    timeout=STATUS_TIMEOUT
+                ) as resp:
+                    text = await resp.text()
+                    retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+                    http_status = resp.status
+
+            if http_status == 429 or http_status >= 500:
+                raise _Retryable(f"HTTP {http_status}: {text[:300]}")
+
+            if http_status not in (200, 202):
+                raise FalPollError(f"Fal status failed: HTTP {http_status}: {text[:1000]}")
+
+            try:
+                data = json.loads(text)
+            except Exception:
+                raise _Retryable(f"non-JSON status: {text[:300]}")
+
+        except asyncio.CancelledError:
+            # close(): ждущий не должен висеть вечно
+            if not entry.future.done():
+                entry.future.cancel()
+            raise
+
+        except FalPollError as e:
+            self.failed += 1
+            if not entry.future.done():
+                entry.future.set_exception(e)
+            return
+
+        except Exception as e:
+            # Сеть / 429 / 5xx — повторяем с backoff, пока не вышел max_wait.
+            self.errors += 1
+            entry.errors += 1
+            delay = min(MAX_BACKOFF, entry.profile["min"] * (2 ** entry.errors))
+            delay = max(delay, retry_after or 0)
+            logging.warning(f"⚠️ FAL POLL RETRY in {delay:.1f}s {entry.label}: {e}")
+            self._schedule(entry, delay)
+            return
+
+        entry.errors = 0
+
+        if entry.future.done():
+            return
+
+        state = data.get("status")
+
+        if state == "COMPLETED":
+            self.completed += 1
+            entry.future.set_result(data)
+            return
+
+        if state == "FAILED":
+            self.failed += 1
+            entry.future.set_exception(FalPollError(f"Fal generation failed: {data}"))
+            return
+
+        delay = self._next_interval(entry, state, data.get("queue_position"))
+        if retry_after:
+            delay = max(delay, retry_after)
+
+        if entry.polls % 10 == 0:
+            logging.info(
+                f"📡 FAL POLL {entry.label} state={state} "
+                f"queue={data.get('queue_position')} polls={entry.polls} next={delay:.1f}s"
+            )
+
+        self._schedule(entry, delay)
+
+
+class _Retryable(Exception):
+    pass
+
+
+def _parse_retry_after(value):
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
@@ -0,0 +1,241 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import socket
+from urllib.parse import urlsplit
+
+from aiohttp import ClientSession, ClientTimeout, web
+
+# ================= FAL STAND-IN =================
+# Локальная замена queue.fal.run для тестов и ручной проверки:
+#     python fal_standin.py --port 8765
+#     FAL_QUEUE_URL=http://127.0.0.1:8765 python bot.py
+# Повторяет контракт queue API, которым пользуется бот:
+# - POST /<owner>/<app>[/...] -> {request_id, status_url, response_url};
+# - GET  /<owner>/<app>/requests/<id>/status -> IN_QUEUE (с queue_position),
+#   IN_PROGRESS, затем COMPLETED / FAILED — по числу опросов;
+# - GET  /<owner>/<app>/requests/<id> -> результат (images / video);
+# - ?fal_webhook=<url> при отправке -> POST {request_id, status, payload}
+#   на этот URL, как делает FAL;
+# - status_errors первых опросов отвечают 503 (проверка backoff поллера).
+
+WEBHOOK_TIMEOUT = ClientTimeout(total=10)
+
+
+class _Request:
+
+    __slots__ = ("app", "path", "payload", "webhook", "polls")
+
+    def __init__(self, app, path, payload, webhook):
+        self.app = app
+        self.path = path
+        self.payload = payload
+        self.webhook = webhook
+        self.polls = 0
+
+
+class FalStandIn:
+
+    def __init__(self, queue_polls=1, progress_polls=1, fail=False,
+                 status_errors=0, webhook_delay=0.05, result=None):
+        self.queue_polls = queue_polls
+        self.progress_polls = progress_polls
+        self.fail = fail
+        self.status_errors = status_errors
+        self.webhook_delay = webhook_delay
+        self.result = result
+
+        self.base_url = None
+        self.requests = {}
+        self.headers = []
+
+        self._ids = itertools.count(1)
+        self._runner = None
+        self._tasks = set()
+
+        self.submitted = 0
+        self.status_polls = 0
+        self.result_fetches = 0
+        self.webhooks_sent = 0
+
+    # ---------- lifecycle ----------
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_get("/{owner}/{app}/requests/{request_id}/status", self._status)
+        app.router.add_get("/{owner}/{app}/requests/{request_id}", self._result)
+        app.router.add_post("/{path:.+}", self._submit)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+
+        sock = socket.create_server((host, port))
+        await web.SockSite(self._runner, sock).start()
+
+        self.base_url = f"http://{host}:{sock.getsockname()[1]}"
+
+        return self.base_url
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # ---------- handlers ----------
+
+    async def _submit(self, request):
+        path = request.match_info["path"]
+        parts = path.split("/")
+
+        if len(parts) < 2:
+            return web.json_response({"detail": "unknown app"}, status=404)
+
+        try:
+            payload = await request.json()
+        except Exception:
+            return web.json_response({"detail": "invalid JSON"}, status=422)
+
+        self.submitted += 1
+        self.headers.append(dict(request.headers))
+
+        request_id = f"standin-{next(self._ids)}"
+        app = "/".join(parts[:2])
+        webhook = request.query.get("fal_webhook")
+
+        self.requests[request_id] = _Request(app, path, payload, webhook)
+
+        if webhook:
+            self._spawn(self._send_webhook(request_id))
+
+        base = f"{self.base_url}/{app}/requests/{request_id}"
+
+        return web.json_response({
+            "request_id": request_id,
+            "gateway_request_id": request_id,
+            "status_url": f"{base}/status",
+            "response_url": base,
+        })
+
+    async def _status(self, request):
+        entry = self._lookup(request)
+        if entry is None:
+            return web.json_response({"detail": "not found"}, status=404)
+
+        self.status_polls += 1
+
+        if self.status_errors > 0:
+            self.status_errors -= 1
+            return web.json_response(
+                {"detail": "temporarily unavailable"},
+                status=503,
+                headers={"Retry-After": "0"}
+            )
+
+        entry.polls += 1
+        request_id = request.match_info["request_id"]
+
+        if entry.polls <= self.queue_polls:
+            return web.json_response({
+                "status": "IN_QUEUE",
+                "request_id": request_id,
+                "queue_position": self.queue_polls - entry.polls,
+            }, status=202)
+
+        if entry.polls <= self.queue_polls + self.progress_polls:
+            return web.json_response({"status": "IN_PROGRESS", "request_id": request_id}, status=202)
+
+        if self.fail:
+            return web.json_response({"status": "FAILED", "request_id": request_id, "error": "stand-in failure"})
+
+        return web.json_response({"status": "COMPLETED", "request_id": request_id})
+
+    async def _result(self, request):
+        entry = self._lookup(request)
+        if entry is None:
+            return web.json_response({"detail": "not found"}, status=404)
+
+        self.result_fetches += 1
+        return web.json_response(self._result_for(entry))
+
+    # ---------- internal ----------
+
+    def _lookup(self, request):
+        entry = self.requests.get(request.match_info["request_id"])
+
+        if entry is None:
+            return None
+
+        if entry.app != f"{request.match_info['owner']}/{request.match_info['app']}":
+            return None
+
+        return entry
+
+    def _result_for(self, entry):
+        if self.result is not None:
+            return self.result
+
+        if "video" in entry.path or "sora" in entry.path:
+            return {"video": {"url": f"{self.base_url}/files/video.mp4"}}
+
+        return {"images": [{"url": f"{self.base_url}/files/image.png"}]}
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send_webhook(self, request_id):
+        await asyncio.sleep(self.webhook_delay)
+
+        entry = self.requests[request_id]
+
+        if self.fail:
+            body = {"request_id": request_id, "status": "ERROR", "error": "stand-in failure", "payload": None}
+        else:
+            body = {"request_id": request_id, "status": "OK", "payload": self._result_for(entry)}
+
+        try:
+            async with ClientSession(timeout=WEBHOOK_TIMEOUT) as session:
+                async with session.post(entry.webhook, data=json.dumps(body),
+                                        headers={"Content-Type": "application/json"}) as resp:
+                    await resp.read()
+            self.webhooks_sent += 1
+        except Exception as e:
+            logging.warning(f"⚠️ STAND-IN WEBHOOK ERROR {urlsplit(entry.webhook).netloc}: {e}")
+
+
+async def _main(args):
+    standin = FalStandIn(
+        queue_polls=args.queue_polls,
+        progress_polls=args.progress_polls,
+        fail=args.fail
+    )
+    url = await standin.start(args.host, args.port)
+
+    logging.info(f"FAL stand-in on {url} (FAL_QUEUE_URL={url})")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await standin.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the FAL queue API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--queue-polls", type=int, default=2)
+    parser.add_argument("--progress-polls", type=int, default=3)
+    parser.add_argument("--fail", action="store_true")
+
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
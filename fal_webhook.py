@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import socket
+import time
+from urllib.parse import urlencode, urlsplit, urlunsplit, parse_qsl
+
+# ================= FAL WEBHOOKS =================
+# Опциональный режим: задачи отправляются в FAL с ?fal_webhook=<наш URL>,
+# FAL сам присылает POST по завершении. Небольшой FastAPI endpoint
+# (uvicorn в том же event loop) резолвит future ожидающей задачи.
+# Опрос статуса остается как страховка, но с длинным интервалом.
+
+# Вебхук может прийти раньше, чем задача успела зарегистрироваться
+# (ответ на submit и callback гоняются) — держим такие ответы немного.
+EARLY_TTL = 300
+
+
+class FalWebhookRegistry:
+
+    def __init__(self, public_url=None, secret=""):
+        self.public_url = (public_url or "").rstrip("/")
+        self.secret = secret or ""
+
+        self._futures = {}
+        self._early = {}   # request_id -> (payload, received_at)
+
+        # Колбэки приходят в процесс, где поднят endpoint; без него
+        # (worker.py, скрипты) задачи отправляются как раньше, без вебхука.
+        self.serving = False
+
+        self.received = 0
+        self.matched = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self):
+        return bool(self.public_url) and self.serving
+
+    @property
+    def callback_url(self):
+        return f"{self.public_url}/fal/webhook/{self.secret}" if self.secret else f"{self.public_url}/fal/webhook"
+
+    def submit_url(self, url):
+        """Добавляет fal_webhook к URL отправки задачи (если режим включен)."""
+        if not self.enabled:
+            return url
+
+        parts = urlsplit(url)
+        query = parse_qsl(parts.query)
+        query.append(("fal_webhook", self.callback_url))
+
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+    def register(self, request_id):
+        future = asyncio.get_running_loop().create_future()
+
+        early = self._early.pop(request_id, None)
+        if early:
+            self.matched += 1
+            self._apply(future, early[0])
+        else:
+            self._futures[request_id] = future
+
+        return future
+
+    def discard(self, request_id):
+        future = self._futures.pop(request_id, None)
+
+        if future and not future.done():
+            future.cancel()
+
+    def resolve(self, payload):
+        self.received += 1
+
+        request_id = payload.get("request_id") or payload.get("gateway_request_id")
+        if not request_id:
+            return False
+
+        future = self._futures.pop(request_id, None)
+
+        if future is None:
+            self._remember_early(request_id, payload)
+            return False
+
+        if not future.done():
+            self.matched += 1
+            self._apply(future, payload)
+
+        return True
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "early": len(self._early),
+            "waiting": len(self._futures),
+            "received": self.received,
+            "matched": self.matched,
+            "rejected": self.rejected,
+        }
+
+    def _apply(self, future, payload):
+        if future.done():
+            return
+
+        status = str(payload.get("status", "")).upper()
+
+        if status in ("OK", "COMPLETED"):
+            future.set_result({
+                "status": "COMPLETED",
+                "request_id": payload.get("request_id"),
+                "webhook_payload": payload.get("payload"),
+            })
+        else:
+            future.set_exception(Exception(
+                f"Fal generation failed (webhook): {payload.get('error') or payload}"
+            ))
+
+    def _remember_early(self, request_id, payload):
+        now = time.monotonic()
+
+        for key, (_, received_at) in list(self._early.items()):
+            if now - received_at > EARLY_TTL:
+                self._early.pop(key, None)
+
+        self._early[request_id] = (payload, now)
+
+
+def create_webhook_app(registry):
+    from fastapi import FastAPI, HTTPException, Request
+
+    app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+
+    async def receive(request: Request, token: str = ""):
+        if registry.secret and token != registry.secret:
+            registry.rejected += 1
+            raise HTTPException(status_code=404)
+
+        try:
+            payload = await request.json()
+        except Exception:
+            raise HTTPException(status_code=400)
+
+        registry.resolve(payload)
+        return {"ok": True}
+
+    @app.post("/fal/webhook/{token}")
+    async def fal_webhook_with_token(token: str, request: Request):
+        return await receive(request, token)
+
+    @app.post("/fal/webhook")
+    async def fal_webhook(request: Request):
+        return await receive(request)
+
+    @app.get("/health")
+    async def health():
+        return registry.stats()
+
+    return app
+
+
+async def start_webhook_server(registry, host="0.0.0.0", port=8080, startup_timeout=10):
+    """
+    Запускает uvicorn в текущем event loop. Возвращает (server, task).
+    serving включается только после успешного bind и старта сервера:
+    занятый порт — OSError здесь, задачи продолжают работать опросом.
+    """
+    import uvicorn
+
+    # bind сами: uvicorn при ошибке bind делает sys.exit(1) внутри задачи
+    sock = socket.create_server((host, port))
+
+    config = uvicorn.Config(
+        create_webhook_app(registry),
+        log_level="warning",
+        lifespan="off"
+    )
+    server = uvicorn.Server(config)
+    # сигналы обрабатывает Application из python-telegram-bot
+    server.install_signal_handlers = lambda: None
+
+    task = asyncio.create_task(server.serve(sockets=[sock]))
+
+    def stopped(_):
+        registry.serving = False
+        sock.close()
+
+    task.add_done_callback(stopped)
+
+    deadline = time.monotonic() + startup_timeout
+
+    while not server.started:
+        if task.done():
+            task.result()
+            raise RuntimeError("FAL webhook server stopped during startup")
+
+        if time.monotonic() > deadline:
+            server.should_exit = True
+            raise RuntimeError("FAL webhook server startup timeout")
+
+        await asyncio.sleep(0.05)
+
+    registry.serving = True
+
+    logging.info(f"✅ FAL webhook endpoint on {host}:{port} -> {registry.callback_url}")
+
+    return server, task
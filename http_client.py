@@ -0,0 +1,70 @@
+import logging
+
+import aiohttp
+
+# ================= SHARED HTTP CLIENT =================
+# Одна aiohttp.ClientSession на процесс для FAL / Gemini / скачивания файлов:
+# keep-alive и переиспользование TLS-соединений, лимиты на хост, DNS кэш.
+# Таймауты задаются на каждый вызов (timeout=...), у сессии — только дефолт.
+
+
+class HttpClient:
+
+    def __init__(
+        self,
+        limit=200,
+        limit_per_host=50,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+        default_timeout=None
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.default_timeout = default_timeout or aiohttp.ClientTimeout(
+            total=300,
+            sock_connect=60,
+            sock_read=120
+        )
+
+        self._session = None
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+            logging.info(
+                f"✅ HTTP pool: limit={self.limit} per_host={self.limit_per_host}"
+            )
+
+        return self._session
+
+    @property
+    def session(self):
+        """
+        Общая сессия. Если start() еще не вызывали (worker.py, скрипты),
+        создается лениво — нужен запущенный event loop.
+        """
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+        self._session = None
+
+    def _create_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.ttl_dns_cache,
+            keepalive_timeout=self.keepalive_timeout
+        )
+
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=self.default_timeout
+        )
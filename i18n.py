@@ -0,0 +1,178 @@
+import string
+from collections import OrderedDict
+
+# ================= TRANSLATION ENGINE =================
+# TEXTS компилируется один раз при импорте: на каждый язык — плоская таблица
+# key -> шаблон, шаблоны с {полями} заранее разобраны через string.Formatter.
+# Язык пользователя хранится в отдельном маленьком кэше, поэтому перевод
+# строки не требует ни одного запроса в БД.
+
+DEFAULT_LANG = "ru"
+
+_formatter = string.Formatter()
+
+
+class CompiledTemplate:
+    """
+    Заранее разобранный str.format шаблон.
+    Для строк без полей render() просто возвращает готовый текст.
+    """
+
+    __slots__ = ("raw", "text", "parts", "dynamic")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.text = raw
+        self.parts = None
+        # dynamic=True — шаблон не удалось разобрать, форматируем через str.format.
+        self.dynamic = False
+
+        try:
+            parsed = list(_formatter.parse(raw))
+        except ValueError:
+            # Битый шаблон ("{" без пары) — str.format тоже упадёт, отдаём как есть.
+            return
+
+        parts = []
+        has_fields = False
+
+        for literal, field, spec, conversion in parsed:
+            if literal:
+                parts.append((literal, None, None, None))
+
+            if field is None:
+                continue
+
+            # Сложные поля ({a.b}, {a[0]}, вложенные спецификаторы) отдаём str.format.
+            if not field.isidentifier() or (spec and "{" in spec):
+                self.dynamic = True
+                return
+
+            has_fields = True
+            parts.append(("", field, spec or "", conversion))
+
+        if has_fields:
+            self.parts = tuple(parts)
+        else:
+            # "{{" / "}}" уже раскрыты парсером.
+            self.text = "".join(p[0] for p in parts)
+
+    def render(self, kwargs):
+        if self.dynamic:
+            try:
+                return self.raw.format(**kwargs)
+            except Exception:
+                return self.raw
+
+        if self.parts is None:
+            return self.text
+
+        out = []
+
+        try:
+            for literal, field, spec, conversion in self.parts:
+                if field is None:
+                    out.append(literal)
+                    continue
+
+                value = kwargs[field]
+
+                if conversion == "r":
+                    value = repr(value)
+                elif conversion == "s":
+                    value = str(value)
+                elif conversion == "a":
+                    value = ascii(value)
+
+                out.append(format(value, spec))
+
+        except Exception:
+            # Как и раньше: если не хватает аргументов — возвращаем шаблон без подстановки.
+            return self.raw
+
+        return "".join(out)
+
+
+class Translator:
+    """
+    Скомпилированные TEXTS: tables[lang][key] -> CompiledTemplate.
+    Фолбэк как у старого t(): язык -> ru -> сам ключ.
+    """
+
+    def __init__(self, texts, default_lang=DEFAULT_LANG):
+        self.default_lang = default_lang
+
+        langs = {default_lang}
+        for item in texts.values():
+            if isinstance(item, dict):
+                langs.update(item.keys())
+
+        self.tables = {}
+
+        for lang in langs:
+            table = {}
+
+            for key, item in texts.items():
+                if isinstance(item, dict):
+                    text = item.get(lang) or item.get(default_lang) or key
+                else:
+                    text = key
+
+                table[key] = CompiledTemplate(text)
+
+            self.tables[lang] = table
+
+    def table(self, lang):
+        return self.tables.get(lang) or self.tables[self.default_lang]
+
+    def get(self, lang, key, **kwargs):
+        template = self.table(lang).get(key)
+
+        if template is None:
+            return key
+
+        return template.render(kwargs)
+
+    def many(self, lang, keys, **kwargs):
+        """Переводит сразу список ключей одним выбором таблицы."""
+        table = self.table(lang)
+        result = []
+
+        for key in keys:
+            template = table.get(key)
+            result.append(key if template is None else template.render(kwargs))
+
+        return result
+
+
+class LanguageCache:
+    """
+    Маленький LRU кэш user_id -> язык.
+    Язык меняется только через кнопку lang_*, поэтому TTL не нужен:
+    обработчик кнопки сам перезаписывает значение.
+    """
+
+    def __init__(self, maxsize=200_000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, user_id):
+        lang = self._data.get(user_id)
+
+        if lang is not None:
+            self._data.move_to_end(user_id)
+
+        return lang
+
+    def set(self, user_id, lang):
+        self._data[user_id] = lang or DEFAULT_LANG
+        self._data.move_to_end(user_id)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, user_id):
+        self._data.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._data)
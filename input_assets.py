@@ -0,0 +1,214 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+
+import aiohttp
+
+from lru_cache import LRUCache
+
+# ================= INPUT ASSETS =================
+# Референсы (фото, видео для ремикса) больше не вшиваются в JSON как
+# data:...;base64 — это +33% к запросу и полная копия в памяти на каждую
+# попытку smart_retry и каждое "Повторить".
+# Байты загружаются в хранилище один раз, URL кэшируется по sha256
+# содержимого с TTL; одновременные загрузки одного файла объединяются.
+# Inline "URL" — сам файл в base64 (вплоть до видео ремикса): такие не
+# кэшируем, иначе тысячи копий файлов часами лежали бы в памяти.
+
+# Большие файлы хэшируем вне event loop.
+HASH_IN_THREAD = 1024 * 1024
+
+UPLOAD_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_connect=60, sock_read=120)
+
+EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "video/mp4": "mp4",
+}
+
+
+class AssetUploadError(Exception):
+    pass
+
+
+# ---------- backends ----------
+
+class FalStorage:
+    """FAL CDN: initiate -> PUT байтов на upload_url -> file_url."""
+
+    def __init__(self, session_getter, key, base_url="https://rest.alpha.fal.ai"):
+        self.session_getter = session_getter
+        self.key = key
+        self.base_url = base_url.rstrip("/")
+
+    async def upload(self, data, content_type, name):
+        session = self.session_getter()
+
+        async with session.post(
+            f"{self.base_url}/storage/upload/initiate?storage_type=fal-cdn-v3",
+            json={"content_type": content_type, "file_name": name},
+            headers={"Authorization": f"Key {self.key}"},
+            timeout=UPLOAD_TIMEOUT
+        ) as resp:
+            text = await resp.text()
+
+            if resp.status != 200:
+                raise AssetUploadError(f"FAL storage initiate: HTTP {resp.status}: {text[:500]}")
+
+            info = await resp.json(content_type=None)
+
+        async with session.put(
+            info["upload_url"],
+            data=bytes(data),
+            headers={"Content-Type": content_type},
+            timeout=UPLOAD_TIMEOUT
+        ) as resp:
+            if resp.status not in (200, 201, 204):
+                text = await resp.text()
+                raise AssetUploadError(f"FAL storage upload: HTTP {resp.status}: {text[:500]}")
+
+        return info["file_url"]
+
+
+class LocalStorage:
+    """
+    Локальный стенд: файл кладется в directory, URL = base_url/имя.
+    Для разработки вместе с локальным FAL (FAL_QUEUE_URL).
+    """
+
+    def __init__(self, directory, base_url):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+
+        os.makedirs(directory, exist_ok=True)
+
+    async def upload(self, data, content_type, name):
+        path = os.path.join(self.directory, name)
+        await asyncio.to_thread(_write_file, path, data)
+        return f"{self.base_url}/{name}"
+
+
+class InlineStorage:
+    """Старое поведение: data URI прямо в payload (без загрузки)."""
+
+    # data URI — копия файла, а не ссылка: в кэше URL не держим
+    cache_urls = False
+
+    async def upload(self, data, content_type, name):
+        encoded = base64.b64encode(bytes(data)).decode("utf-8")
+        return f"data:{content_type};base64,{encoded}"
+
+
+# ---------- cache ----------
+
+class InputAssets:
+
+    def __init__(self, storage, ttl=6 * 60 * 60, maxsize=10_000):
+        self.storage = storage
+        self.urls = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.cache_urls = getattr(storage, "cache_urls", True)
+
+        self._pending = {}
+
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.reused = 0
+
+    async def url_for(self, data, content_type="image/jpeg"):
+        digest = await _digest(data)
+        key = (digest, content_type)
+
+        url = self.urls.get(key)
+        if url:
+            self.reused += 1
+            return url
+
+        # Тот же файл уже грузится другой задачей — ждем ее результат.
+        pending = self._pending.get(key)
+        if pending:
+            self.reused += 1
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+
+        try:
+            name = f"{digest}.{EXTENSIONS.get(content_type, 'bin')}"
+            url = await self.storage.upload(data, content_type, name)
+
+            self.uploads += 1
+            self.uploaded_bytes += len(data)
+            if self.cache_urls:
+                self.urls.set(key, url)
+
+            future.set_result(url)
+            return url
+
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # исключение доставлено вызывающему; у future его не ждут
+                future.exception()
+            raise
+
+        finally:
+            self._pending.pop(key, None)
+
+    async def urls_for(self, items, content_type="image/jpeg"):
+        return list(await asyncio.gather(
+            *(self.url_for(item, content_type) for item in items)
+        ))
+
+    def stats(self):
+        return {
+            "cached": len(self.urls),
+            "uploads": self.uploads,
+            "uploaded_mb": round(self.uploaded_bytes / 1024 / 1024, 1),
+            "reused": self.reused,
+        }
+
+
+def create_storage(
+    kind,
+    session_getter,
+    fal_key=None,
+    fal_storage_url="https://rest.alpha.fal.ai",
+    local_dir=None,
+    local_url=None
+):
+    kind = (kind or "fal").lower()
+
+    if kind == "local" and local_dir and local_url:
+        return LocalStorage(local_dir, local_url)
+
+    if kind == "fal" and fal_key:
+        return FalStorage(
+            session_getter,
+            fal_key,
+            base_url=fal_storage_url
+        )
+
+    if kind not in ("inline", "fal"):
+        logging.warning(f"⚠️ INPUT STORAGE {kind!r} не настроен, используем inline data URI")
+
+    return InlineStorage()
+
+
+async def _digest(data):
+    if len(data) >= HASH_IN_THREAD:
+        return await asyncio.to_thread(_sha256, data)
+
+    return _sha256(data)
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
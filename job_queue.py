@@ -0,0 +1,543 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+
+from queue_eta import ThroughputMeter
+from scheduler import PRIORITY_FREE, WaitStats, job_score
+
+# ================= REDIS JOB QUEUE =================
+# Задачи генерации живут в Redis, а не в asyncio.Queue процесса:
+# - на тип очереди (image / video / music) — набор ключей jobs:<queue>:*:
+#   ready (ZSET, score из scheduler.job_score — приоритет, справедливость
+#   между пользователями и старение), processing (ZSET, score = дедлайн
+#   видимости), data / scores / deliveries (HASH по job_id), backlog
+#   (HASH по user_id), served (счетчик взятых в работу),
+#   signal (LIST — разбудить ждущих воркеров);
+# - pop атомарно переносит задачу из ready в processing (Lua); heartbeat
+#   сдвигает дедлайн с момента get() — и пока задача ждет в буфере воркера
+#   или на семафоре, и пока выполняется; ack удаляет задачу совсем;
+# - если процесс умер, после VISIBILITY_TIMEOUT задача возвращается в ready
+#   с прежним score (не теряет места); после MAX_DELIVERIES — в jobs:dead;
+# - задача хранится как JSON, байты (фото, видео для ремикса) — отдельными
+#   ключами job:blob:<sha256> с TTL, одинаковые файлы не дублируются;
+# - после ack публикуется событие в jobs:done, чтобы процесс бота снял
+#   блокировку пользователя, даже если задачу выполнил другой воркер;
+#   по этим же событиям считается пропускная способность очередей (ETA).
+# Позиция задачи = ZRANK в ready, то есть реальный порядок обслуживания.
+
+QUEUES = ("image", "video", "music")
+
+QUEUE_FOR_MODE = {
+    "image": "image",
+    "video": "video",
+    "cartoon": "video",
+    "remix": "video",
+    "music": "music",
+}
+
+# Поля задачи, которые переносятся как есть (JSON).
+JOB_FIELDS = (
+    "job_id",
+    "user_id",
+    "mode",
+    "priority",
+    "prompt",
+    "size",
+    "model",
+    "chat_id",
+    "message_id",
+    "status_message_id",
+    "video_meta",
+    "video_ready",
+    "user_data",
+    "repeat",
+    "created_at",
+)
+
+DONE_CHANNEL = "jobs:done"
+DEAD_STREAM = "jobs:dead"
+
+# KEYS: ready, processing, data, deliveries; ARGV: deadline
+POP_SCRIPT = """
+local ids = redis.call('ZRANGE', KEYS[1], 0, 0)
+if #ids == 0 then
+    return nil
+end
+local id = ids[1]
+redis.call('ZREM', KEYS[1], id)
+redis.call('ZADD', KEYS[2], ARGV[1], id)
+local deliveries = redis.call('HINCRBY', KEYS[4], id, 1)
+return {id, redis.call('HGET', KEYS[3], id), deliveries}
+"""
+
+# KEYS: ready, processing, scores; ARGV: now
+RECLAIM_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for _, id in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], id)
+    local score = redis.call('HGET', KEYS[3], id)
+    if score then
+        redis.call('ZADD', KEYS[1], score, id)
+    end
+end
+return #expired
+"""
+
+
+def queue_for_mode(mode):
+    return QUEUE_FOR_MODE.get(mode, "image")
+
+
+class RedisJobQueue:
+
+    def __init__(
+        self,
+        client,
+        prefix="jobs",
+        consumer=None,
+        visibility_timeout=300,
+        max_deliveries=3,
+        blob_ttl=3600
+    ):
+        # клиент без decode_responses: в Redis лежат и байты файлов
+        self.client = client
+        self.prefix = prefix
+        self.consumer = consumer or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.visibility_timeout = visibility_timeout
+        self.max_deliveries = max_deliveries
+        self.blob_ttl = blob_ttl
+
+        self.depth = {name: 0 for name in QUEUES}
+        self.served = {name: 0 for name in QUEUES}
+        self.wait_stats = WaitStats()
+        self.throughput = ThroughputMeter()
+
+        self._pop = client.register_script(POP_SCRIPT)
+        self._reclaim_script = client.register_script(RECLAIM_SCRIPT)
+        self._last_reclaim = {name: 0.0 for name in QUEUES}
+        self._done_callbacks = []
+        self._tasks = []
+        self._beats = {}   # job_id -> задача heartbeat
+        self._listening = False
+
+        self.enqueued = 0
+        self.acked = 0
+        self.reclaimed = 0
+        self.dead = 0
+
+    # ---------- lifecycle ----------
+
+    async def start(self, listen_done=False):
+        await self.refresh_depth()
+
+        self._tasks.append(asyncio.create_task(self._monitor()))
+
+        if listen_done:
+            self._listening = True
+            self._tasks.append(asyncio.create_task(self._listen_done()))
+
+        logging.info(f"✅ Redis job queue: consumer={self.consumer}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+        # брошенные задачи заберут другие воркеры после visibility timeout
+        for job_id in list(self._beats):
+            self._stop_heartbeat(job_id)
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def on_done(self, callback):
+        """callback(job_id, user_id) — задача завершена любым воркером."""
+        self._done_callbacks.append(callback)
+
+    def key(self, name, part):
+        return f"{self.prefix}:{name}:{part}"
+
+    # ---------- producer ----------
+
+    async def put(self, job):
+        """
+        Сериализует задачу (см. JOB_FIELDS) и ставит в очередь по mode.
+        Возвращает позицию задачи (1 — следующая).
+        """
+        payload = {key: job.get(key) for key in JOB_FIELDS}
+        payload["job_id"] = payload["job_id"] or uuid.uuid4().hex
+        payload["created_at"] = payload["created_at"] or time.time()
+        payload["priority"] = payload["priority"] or PRIORITY_FREE
+        payload["blobs"] = {
+            "images": [await self._put_blob(img) for img in job.get("images") or []],
+            "video": await self._put_blob(job["video"]) if job.get("video") else None,
+        }
+
+        name = queue_for_mode(payload["mode"])
+        job_id = payload["job_id"]
+
+        backlog = await self.client.hincrby(self.key(name, "backlog"), str(payload["user_id"]), 1)
+        score = job_score(payload["created_at"], payload["priority"], max(0, backlog - 1))
+
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(self.key(name, "data"), job_id, json.dumps(payload, ensure_ascii=False))
+        pipe.hset(self.key(name, "scores"), job_id, score)
+        pipe.zadd(self.key(name, "ready"), {job_id: score})
+        pipe.zrank(self.key(name, "ready"), job_id)
+        pipe.lpush(self.key(name, "signal"), 1)
+        pipe.ltrim(self.key(name, "signal"), 0, 99)
+        results = await pipe.execute()
+
+        self.enqueued += 1
+        self.depth[name] += 1
+
+        rank = results[3]
+        return (rank if rank is not None else self.depth[name] - 1) + 1
+
+    async def position(self, job_id, mode):
+        rank = await self.client.zrank(self.key(queue_for_mode(mode), "ready"), job_id)
+        return None if rank is None else rank + 1
+
+    # ---------- consumer ----------
+
+    async def get(self, name, block=5000):
+        """Следующая по score задача: (job_id, job) или None по таймауту."""
+        await self._reclaim(name)
+
+        entry = await self._pop_ready(name)
+
+        if entry is None:
+            # ждем сигнал о новой задаче (или таймаут) и пробуем еще раз
+            await self.client.blpop([self.key(name, "signal")], timeout=max(1, block // 1000))
+            entry = await self._pop_ready(name)
+
+        if entry is None:
+            return None
+
+        job_id, raw, deliveries = entry
+
+        if deliveries > self.max_deliveries:
+            await self._bury(name, job_id, raw, f"deliveries={deliveries}")
+            return None
+
+        try:
+            job = await self._decode(raw)
+        except Exception as e:
+            logging.error(f"❌ JOB DECODE ERROR {name} {job_id}: {e}")
+            await self._bury(name, job_id, raw, f"decode: {e}", counted=deliveries > 1)
+            return None
+
+        if deliveries == 1:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.hincrby(self.key(name, "backlog"), str(job.get("user_id")), -1)
+            pipe.incr(self.key(name, "served"))
+            await pipe.execute()
+
+            self.served[name] += 1
+            self.wait_stats.record(
+                job.get("priority") or PRIORITY_FREE,
+                time.time() - (job.get("created_at") or time.time())
+            )
+        else:
+            self.reclaimed += 1
+            logging.warning(f"♻️ JOB REDELIVERED {name} {job_id} deliveries={deliveries}")
+
+        # задача может долго ждать в буфере воркера — продлеваем уже сейчас
+        self._start_heartbeat(name, job_id)
+
+        return job_id, job
+
+    async def run(self, name, job_id, job, handler):
+        """
+        Выполняет handler(job) с heartbeat и подтверждает задачу.
+        При отмене (остановка процесса) ack не делается — задачу
+        заберет другой воркер после visibility timeout.
+        """
+        self._start_heartbeat(name, job_id)
+        started = time.monotonic()
+
+        try:
+            await handler(job)
+
+        except asyncio.CancelledError:
+            self._stop_heartbeat(job_id)
+            raise
+
+        except Exception as e:
+            logging.error(f"❌ JOB HANDLER ERROR {job.get('job_id')}: {e}", exc_info=True)
+
+        await self.ack(name, job_id, job, duration=time.monotonic() - started)
+
+    async def ack(self, name, job_id, job, duration=None):
+        self._stop_heartbeat(job_id)
+
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zrem(self.key(name, "processing"), job_id)
+        pipe.hdel(self.key(name, "data"), job_id)
+        pipe.hdel(self.key(name, "scores"), job_id)
+        pipe.hdel(self.key(name, "deliveries"), job_id)
+        pipe.publish(DONE_CHANNEL, json.dumps({
+            "job_id": job.get("job_id"),
+            "user_id": job.get("user_id"),
+            "queue": name,
+            "duration": duration,
+        }))
+        await pipe.execute()
+
+        self.acked += 1
+
+        # с подпиской завершения (в том числе свои) считает _listen_done
+        if not self._listening:
+            self.throughput.record(name, duration)
+
+    async def release(self, name, job_id, job):
+        """Возвращает невыполненную задачу в ready на прежнее место."""
+        self._stop_heartbeat(job_id)
+
+        score = await self.client.hget(self.key(name, "scores"), job_id)
+
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zrem(self.key(name, "processing"), job_id)
+        pipe.zadd(self.key(name, "ready"), {job_id: float(score or time.time())})
+        pipe.hincrby(self.key(name, "deliveries"), job_id, -1)
+        pipe.hincrby(self.key(name, "backlog"), str(job.get("user_id")), 1)
+        pipe.incrby(self.key(name, "served"), -1)
+        pipe.lpush(self.key(name, "signal"), 1)
+        await pipe.execute()
+
+        self.served[name] = max(0, self.served[name] - 1)
+
+    # ---------- monitoring ----------
+
+    async def refresh_depth(self):
+        for name in QUEUES:
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                pipe.zcard(self.key(name, "ready"))
+                pipe.get(self.key(name, "served"))
+                depth, served = await pipe.execute()
+
+                self.depth[name] = depth
+                self.served[name] = int(served or 0)
+            except Exception as e:
+                logging.warning(f"⚠️ JOB QUEUE DEPTH ERROR {name}: {e}")
+
+    def stats(self):
+        return {
+            "depth": dict(self.depth),
+            "enqueued": self.enqueued,
+            "acked": self.acked,
+            "reclaimed": self.reclaimed,
+            "dead": self.dead,
+            "wait": self.wait_stats.summary(),
+        }
+
+    # ---------- internals ----------
+
+    async def _pop_ready(self, name):
+        result = await self._pop(
+            keys=[
+                self.key(name, "ready"),
+                self.key(name, "processing"),
+                self.key(name, "data"),
+                self.key(name, "deliveries"),
+            ],
+            args=[time.time() + self.visibility_timeout]
+        )
+
+        if not result:
+            return None
+
+        job_id, raw, deliveries = result
+        job_id = job_id.decode() if isinstance(job_id, bytes) else job_id
+
+        return job_id, raw, int(deliveries)
+
+    async def _decode(self, raw):
+        payload = json.loads(raw)
+
+        blobs = payload.get("blobs") or {}
+        keys = list(blobs.get("images") or [])
+        if blobs.get("video"):
+            keys.append(blobs["video"])
+
+        values = await self.client.mget([self._blob_key(k) for k in keys]) if keys else []
+
+        if any(v is None for v in values):
+            raise Exception("job blob expired")
+
+        images = values[:len(blobs.get("images") or [])]
+
+        job = {key: payload.get(key) for key in JOB_FIELDS}
+        job["blobs"] = blobs
+        job["images"] = [bytes(v) for v in images]
+        job["video"] = bytes(values[-1]) if blobs.get("video") else None
+
+        return job
+
+    async def _put_blob(self, data):
+        data = bytes(data)
+        digest = hashlib.sha256(data).hexdigest()
+
+        # NX: тот же файл уже лежит — только продлеваем
+        created = await self.client.set(self._blob_key(digest), data, ex=self.blob_ttl, nx=True)
+        if not created:
+            await self.client.expire(self._blob_key(digest), self.blob_ttl)
+
+        return digest
+
+    def _blob_key(self, digest):
+        return f"job:blob:{digest}"
+
+    async def _reclaim(self, name):
+        now = time.monotonic()
+
+        if now - self._last_reclaim[name] < min(30.0, self.visibility_timeout / 4):
+            return
+
+        self._last_reclaim[name] = now
+
+        try:
+            moved = await self._reclaim_script(
+                keys=[
+                    self.key(name, "ready"),
+                    self.key(name, "processing"),
+                    self.key(name, "scores"),
+                ],
+                args=[time.time()]
+            )
+        except Exception as e:
+            logging.warning(f"⚠️ JOB RECLAIM ERROR {name}: {e}")
+            return
+
+        if moved:
+            logging.warning(f"♻️ JOB RECLAIMED {name}: {moved} задач вернулись в очередь")
+
+    async def _bury(self, name, job_id, raw, reason, counted=True):
+        """
+        Переносит задачу в DEAD_STREAM. counted=False — задача не дошла до
+        учета первой выдачи (backlog / served в get), учитываем здесь.
+        Событие завершения публикуется как при ack: бот снимает блокировку
+        пользователя и не ждет результата, которого не будет.
+        """
+        self._stop_heartbeat(job_id)
+
+        try:
+            payload = json.loads(raw)
+        except Exception:
+            payload = {}
+
+        user_id = payload.get("user_id")
+
+        pipe = self.client.pipeline(transaction=True)
+        pipe.xadd(
+            DEAD_STREAM,
+            {"job": raw or b"", "reason": reason, "queue": name},
+            maxlen=10_000,
+            approximate=True
+        )
+        pipe.zrem(self.key(name, "processing"), job_id)
+        pipe.hdel(self.key(name, "data"), job_id)
+        pipe.hdel(self.key(name, "scores"), job_id)
+        pipe.hdel(self.key(name, "deliveries"), job_id)
+
+        if not counted:
+            if user_id is not None:
+                pipe.hincrby(self.key(name, "backlog"), str(user_id), -1)
+            pipe.incr(self.key(name, "served"))
+
+        pipe.publish(DONE_CHANNEL, json.dumps({
+            "job_id": payload.get("job_id") or job_id,
+            "user_id": user_id,
+            "queue": name,
+            "duration": None,
+            "dead": True,
+        }))
+        await pipe.execute()
+
+        if not counted:
+            self.served[name] += 1
+
+        self.dead += 1
+        logging.error(f"💀 JOB DEAD {name} {job_id}: {reason}")
+
+    def _start_heartbeat(self, name, job_id):
+        beat = self._beats.get(job_id)
+
+        if beat is None or beat.done():
+            self._beats[job_id] = asyncio.create_task(self._heartbeat(name, job_id))
+
+    def _stop_heartbeat(self, job_id):
+        beat = self._beats.pop(job_id, None)
+
+        if beat is not None:
+            beat.cancel()
+
+    async def _heartbeat(self, name, job_id):
+        # сдвигаем дедлайн видимости — задача не считается брошенной
+        interval = max(1.0, self.visibility_timeout / 3)
+
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                await self.client.zadd(
+                    self.key(name, "processing"),
+                    {job_id: time.time() + self.visibility_timeout},
+                    xx=True
+                )
+            except Exception as e:
+                logging.warning(f"⚠️ JOB HEARTBEAT ERROR {job_id}: {e}")
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(2)
+
+            try:
+                await self.refresh_depth()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"⚠️ JOB QUEUE MONITOR ERROR: {e}")
+
+    async def _listen_done(self):
+        while True:
+            pubsub = self.client.pubsub()
+
+            try:
+                await pubsub.subscribe(DONE_CHANNEL)
+
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+
+                    try:
+                        data = json.loads(message["data"])
+                    except Exception:
+                        continue
+
+                    if data.get("queue"):
+                        self.throughput.record(data["queue"], data.get("duration"))
+
+                    for callback in self._done_callbacks:
+                        try:
+                            callback(data.get("job_id"), data.get("user_id"))
+                        except Exception as e:
+                            logging.error(f"❌ JOB DONE CALLBACK ERROR: {e}")
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                logging.error(f"❌ JOB DONE LISTENER ERROR: {e}")
+                await asyncio.sleep(1)
+
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
@@ -0,0 +1,112 @@
+import sys
+import time
+from collections import OrderedDict
+
+# ================= LRU + TTL CACHE =================
+# Кэш в памяти процесса для любых значений (строки users, file_id
+# результатов, URL загруженных референсов).
+# - вытеснение O(1) через OrderedDict (самый старый по обращению — первый);
+# - жёсткий лимит по числу записей и по примерному объёму в байтах;
+# - TTL проверяется лениво при чтении, фоновый обход всего словаря не нужен;
+# - счётчики hit/miss/eviction для /stats.
+
+
+def estimate_size(value):
+    """
+    Грубая оценка объёма записи в байтах.
+    Для asyncpg.Record / dict считаем сумму размеров значений.
+    """
+    size = sys.getsizeof(value)
+
+    values = getattr(value, "values", None)
+
+    if callable(values):
+        try:
+            for v in values():
+                size += sys.getsizeof(v)
+        except Exception:
+            pass
+
+    return size
+
+
+class LRUCache:
+
+    def __init__(self, maxsize=50_000, max_bytes=64 * 1024 * 1024, ttl=60):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # key -> (value, expires_at, size)
+        self._data = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key):
+        item = self._data.get(key)
+
+        if item is None:
+            self.misses += 1
+            return None
+
+        value, expires_at, size = item
+
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expired += 1
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        if key in self._data:
+            self._remove(key)
+
+        size = estimate_size(value)
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        self._data[key] = (value, expires_at, size)
+        self._bytes += size
+
+        while self._data and (
+            len(self._data) > self.maxsize or self._bytes > self.max_bytes
+        ):
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._remove(key)
+
+    def clear(self):
+        self._data.clear()
+        self._bytes = 0
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+
+        if item is not None:
+            self._bytes -= item[2]
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+
+        return {
+            "size": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
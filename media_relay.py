@@ -0,0 +1,183 @@
+import logging
+import os
+import tempfile
+
+import aiohttp
+from telegram import InputFile
+
+# ================= MEDIA RELAY =================
+# Результаты FAL (фото / видео) больше не читаются целиком в память:
+# 1. если размер подходит под лимит Telegram для URL — отдаем ссылку
+#    провайдера, Telegram скачивает сам (0 байт через бота);
+# 2. иначе качаем чанками во временный файл с ограничением размера
+#    и отдаем Telegram файловый дескриптор — httpx читает его потоково.
+# Пик памяти на задачу ~ CHUNK_SIZE, а не размер файла.
+
+CHUNK_SIZE = 256 * 1024
+
+# Лимиты Bot API: по URL Telegram забирает фото до 5 МБ, прочее до 20 МБ;
+# загрузка multipart — до 10 МБ фото, до 50 МБ остальное.
+URL_PHOTO_LIMIT = 5 * 1024 * 1024
+URL_FILE_LIMIT = 20 * 1024 * 1024
+UPLOAD_PHOTO_LIMIT = 10 * 1024 * 1024
+UPLOAD_FILE_LIMIT = 50 * 1024 * 1024
+
+HEAD_TIMEOUT = aiohttp.ClientTimeout(total=15, sock_connect=10, sock_read=10)
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=600, sock_connect=60, sock_read=120)
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class SpooledMedia:
+    """Временный файл с результатом; удаляется при выходе из контекста."""
+
+    def __init__(self, path, size, filename):
+        self.path = path
+        self.size = size
+        self.filename = filename
+        self._handles = []
+
+    def input_file(self):
+        handle = open(self.path, "rb")
+        self._handles.append(handle)
+        return InputFile(handle, filename=self.filename, read_file_handle=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        for handle in self._handles:
+            handle.close()
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class MediaRelay:
+
+    def __init__(self, session_getter, chunk_size=CHUNK_SIZE, spool_dir=None):
+        self.session_getter = session_getter
+        self.chunk_size = chunk_size
+        self.spool_dir = spool_dir
+
+        self.by_url = 0
+        self.spooled = 0
+        self.spooled_bytes = 0
+        self.too_large = 0
+
+    # ---------- public ----------
+
+    async def send(
+        self,
+        url,
+        send,
+        field,
+        filename,
+        url_limit=URL_FILE_LIMIT,
+        max_bytes=UPLOAD_FILE_LIMIT,
+        fallback=None,
+        **kwargs
+    ):
+        """
+        Отправляет медиа по ссылке провайдера через send(**{field: ...}).
+        fallback=(send, field) — вторая попытка с тем же файлом
+        (например send_video -> send_document).
+        """
+        size = await self.content_length(url)
+
+        if size is not None and size <= url_limit:
+            try:
+                result = await send(**{field: url}, **kwargs)
+                self.by_url += 1
+                return result
+            except Exception as e:
+                logging.warning(f"⚠️ SEND BY URL FAILED, spooling: {e}")
+
+        suffix = os.path.splitext(filename)[1]
+
+        async with await self.spool(url, suffix=suffix, max_bytes=max_bytes, filename=filename) as media:
+            try:
+                return await send(**{field: media.input_file()}, **kwargs)
+
+            except Exception:
+                if not fallback:
+                    raise
+
+                fallback_send, fallback_field = fallback
+                logging.warning(f"⚠️ SEND {field} FAILED, trying {fallback_field}")
+
+                return await fallback_send(**{fallback_field: media.input_file()}, **kwargs)
+
+    async def content_length(self, url):
+        try:
+            session = self.session_getter()
+            async with session.head(url, allow_redirects=True, timeout=HEAD_TIMEOUT) as resp:
+                if resp.status != 200:
+                    return None
+
+                value = resp.headers.get("Content-Length")
+                return int(value) if value else None
+
+        except Exception:
+            return None
+
+    async def spool(self, url, suffix="", max_bytes=UPLOAD_FILE_LIMIT, filename=None):
+        """Скачивает url чанками во временный файл. Бросает MediaTooLarge."""
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.spool_dir)
+        size = 0
+
+        try:
+            with os.fdopen(fd, "wb") as out:
+                session = self.session_getter()
+
+                async with session.get(url, timeout=DOWNLOAD_TIMEOUT) as resp:
+                    if resp.status != 200:
+                        raise Exception(f"Failed to download media: {resp.status}")
+
+                    declared = resp.content_length
+                    if declared and declared > max_bytes:
+                        raise MediaTooLarge(f"media is {declared} bytes (limit {max_bytes})")
+
+                    async for chunk in resp.content.iter_chunked(self.chunk_size):
+                        size += len(chunk)
+
+                        if size > max_bytes:
+                            raise MediaTooLarge(f"media exceeds {max_bytes} bytes")
+
+                        out.write(chunk)
+
+            if not size:
+                raise Exception("Empty media download")
+
+        except MediaTooLarge:
+            self.too_large += 1
+            _remove(path)
+            raise
+
+        except BaseException:
+            _remove(path)
+            raise
+
+        self.spooled += 1
+        self.spooled_bytes += size
+
+        return SpooledMedia(path, size, filename or os.path.basename(path))
+
+    def stats(self):
+        return {
+            "by_url": self.by_url,
+            "spooled": self.spooled,
+            "spooled_mb": round(self.spooled_bytes / 1024 / 1024, 1),
+            "too_large": self.too_large,
+        }
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
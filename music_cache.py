@@ -0,0 +1,176 @@
+import logging
+import time
+
+# ================= MUSIC CACHE =================
+# Кэш готовых треков Lyria в таблице music_cache (переживает рестарты,
+# общий для всех процессов):
+# - ключ — нормализованный итоговый промпт (после _prepare_lyria3_clip_prompt):
+#   регистр и пробелы не важны, одинаковая просьба = одна запись;
+# - значение — file_id аудио в Telegram + размер и mime, байты не храним;
+# - TTL по времени создания и ограничение по числу строк: лишние
+#   вытесняются по давности последнего использования (LRU);
+# - выдавать ли готовый трек, решает пользователь (кнопка в боте).
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS music_cache (
+        prompt TEXT PRIMARY KEY,
+        audio_url TEXT,
+        created_at BIGINT
+    )
+    """,
+    "ALTER TABLE music_cache ADD COLUMN IF NOT EXISTS file_id TEXT",
+    "ALTER TABLE music_cache ADD COLUMN IF NOT EXISTS kind TEXT",
+    "ALTER TABLE music_cache ADD COLUMN IF NOT EXISTS file_size BIGINT",
+    "ALTER TABLE music_cache ADD COLUMN IF NOT EXISTS mime_type TEXT",
+    "ALTER TABLE music_cache ADD COLUMN IF NOT EXISTS hits INT DEFAULT 0",
+    "ALTER TABLE music_cache ADD COLUMN IF NOT EXISTS last_used BIGINT",
+    "CREATE INDEX IF NOT EXISTS idx_music_cache_last_used ON music_cache(last_used)",
+)
+
+# вытеснение не на каждую запись, а раз в EVICT_EVERY сохранений
+EVICT_EVERY = 20
+
+
+def normalize_key(prepared_prompt):
+    return " ".join((prepared_prompt or "").lower().split())
+
+
+class MusicCache:
+
+    def __init__(self, ttl=7 * 24 * 60 * 60, max_rows=5000):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.pool = None
+
+        self.lookups = 0
+        self.hits = 0
+        self.offered = 0
+        self.served = 0
+        self.stored = 0
+        self.evicted = 0
+
+        self._saves = 0
+
+    async def start(self, pool):
+        self.pool = pool
+
+        async with pool.acquire() as conn:
+            for statement in SCHEMA:
+                await conn.execute(statement)
+
+    async def get(self, key, count=True):
+        """
+        {"file_id", "kind", "file_size", "mime_type"} или None.
+        count=False — повторное чтение той же записи (выдача после
+        предложения): в lookups / hits оно не попадает.
+        """
+        if not self.pool or not key:
+            return None
+
+        if count:
+            self.lookups += 1
+
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(
+                """
+                SELECT file_id, kind, file_size, mime_type
+                FROM music_cache
+                WHERE prompt=$1 AND file_id IS NOT NULL AND created_at > $2
+                """,
+                key, int(time.time()) - self.ttl
+            )
+
+        if not row:
+            return None
+
+        if count:
+            self.hits += 1
+
+        return dict(row)
+
+    async def touch(self, key):
+        """Трек выдан из кэша: счетчик и время для LRU."""
+        self.served += 1
+
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE music_cache SET hits = hits + 1, last_used = $2 WHERE prompt=$1",
+                key, int(time.time())
+            )
+
+    async def save(self, key, kind, file_id, file_size=None, mime_type=None):
+        if not self.pool or not key or not file_id:
+            return
+
+        now = int(time.time())
+
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO music_cache (prompt, file_id, kind, file_size, mime_type, created_at, last_used, hits)
+                VALUES ($1, $2, $3, $4, $5, $6, $6, 0)
+                ON CONFLICT (prompt) DO UPDATE
+                SET file_id = EXCLUDED.file_id,
+                    kind = EXCLUDED.kind,
+                    file_size = EXCLUDED.file_size,
+                    mime_type = EXCLUDED.mime_type,
+                    created_at = EXCLUDED.created_at,
+                    last_used = EXCLUDED.last_used
+                """,
+                key, file_id, kind, file_size, mime_type, now
+            )
+
+        self.stored += 1
+        self._saves += 1
+
+        if self._saves % EVICT_EVERY == 1:
+            await self.evict()
+
+    async def invalidate(self, key):
+        # file_id больше не принимается Telegram
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM music_cache WHERE prompt=$1", key)
+
+    async def evict(self):
+        try:
+            async with self.pool.acquire() as conn:
+                expired = await conn.execute(
+                    "DELETE FROM music_cache WHERE created_at <= $1",
+                    int(time.time()) - self.ttl
+                )
+                overflow = await conn.execute(
+                    """
+                    DELETE FROM music_cache
+                    WHERE prompt IN (
+                        SELECT prompt FROM music_cache
+                        ORDER BY COALESCE(last_used, created_at) DESC
+                        OFFSET $1
+                    )
+                    """,
+                    self.max_rows
+                )
+
+            self.evicted += _affected(expired) + _affected(overflow)
+
+        except Exception as e:
+            logging.warning(f"⚠️ MUSIC CACHE EVICT ERROR: {e}")
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": (self.hits / self.lookups) if self.lookups else 0.0,
+            "offered": self.offered,
+            "served": self.served,
+            "stored": self.stored,
+            "evicted": self.evicted,
+        }
+
+
+def _affected(status):
+    # asyncpg: "DELETE 3"
+    try:
+        return int(status.split()[-1])
+    except Exception:
+        return 0
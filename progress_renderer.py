@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+# ================= PROGRESS RENDERER =================
+# Раньше каждая задача сама правила свой статус (точки каждые 1.5 с,
+# шаги видео / remix, полоска музыки) и слала chat action каждые 4 с:
+# при 30 задачах это десятки запросов в секунду только ради анимации,
+# Telegram отвечает 429 и тормозит настоящие send_photo / send_video.
+# Теперь задачи только публикуют желаемый текст (publish), а один
+# планировщик на процесс правит сообщения:
+# - не больше rate правок / действий в секунду на весь процесс;
+# - не чаще chat_interval в один чат, промежуточные кадры схлопываются
+#   (показывается последний опубликованный текст);
+# - правки, не меняющие текст, не отправляются;
+# - finish() снимает статус и заранее списывает из общего бюджета
+#   delivery_cost запросов на отправку результата: доставка идет вне
+#   очереди, а правки и действия остальных чатов только замедляются на эту
+#   долю, а не встают целиком; RetryAfter от Telegram ставит правки на паузу.
+
+TICK = 0.25
+
+# статус без publish дольше этого (задача упала, не вызвав finish) — забываем
+STALE_AFTER = 600
+
+
+class _Status:
+
+    __slots__ = ("message", "text", "kwargs", "shown", "dirty", "updated")
+
+    def __init__(self, message):
+        self.message = message
+        self.text = None
+        self.kwargs = {}
+        self.shown = getattr(message, "text", None)
+        self.dirty = False
+        self.updated = time.monotonic()
+
+
+class _Action:
+
+    __slots__ = ("bot", "action", "refs", "next_at")
+
+    def __init__(self, bot, action):
+        self.bot = bot
+        self.action = action
+        self.refs = 0
+        self.next_at = 0.0
+
+
+class ProgressRenderer:
+
+    def __init__(self, rate=10.0, chat_interval=3.0, action_interval=5.0, delivery_cost=2.0):
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.action_interval = action_interval
+        self.delivery_cost = delivery_cost
+
+        # (chat_id, message_id) -> _Status; порядок = очередь на правку
+        self._statuses = {}
+        self._actions = {}
+        self._chat_edited = {}
+
+        self._tokens = rate
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._inflight = set()
+        self._task = None
+
+        self.published = 0
+        self.edits = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.actions = 0
+        self.deliveries = 0
+        self.flood_waits = 0
+
+    # ---------- public ----------
+
+    def publish(self, message, text, **kwargs):
+        """Желаемый текст статуса; отправит планировщик, когда будет бюджет."""
+        if message is None:
+            return
+
+        key = _key(message)
+        status = self._statuses.get(key)
+
+        if status is None:
+            status = self._statuses[key] = _Status(message)
+
+        self.published += 1
+
+        if status.dirty:
+            # предыдущий кадр так и не был показан
+            self.coalesced += 1
+
+        status.text = text
+        status.kwargs = kwargs
+        status.dirty = text != status.shown
+        status.updated = time.monotonic()
+
+        if not status.dirty:
+            self.skipped += 1
+
+        self._ensure_running()
+
+    def finish(self, message):
+        """Статус больше не обновляется; часть бюджета — отправке результата."""
+        if message is not None:
+            self._statuses.pop(_key(message), None)
+
+        # долг не больше секунды бюджета: поток доставок не замораживает
+        # статусы остальных задач надолго
+        self._refill(time.monotonic())
+        self._tokens = max(-self.rate, self._tokens - self.delivery_cost)
+        self.deliveries += 1
+
+    def start_action(self, bot, chat_id, action):
+        """Периодический chat action (upload_photo, ...) до stop_action."""
+        entry = self._actions.get(chat_id)
+
+        if entry is None or entry.action != action:
+            entry = self._actions[chat_id] = _Action(bot, action)
+
+        entry.refs += 1
+        self._ensure_running()
+
+    def stop_action(self, chat_id):
+        entry = self._actions.get(chat_id)
+
+        if entry is None:
+            return
+
+        entry.refs -= 1
+
+        if entry.refs <= 0:
+            self._actions.pop(chat_id, None)
+
+    def stats(self):
+        return {
+            "statuses": len(self._statuses),
+            "actions": len(self._actions),
+            "published": self.published,
+            "edits": self.edits,
+            "coalesced": self.coalesced,
+            "skipped": self.skipped,
+            "chat_actions": self.actions,
+            "deliveries": self.deliveries,
+            "flood_waits": self.flood_waits,
+        }
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+        for task in list(self._inflight):
+            task.cancel()
+
+        self._statuses = {}
+        self._actions = {}
+
+    # ---------- scheduling ----------
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._statuses or self._actions:
+            await asyncio.sleep(TICK)
+
+            try:
+                self._tick()
+            except Exception as e:
+                logging.error(f"❌ PROGRESS RENDERER ERROR: {e}")
+
+    def _tick(self):
+        now = time.monotonic()
+        self._refill(now)
+
+        if now < self._paused_until:
+            return
+
+        # chat action короткие и видны пользователю — сначала они
+        for chat_id, entry in list(self._actions.items()):
+            if self._tokens < 1:
+                return
+
+            if now < entry.next_at:
+                continue
+
+            entry.next_at = now + self.action_interval
+            self._tokens -= 1
+            self._spawn(self._send_action(chat_id, entry))
+
+        for key, status in list(self._statuses.items()):
+            if now - status.updated > STALE_AFTER:
+                self._statuses.pop(key, None)
+                continue
+
+            if self._tokens < 1:
+                return
+
+            if not status.dirty:
+                continue
+
+            chat_id = key[0]
+            if now - self._chat_edited.get(chat_id, 0.0) < self.chat_interval:
+                continue
+
+            self._chat_edited[chat_id] = now
+            self._tokens -= 1
+
+            # в конец: следующий тик начнет с тех, кто ждал дольше
+            self._statuses.pop(key)
+            self._statuses[key] = status
+
+            status.dirty = False
+            self._spawn(self._edit(key, status, status.text, status.kwargs))
+
+        self._prune_chats(now)
+
+    def _refill(self, now):
+        self._tokens = min(self.rate, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    def _prune_chats(self, now):
+        if len(self._chat_edited) < 1000:
+            return
+
+        for chat_id, edited in list(self._chat_edited.items()):
+            if now - edited > self.chat_interval:
+                self._chat_edited.pop(chat_id, None)
+
+    # ---------- telegram calls ----------
+
+    async def _edit(self, key, status, text, kwargs):
+        try:
+            await status.message.edit_text(text, **kwargs)
+            status.shown = text
+            self.edits += 1
+
+        except RetryAfter as e:
+            self._flood_wait(e)
+            # кадр не показан — повторим, если статус еще жив
+            status.dirty = status.text != status.shown
+
+        except BadRequest as e:
+            if "message is not modified" in str(e):
+                status.shown = text
+                return
+
+            if self._statuses.get(key) is not status:
+                # статус уже снят (finish) и, скорее всего, удален
+                return
+
+            # сообщение удалено / недоступно — больше не трогаем
+            logging.warning(f"PROGRESS EDIT ERROR: {e}")
+            self._statuses.pop(key, None)
+
+        except Exception as e:
+            logging.warning(f"PROGRESS EDIT ERROR: {e}")
+
+    async def _send_action(self, chat_id, entry):
+        try:
+            await entry.bot.send_chat_action(chat_id=chat_id, action=entry.action)
+            self.actions += 1
+
+        except RetryAfter as e:
+            self._flood_wait(e)
+
+        except Exception as e:
+            logging.warning(f"CHAT ACTION ERROR: {e}")
+
+    def _flood_wait(self, e):
+        retry_after = e.retry_after
+        if hasattr(retry_after, "total_seconds"):
+            retry_after = retry_after.total_seconds()
+
+        self.flood_waits += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + float(retry_after))
+
+        logging.warning(f"⏸ PROGRESS FLOOD WAIT {retry_after}s")
+
+
+def _key(message):
+    return message.chat_id, message.message_id
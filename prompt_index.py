@@ -0,0 +1,294 @@
+import hashlib
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+# ================= SIMILAR PROMPTS =================
+# Точный ключ кэша результатов (result_cache.py) не ловит почти одинаковые
+# запросы: "Кот в шляпе!!", "кот в шляпе 😺", "Кот  в шляпе".
+# Здесь поверх clean_prompt:
+# - canonicalize: NFKC, нижний регистр, без эмодзи / пунктуации, пробелы
+#   схлопнуты;
+# - шинглы — символьные триграммы канонического текста;
+# - SimHash 64 бита; похожими считаются отпечатки с расстоянием Хэмминга
+#   не больше max_distance;
+# - поиск через LSH: отпечаток режется на max_distance + 1 полос, при
+#   расстоянии <= max_distance хотя бы одна полоса совпадает (принцип
+#   Дирихле), так что кандидаты — только из своих корзин, без перебора;
+# - scope — все, кроме текста (режим, модель, размер, референсы): похожий
+#   текст с другими фото похожим запросом не считается.
+# Индекс хранит только ключ кэша результатов; с Redis — общий для процессов:
+# корзина — ZSET (score = срок жизни записи), просроченные записи
+# вычищаются при добавлении и не попадают в кандидаты, так что TTL действует
+# на каждую запись, а не на корзину целиком.
+# Запись, чей результат уже пропал из кэша (alive в find), удаляется из
+# индекса сразу.
+
+BITS = 64
+SHINGLE = 3
+
+_NOT_WORD = re.compile(r"[^\w\s]+", re.UNICODE)
+_SPACES = re.compile(r"\s+")
+
+
+def canonicalize(text):
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = _NOT_WORD.sub(" ", text).replace("_", " ")
+    return _SPACES.sub(" ", text).strip()
+
+
+def shingles(canonical, size=SHINGLE):
+    if len(canonical) <= size:
+        return {canonical} if canonical else set()
+
+    return {canonical[i:i + size] for i in range(len(canonical) - size + 1)}
+
+
+def simhash(features):
+    weights = [0] * BITS
+
+    for feature in features:
+        h = int.from_bytes(
+            hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(),
+            "big"
+        )
+
+        for bit in range(BITS):
+            weights[bit] += 1 if h >> bit & 1 else -1
+
+    return sum(1 << bit for bit in range(BITS) if weights[bit] > 0)
+
+
+def fingerprint(text):
+    canonical = canonicalize(text)
+    return simhash(shingles(canonical)) if canonical else None
+
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class PromptIndex:
+
+    def __init__(self, max_distance=3, ttl=3600, maxsize=50_000, prefix="simhash:z:"):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.prefix = prefix
+
+        self.bands = max_distance + 1
+        self.band_bits = BITS // self.bands
+
+        # (scope, fp) -> (result_key, expires_at); порядок = давность
+        self._entries = OrderedDict()
+        # (scope, band, value) -> {fp}
+        self._buckets = {}
+
+        self.redis = None
+
+        self.lookups = 0
+        self.exact = 0
+        self.similar = 0
+        self.offered = 0
+        self.accepted = 0
+        self.stale = 0
+        self.redis_errors = 0
+
+    def start(self, redis_client):
+        self.redis = redis_client
+
+    # ---------- public ----------
+
+    async def add(self, scope, prompt, result_key):
+        fp = fingerprint(prompt)
+
+        if fp is None or not result_key:
+            return
+
+        if self.redis:
+            try:
+                await self._add_remote(scope, fp, result_key)
+                return
+            except Exception as e:
+                self.redis_errors += 1
+                logging.warning(f"⚠️ PROMPT INDEX REDIS ERROR: {e}")
+
+        self._add_local(scope, fp, result_key)
+
+    async def find(self, scope, prompt, alive=None):
+        """
+        (result_key, расстояние) ближайшего похожего запроса или None.
+        alive — await alive(result_key): результат еще в кэше; мертвые
+        записи удаляются из индекса, берется следующая ближайшая.
+        """
+        fp = fingerprint(prompt)
+
+        if fp is None:
+            return None
+
+        self.lookups += 1
+
+        candidates = None
+
+        if self.redis:
+            try:
+                candidates = await self._candidates_remote(scope, fp)
+            except Exception as e:
+                self.redis_errors += 1
+                logging.warning(f"⚠️ PROMPT INDEX REDIS ERROR: {e}")
+
+        if candidates is None:
+            candidates = self._candidates_local(scope, fp)
+
+        matches = sorted(
+            (distance(fp, other), other, result_key)
+            for other, result_key in candidates
+        )
+
+        for d, other, result_key in matches:
+            if d > self.max_distance:
+                break
+
+            if alive is not None and not await alive(result_key):
+                self.stale += 1
+                await self._remove(scope, other, result_key)
+                continue
+
+            if d == 0:
+                self.exact += 1
+            else:
+                self.similar += 1
+
+            return result_key, d
+
+        return None
+
+    def stats(self):
+        matched = self.exact + self.similar
+
+        return {
+            "size": len(self._entries),
+            "lookups": self.lookups,
+            "exact": self.exact,
+            "similar": self.similar,
+            # доля запросов, для которых уже был готовый (почти такой же) результат
+            "avoidable": (matched / self.lookups) if self.lookups else 0.0,
+            "offered": self.offered,
+            "accepted": self.accepted,
+            "stale": self.stale,
+        }
+
+    async def _remove(self, scope, fp, result_key):
+        self._remove_local((scope, fp))
+
+        if self.redis:
+            try:
+                await self._remove_remote(scope, fp, result_key)
+            except Exception as e:
+                self.redis_errors += 1
+                logging.warning(f"⚠️ PROMPT INDEX REDIS ERROR: {e}")
+
+    # ---------- bands ----------
+
+    def _bands(self, fp):
+        mask = (1 << self.band_bits) - 1
+        return [(band, fp >> (band * self.band_bits) & mask) for band in range(self.bands)]
+
+    def _bucket_key(self, scope, band, value):
+        return f"{self.prefix}{scope}:{band}:{value:x}"
+
+    # ---------- local ----------
+
+    def _add_local(self, scope, fp, result_key):
+        key = (scope, fp)
+
+        self._entries.pop(key, None)
+        self._entries[key] = (result_key, time.monotonic() + self.ttl)
+
+        for band, value in self._bands(fp):
+            self._buckets.setdefault((scope, band, value), set()).add(fp)
+
+        while len(self._entries) > self.maxsize:
+            self._remove_local(next(iter(self._entries)))
+
+    def _candidates_local(self, scope, fp):
+        now = time.monotonic()
+        found = {}
+
+        for band, value in self._bands(fp):
+            for other in list(self._buckets.get((scope, band, value), ())):
+                entry = self._entries.get((scope, other))
+
+                if entry is None:
+                    continue
+
+                if entry[1] <= now:
+                    self._remove_local((scope, other))
+                    continue
+
+                found[other] = entry[0]
+
+        return list(found.items())
+
+    def _remove_local(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry is None:
+            return
+
+        scope, fp = key
+
+        for band, value in self._bands(fp):
+            bucket = self._buckets.get((scope, band, value))
+
+            if bucket is not None:
+                bucket.discard(fp)
+                if not bucket:
+                    self._buckets.pop((scope, band, value), None)
+
+    # ---------- redis ----------
+
+    async def _add_remote(self, scope, fp, result_key):
+        member = f"{fp:x}:{result_key}"
+        now = time.time()
+
+        pipe = self.redis.pipeline(transaction=False)
+
+        for band, value in self._bands(fp):
+            key = self._bucket_key(scope, band, value)
+            pipe.zadd(key, {member: now + self.ttl})
+            pipe.zremrangebyscore(key, "-inf", now)
+            # корзина без добавлений за ttl целиком просрочена
+            pipe.expire(key, self.ttl)
+
+        await pipe.execute()
+
+    async def _candidates_remote(self, scope, fp):
+        pipe = self.redis.pipeline(transaction=False)
+
+        for band, value in self._bands(fp):
+            pipe.zrangebyscore(self._bucket_key(scope, band, value), time.time(), "+inf")
+
+        found = set()
+
+        for members in await pipe.execute():
+            for member in members:
+                if isinstance(member, bytes):
+                    member = member.decode()
+
+                other, _, result_key = member.partition(":")
+                found.add((int(other, 16), result_key))
+
+        return list(found)
+
+    async def _remove_remote(self, scope, fp, result_key):
+        member = f"{fp:x}:{result_key}"
+
+        pipe = self.redis.pipeline(transaction=False)
+
+        for band, value in self._bands(fp):
+            pipe.zrem(self._bucket_key(scope, band, value), member)
+
+        await pipe.execute()
@@ -0,0 +1,67 @@
+# ================= PROMPT RULES =================
+# Замены для clean_prompt (prompt_sanitizer.py). Английские формы — списком,
+# русские — основой со * (окончаний слишком много, чтобы перечислять).
+
+# ===== SAFE REPLACEMENTS (БЕЗ ЛОМАНИЯ СМЫСЛА) =====
+# оружие → нейтрально, насилие → cinematic
+SAFETY_REPLACEMENTS = {
+    "стреля*": "испускает свет",
+    "стрельб*": "энергетический эффект",
+    "оруж*": "устройство",
+    "пистолет*": "устройство",
+    "бластер*": "фантастическое устройство",
+
+    "gun": "futuristic device",
+    "guns": "futuristic devices",
+    "weapon": "tool",
+    "weapons": "tools",
+    "shoot": "emit light",
+    "shoots": "emits light",
+    "shooting": "light effect",
+
+    "убива*": "побеждает",
+    "убил*": "победил",
+    "убить": "победить",
+    "кровь": "красная энергия",
+    "крови": "красной энергии",
+    "кровью": "красной энергией",
+
+    "kill": "defeat",
+    "kills": "defeats",
+    "killed": "defeated",
+    "killing": "defeating",
+    "blood": "red energy",
+    "bloody": "glowing red",
+    "murder": "dramatic action",
+    "murders": "dramatic actions",
+}
+
+# бренды → стили
+BRAND_REPLACEMENTS = {
+    "simpsons": "yellow cartoon sitcom style",
+    "pixar": "3d animated cinematic style",
+    "disney": "fantasy animation style",
+    "rick and morty": "crazy sci-fi cartoon style",
+}
+
+# sora sensitive
+MOTION_REPLACEMENTS = {
+    "laser": "light beam",
+    "lasers": "light beams",
+    "attack": "fast action movement",
+    "attacks": "fast action movements",
+    "attacking": "moving fast",
+    "battle": "epic cinematic scene",
+    "battles": "epic cinematic scenes",
+    "fight": "dynamic action sequence",
+    "fights": "dynamic action sequences",
+    "fighting": "dynamic action",
+    "explosion": "bright cinematic flash",
+    "explosions": "bright cinematic flashes",
+}
+
+# ===== MODE SWITCH (БЕЗ БУСТЕРОВ) =====
+# картинкам / видео — все правила; Lyria стили и "экшн" не нужны
+# ("rap battle" не должен стать "rap epic cinematic scene")
+PROMPT_RULES = {**SAFETY_REPLACEMENTS, **BRAND_REPLACEMENTS, **MOTION_REPLACEMENTS}
+MODE_RULES = {"music": SAFETY_REPLACEMENTS}
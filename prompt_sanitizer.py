@@ -0,0 +1,155 @@
+import re
+from collections import OrderedDict
+
+# ================= PROMPT SANITIZER =================
+# Замены в промпте одним проходом:
+# - все правила режима собраны в одну регулярку-альтернацию, компилируется
+#   один раз при старте, а не словарь + 50 str.replace на каждый вызов;
+# - только целые слова: "kill" не трогает "skill", "gun" — "gunther";
+#   словоформы — отдельными правилами ("guns", "kills") или основой со *
+#   на конце: "пистолет*" ловит "пистолетом", "пистолеты" (для русского,
+#   где окончаний слишком много, чтобы перечислять);
+# - длинные варианты раньше коротких ("shooting" раньше "shoot"), замененный
+#   текст повторно не сканируется — правила не цепляются друг за друга;
+# - регистр сохраняется: kill -> defeat, Kill -> Defeat, KILL -> DEFEAT;
+# - свой набор правил на режим (mode), неизвестный режим — default;
+# - идемпотентность: ни одна замена сама не попадает под правила (проверяется
+#   при создании), поэтому повторный вызов на готовом тексте ничего не меняет;
+#   результат сразу кладется в LRU memo как уже чистый — второй вызов (задача,
+#   потом fal_generate) не сканирует текст вообще.
+
+
+def _match_case(source, replacement):
+    if len(source) > 1 and source.isupper():
+        return replacement.upper()
+
+    if source[:1].isupper():
+        return replacement[:1].upper() + replacement[1:]
+
+    return replacement
+
+
+def _normalize(phrase):
+    return " ".join(phrase.lower().split())
+
+
+class PromptSanitizer:
+
+    def __init__(self, rules, modes=None, maxsize=4096):
+        """
+        rules — {"плохо": "хорошо"} для режима по умолчанию; "плох*" —
+        основа с любым окончанием;
+        modes — {"music": {...}}: свои наборы правил для отдельных режимов.
+        """
+        self.maxsize = maxsize
+
+        self._compiled = {None: _compile(rules)}
+
+        for mode, mode_rules in (modes or {}).items():
+            self._compiled[mode] = _compile(mode_rules)
+
+        # (mode, prompt) -> cleaned; порядок = давность
+        self._memo = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.replaced = 0
+
+    def __call__(self, prompt, mode=None):
+        if not prompt:
+            return prompt
+
+        mode = (mode or "").lower()
+        if mode not in self._compiled:
+            mode = None
+
+        key = (mode, prompt)
+        cleaned = self._memo.get(key)
+
+        if cleaned is not None:
+            self._memo.move_to_end(key)
+            self.hits += 1
+            return cleaned
+
+        self.misses += 1
+        cleaned = self._clean(prompt, mode)
+
+        self._remember(key, cleaned)
+        if cleaned != prompt:
+            self._remember((mode, cleaned), cleaned)
+
+        return cleaned
+
+    def stats(self):
+        total = self.hits + self.misses
+
+        return {
+            "size": len(self._memo),
+            "hits": self.hits,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "replaced": self.replaced,
+        }
+
+    # ---------- internal ----------
+
+    def _clean(self, prompt, mode):
+        pattern, table = self._compiled[mode]
+
+        if pattern is None:
+            return prompt
+
+        def replace(match):
+            self.replaced += 1
+            source = match.group(0)
+            return _match_case(source, _lookup(table, _normalize(source)))
+
+        return pattern.sub(replace, prompt)
+
+    def _remember(self, key, cleaned):
+        self._memo[key] = cleaned
+        self._memo.move_to_end(key)
+
+        while len(self._memo) > self.maxsize:
+            self._memo.popitem(last=False)
+
+
+def _lookup(table, source):
+    good = table.get(source)
+
+    if good is not None:
+        return good
+
+    # основы ("пистолет*") — самая длинная подходящая
+    for bad in sorted(table, key=len, reverse=True):
+        if bad.endswith("*") and source.startswith(bad[:-1]):
+            return table[bad]
+
+    return source
+
+
+def _alternative(bad):
+    stem = bad.endswith("*")
+    words = bad.rstrip("*").split()
+
+    return r"\s+".join(map(re.escape, words)) + (r"\w*" if stem else "")
+
+
+def _compile(rules):
+    table = {_normalize(bad): good for bad, good in rules.items()}
+
+    if not table:
+        return None, table
+
+    alternatives = sorted(table, key=lambda bad: len(bad.rstrip("*")), reverse=True)
+    pattern = re.compile(
+        r"(?<!\w)(?:"
+        + "|".join(map(_alternative, alternatives))
+        + r")(?!\w)",
+        re.IGNORECASE
+    )
+
+    for good in table.values():
+        if pattern.search(good):
+            raise ValueError(f"prompt rule output is not clean: {good!r}")
+
+    return pattern, table
@@ -0,0 +1,142 @@
+import math
+import time
+from collections import deque
+
+# ================= QUEUE POSITION / ETA =================
+# Раньше позиция = сумма длин всех трех очередей, а защита от перегрузки —
+# "больше 300 задач", хотя картинка делается за секунды, а видео — минуты.
+# Теперь по каждой очереди отдельно:
+# - при постановке пользователь получает тикет — id своей задачи в очереди;
+# - позиция по тикету — реальное место задачи в очереди (ZRANK Redis-очереди
+#   или ранг в куче процесса), с учетом приоритетов: premium, поставленный
+#   позже, обгоняет free, и позиция free-пользователя честно растет;
+# - ETA = позиция / пропускная способность очереди, где пропускная
+#   способность — наблюдаемая за окно (завершенные задачи) или, пока данных
+#   мало, concurrency / средняя длительность задачи.
+# Допуск в очередь решается по ожидаемому ожиданию, а не по числу задач.
+
+DEFAULT_SERVICE_SECONDS = {
+    "image": 40.0,
+    "video": 300.0,
+    "music": 120.0,
+}
+
+
+class ThroughputMeter:
+    """Завершенные задачи по очередям: сколько за окно и EWMA длительности."""
+
+    def __init__(self, window=900, alpha=0.2):
+        self.window = window
+        self.alpha = alpha
+
+        self.completions = {}
+        self.service = {}
+
+    def record(self, name, duration=None, now=None):
+        now = now or time.time()
+
+        done = self.completions.setdefault(name, deque())
+        done.append(now)
+        self._trim(done, now)
+
+        if duration and duration > 0:
+            prev = self.service.get(name)
+            self.service[name] = duration if prev is None else prev + self.alpha * (duration - prev)
+
+    def rate(self, name, now=None):
+        """Задач в секунду за последнее окно."""
+        done = self.completions.get(name)
+
+        if not done:
+            return 0.0
+
+        self._trim(done, now or time.time())
+        return len(done) / self.window
+
+    def _trim(self, done, now):
+        while done and now - done[0] > self.window:
+            done.popleft()
+
+
+class QueueEta:
+
+    def __init__(
+        self,
+        position_getter,
+        throughput_getter,
+        concurrency,
+        default_service=None,
+        max_tickets=10_000
+    ):
+        # await position_getter(name, job_id) -> место задачи в очереди
+        # (1 — следующая) или None, если ее там уже нет;
+        # throughput_getter() -> ThroughputMeter (локальный или Redis-очереди)
+        self.position_getter = position_getter
+        self.throughput_getter = throughput_getter
+        self.concurrency = concurrency
+        self.default_service = default_service or DEFAULT_SERVICE_SECONDS
+        self.max_tickets = max_tickets
+
+        # user_id -> (очередь, тикет): у пользователя одна задача в очереди
+        self.tickets = {}
+
+    # ---------- tickets ----------
+
+    def issue(self, user_id, name, job_id):
+        self.tickets.pop(user_id, None)
+        self.tickets[user_id] = (name, job_id)
+
+        # самые старые тикеты — первые в dict
+        overflow = len(self.tickets) - self.max_tickets
+        for stale in list(self.tickets)[:max(0, overflow)]:
+            self.tickets.pop(stale, None)
+
+        return job_id
+
+    async def lookup(self, user_id):
+        """(очередь, позиция) или None, если задача уже выполняется."""
+        entry = self.tickets.get(user_id)
+
+        if not entry:
+            return None
+
+        name, job_id = entry
+        position = await self.position_getter(name, job_id)
+
+        if not position:
+            self.tickets.pop(user_id, None)
+            return None
+
+        return name, position
+
+    def discard(self, user_id):
+        self.tickets.pop(user_id, None)
+
+    # ---------- estimates ----------
+
+    def capacity(self, name):
+        """Задач в секунду: наблюдаемая скорость, но не ниже расчетной."""
+        throughput = self.throughput_getter()
+
+        service = throughput.service.get(name) or self.default_service.get(name, 60.0)
+        estimated = max(1, self.concurrency.get(name, 1)) / service
+
+        return max(throughput.rate(name), estimated)
+
+    def eta(self, name, position):
+        """Ожидаемое время (сек) до завершения задачи на позиции position."""
+        return position / self.capacity(name)
+
+    def eta_minutes(self, name, position):
+        return max(1, math.ceil(self.eta(name, position) / 60))
+
+    def stats(self):
+        throughput = self.throughput_getter()
+
+        return {
+            name: {
+                "rate_per_min": round(throughput.rate(name) * 60, 1),
+                "service": round(throughput.service.get(name) or 0, 1),
+            }
+            for name in self.concurrency
+        }
@@ -0,0 +1,158 @@
+import logging
+import time
+from collections import OrderedDict
+
+# ================= RATE LIMIT =================
+# Token bucket на ключ (user_id): capacity токенов, пополнение
+# capacity / per в секунду, каждое сообщение тратит один токен.
+# - проверка O(1): никаких списков отметок времени;
+# - block > 0: пустое ведро = бан на block секунд, после бана ведро полное
+#   (как старый антиспам: SPAM_LIMIT сообщений за SPAM_WINDOW -> бан);
+# - ключи, к которым давно не обращались (ведро уже полное и бана нет),
+#   удаляются — словари больше не растут на каждого пользователя навсегда;
+# - с Redis состояние общее для всех процессов (Lua-скрипт, ключи
+#   rl:<имя>:<ключ> с TTL), при ошибке Redis — локальное ведро.
+
+# KEYS: bucket; ARGV: capacity, rate, now, block, ttl_ms
+# -> {allowed, blocked_now}
+BUCKET_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 't', 'ts', 'b')
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local block = tonumber(ARGV[4])
+
+local blocked = tonumber(state[3]) or 0
+if now < blocked then
+    return {0, 0}
+end
+
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+local blocked_now = 0
+
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+elseif block > 0 then
+    blocked = now + block
+    tokens = capacity
+    now = blocked
+    blocked_now = 1
+end
+
+redis.call('HSET', KEYS[1], 't', tostring(tokens), 'ts', tostring(now), 'b', tostring(blocked))
+redis.call('PEXPIRE', KEYS[1], ARGV[5])
+
+return {allowed, blocked_now}
+"""
+
+
+class TokenBucketLimiter:
+
+    def __init__(self, name, capacity, per, block=0, maxsize=200_000):
+        self.name = name
+        self.capacity = float(capacity)
+        self.rate = capacity / per
+        self.block = block
+        self.maxsize = maxsize
+
+        # ведро полностью восстанавливается за per секунд после бана
+        self.idle_ttl = per + block
+
+        # key -> [tokens, ts, blocked_until]; порядок = давность обращения
+        self._buckets = OrderedDict()
+
+        self._script = None
+        self._prefix = f"rl:{name}"
+
+        self.allowed = 0
+        self.throttled = 0
+        self.blocked = 0
+        self.redis_errors = 0
+
+    def use_redis(self, client):
+        """Общее состояние в Redis (client — redis.asyncio)."""
+        self._script = client.register_script(BUCKET_SCRIPT) if client else None
+
+    async def allow(self, key):
+        now = time.time()
+
+        if self._script:
+            try:
+                allowed, blocked_now = await self._script(
+                    keys=[f"{self._prefix}:{key}"],
+                    args=[self.capacity, self.rate, now, self.block, int(self.idle_ttl * 1000)]
+                )
+                return self._count(key, int(allowed), int(blocked_now))
+
+            except Exception as e:
+                self.redis_errors += 1
+                logging.warning(f"⚠️ RATE LIMIT REDIS ERROR {self.name}: {e}")
+
+        return self._count(key, *self._take(key, now))
+
+    def _take(self, key, now):
+        self._expire(now)
+
+        bucket = self._buckets.pop(key, None)
+
+        if bucket is None:
+            bucket = [self.capacity, now, 0.0]
+
+        # в конец: самые давние обращения остаются в начале
+        self._buckets[key] = bucket
+
+        tokens, ts, blocked_until = bucket
+
+        if now < blocked_until:
+            return False, False
+
+        tokens = min(self.capacity, tokens + max(0.0, now - ts) * self.rate)
+
+        if tokens >= 1:
+            bucket[0], bucket[1] = tokens - 1, now
+            return True, False
+
+        if self.block > 0:
+            blocked_until = now + self.block
+            bucket[:] = [self.capacity, blocked_until, blocked_until]
+            return False, True
+
+        bucket[0], bucket[1] = tokens, now
+        return False, False
+
+    def _expire(self, now):
+        # амортизированно O(1): снимаем с головы только протухшие ключи
+        while self._buckets:
+            bucket = next(iter(self._buckets.values()))
+
+            if len(self._buckets) <= self.maxsize and now - max(bucket[1], bucket[2]) < self.idle_ttl:
+                break
+
+            self._buckets.popitem(last=False)
+
+    def _count(self, key, allowed, blocked_now):
+        if allowed:
+            self.allowed += 1
+        else:
+            self.throttled += 1
+
+        if blocked_now:
+            self.blocked += 1
+            logging.warning(f"🚫 RATE LIMIT BLOCK {self.name} key={key} ({self.block}s)")
+
+        return bool(allowed)
+
+    def stats(self):
+        return {
+            "allowed": self.allowed,
+            "throttled": self.throttled,
+            "blocked": self.blocked,
+            "tracked": len(self._buckets),
+            "redis": bool(self._script),
+            "redis_errors": self.redis_errors,
+        }
@@ -0,0 +1,154 @@
+import asyncio
+import hashlib
+import json
+import logging
+
+from lru_cache import LRUCache
+
+# ================= RESULT CACHE =================
+# Готовые результаты храним не байтами, а как file_id Telegram:
+# повторная отправка по file_id не качает и не грузит файл заново.
+# - ключ — sha256 от (mode, prompt, model, size, sha256 каждого референса),
+#   так что одинаковый текст с разными фото больше не совпадает;
+#   все, кроме текста, сворачивается в scope (для поиска похожих промптов,
+#   prompt_index.py);
+# - L1 — LRU + TTL в памяти (lru_cache.LRUCache), L2 — Redis с тем же TTL,
+#   общий для всех процессов (если подключен);
+# - в записи только {"kind", "file_id"} — десятки байт вместо мегабайт.
+
+# Большие файлы хэшируем вне event loop.
+HASH_IN_THREAD = 1024 * 1024
+
+# kind -> атрибут сообщения с файлом (для photo — список размеров)
+FILE_KINDS = ("photo", "video", "animation", "audio", "document")
+
+
+def message_file(message):
+    """(kind, file_id) отправленного сообщения или None."""
+    for kind in FILE_KINDS:
+        media = getattr(message, kind, None)
+
+        if not media:
+            continue
+
+        if isinstance(media, (list, tuple)):
+            media = media[-1]
+
+        return kind, media.file_id
+
+    return None
+
+
+class ResultCache:
+
+    def __init__(self, ttl=3600, maxsize=10_000, prefix="result:"):
+        self.ttl = ttl
+        self.prefix = prefix
+        self.l1 = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.redis = None
+
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.redis_errors = 0
+
+    def start(self, redis_client):
+        self.redis = redis_client
+
+    async def scope(self, mode, model, size, images=(), video=None):
+        """Все входы, кроме текста: похожие промпты ищутся только внутри scope."""
+        inputs = [await _digest(item) for item in images or ()]
+
+        if video:
+            inputs.append(await _digest(video))
+
+        raw = json.dumps([mode, model, size, inputs], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+    async def key(self, mode, prompt, model, size, images=(), video=None, scope=None):
+        if scope is None:
+            scope = await self.scope(mode, model, size, images, video)
+
+        raw = json.dumps([scope, prompt], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, key, count=True):
+        """count=False — проверка, что запись жива: без учета в hits / misses."""
+        entry = self.l1.get(key)
+
+        if entry is None and self.redis:
+            try:
+                raw = await self.redis.get(self.prefix + key)
+                if raw:
+                    entry = json.loads(raw)
+                    self.l1.set(key, entry)
+            except Exception as e:
+                self.redis_errors += 1
+                logging.warning(f"⚠️ RESULT CACHE REDIS GET ERROR: {e}")
+
+        if entry is None:
+            if count:
+                self.misses += 1
+            return None
+
+        if count:
+            self.hits += 1
+
+        return entry
+
+    async def set(self, key, message):
+        """Запоминает file_id из отправленного сообщения."""
+        found = message_file(message)
+
+        if not key or not found:
+            return
+
+        kind, file_id = found
+        entry = {"kind": kind, "file_id": file_id}
+
+        self.l1.set(key, entry)
+        self.stored += 1
+
+        if self.redis:
+            try:
+                await self.redis.set(self.prefix + key, json.dumps(entry), ex=self.ttl)
+            except Exception as e:
+                self.redis_errors += 1
+                logging.warning(f"⚠️ RESULT CACHE REDIS SET ERROR: {e}")
+
+    async def invalidate(self, key):
+        # file_id перестал работать (файл удален у Telegram)
+        self.l1.invalidate(key)
+
+        if self.redis:
+            await self._delete_remote(key)
+
+    def stats(self):
+        total = self.hits + self.misses
+
+        return {
+            "size": len(self.l1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stored": self.stored,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "redis_errors": self.redis_errors,
+        }
+
+    async def _delete_remote(self, key):
+        try:
+            await self.redis.delete(self.prefix + key)
+        except Exception as e:
+            self.redis_errors += 1
+            logging.warning(f"⚠️ RESULT CACHE REDIS DELETE ERROR: {e}")
+
+
+async def _digest(data):
+    if len(data) >= HASH_IN_THREAD:
+        return await asyncio.to_thread(_sha256, data)
+
+    return _sha256(data)
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
@@ -0,0 +1,150 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+
+# ================= JOB SCHEDULER =================
+# Вместо FIFO: у каждой задачи есть "время в очереди" (score), меньше — раньше.
+#
+#   score = created_at - PRIORITY_CREDIT[класс] + backlog_пользователя * USER_STRIDE
+#
+# - класс: premium > paid (купленные видео / музыка) > free. Кредит в секундах:
+#   premium-задача обгоняет free-задачи, поставленные не раньше, чем
+#   PRIORITY_CREDIT["premium"] секунд назад;
+# - старение встроено: free-задача, ждущая дольше кредита, уже никем не
+#   обгоняется, так что голодания нет, а лишнее ожидание ограничено кредитом;
+# - справедливость между пользователями: каждая следующая задача одного
+#   пользователя, пока предыдущие ждут, сдвигается на USER_STRIDE — это
+#   взвешенная очередь с виртуальным временем = реальное время.
+# Позиция задачи = число задач с меньшим score, то есть реальный порядок.
+
+PRIORITY_PREMIUM = "premium"
+PRIORITY_PAID = "paid"
+PRIORITY_FREE = "free"
+
+PRIORITIES = (PRIORITY_PREMIUM, PRIORITY_PAID, PRIORITY_FREE)
+
+PRIORITY_CREDIT = {
+    PRIORITY_PREMIUM: 600.0,
+    PRIORITY_PAID: 300.0,
+    PRIORITY_FREE: 0.0,
+}
+
+USER_STRIDE = 60.0
+
+
+def job_score(created_at, priority, backlog=0, credit=None, stride=USER_STRIDE):
+    credit = credit or PRIORITY_CREDIT
+    return created_at - credit.get(priority, 0.0) + backlog * stride
+
+
+class WaitStats:
+    """Время ожидания в очереди по классам: последние N значений, p50/p95."""
+
+    def __init__(self, window=1000):
+        self.samples = {name: deque(maxlen=window) for name in PRIORITIES}
+
+    def record(self, priority, seconds):
+        self.samples.setdefault(priority, deque(maxlen=1000)).append(max(0.0, seconds))
+
+    def percentile(self, priority, p):
+        values = sorted(self.samples.get(priority) or ())
+        if not values:
+            return None
+
+        index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+        return values[index]
+
+    def summary(self):
+        return {
+            name: {
+                "count": len(self.samples[name]),
+                "p50": self.percentile(name, 50),
+                "p95": self.percentile(name, 95),
+            }
+            for name in PRIORITIES
+        }
+
+
+class PriorityJobQueue:
+    """
+    Очередь процесса с тем же порядком, что и Redis-очередь (job_queue.py).
+    Интерфейс как у asyncio.Queue (put / get / qsize / task_done),
+    put возвращает позицию задачи.
+    """
+
+    def __init__(self, maxsize=0, wait_stats=None):
+        self.maxsize = maxsize
+        self.wait_stats = wait_stats
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._backlog = {}
+        self._unfinished = 0
+
+        # сколько задач уже взято в работу
+        self.served = 0
+        self._not_empty = asyncio.Event()
+
+    async def put(self, job):
+        return self.put_nowait(job)
+
+    def put_nowait(self, job):
+        if self.maxsize and len(self._heap) >= self.maxsize:
+            raise asyncio.QueueFull
+
+        user_id = job.get("user_id")
+        created_at = job.get("created_at") or time.time()
+        backlog = self._backlog.get(user_id, 0)
+
+        score = job_score(created_at, job.get("priority") or PRIORITY_FREE, backlog)
+
+        self._backlog[user_id] = backlog + 1
+        heapq.heappush(self._heap, (score, next(self._seq), job))
+
+        self._unfinished += 1
+        self._not_empty.set()
+
+        return self.position(score)
+
+    async def get(self):
+        while not self._heap:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        _, _, job = heapq.heappop(self._heap)
+        self.served += 1
+
+        user_id = job.get("user_id")
+        backlog = self._backlog.get(user_id, 1) - 1
+
+        if backlog > 0:
+            self._backlog[user_id] = backlog
+        else:
+            self._backlog.pop(user_id, None)
+
+        if self.wait_stats:
+            self.wait_stats.record(
+                job.get("priority") or PRIORITY_FREE,
+                time.time() - (job.get("created_at") or time.time())
+            )
+
+        return job
+
+    def task_done(self):
+        self._unfinished = max(0, self._unfinished - 1)
+
+    def qsize(self):
+        return len(self._heap)
+
+    def position(self, score):
+        return 1 + sum(1 for item in self._heap if item[0] < score)
+
+    def rank(self, job_id):
+        """Место задачи в очереди (1 — следующая) или None, если ее уже нет."""
+        for item in self._heap:
+            if item[2].get("job_id") == job_id:
+                return 1 + sum(1 for other in self._heap if other[:2] < item[:2])
+
+        return None
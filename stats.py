@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import time
+
+# ================= STATS ENGINE =================
+# /stats больше не сканирует users при каждом вызове.
+# - счётчики событий (регистрации, генерации, оплаты) копятся в памяти
+#   и раз в STATS_FLUSH_INTERVAL дописываются дельтой в bot_stats
+#   (сложение в SQL, поэтому несколько процессов не затирают друг друга);
+# - срезы, которые нельзя посчитать событиями (всего пользователей,
+#   premium, новые/активные за 24ч), пересчитываются одним запросом
+#   раз в STATS_ROLLUP_INTERVAL, а не на каждый /stats;
+# - окно 24ч — почасовые корзины в bot_stats_hourly: их пишет тот же flush,
+#   поэтому в "за 24ч" попадают все процессы (и worker.py), и рестарт
+#   ничего не обнуляет.
+
+DAY_SECONDS = 24 * 60 * 60
+HOUR_SECONDS = 60 * 60
+
+# почасовые корзины старше этого удаляются при rollup
+HOURLY_KEEP = 7 * DAY_SECONDS
+
+# Счётчики за всё время, которые храним в bot_stats.
+COUNTERS = (
+    "signups",
+    "images",
+    "videos",
+    "music",
+    "chat",
+    "premium_payments",
+)
+
+
+class StatsEngine:
+
+    def __init__(self, flush_interval=30, rollup_interval=300):
+        self.flush_interval = flush_interval
+        self.rollup_interval = rollup_interval
+
+        self.pool = None
+
+        # значения из bot_stats на момент последнего flush
+        self.persisted = {name: 0 for name in COUNTERS}
+        # ещё не записанные дельты этого процесса
+        self.pending = {name: 0 for name in COUNTERS}
+        # сумма почасовых корзин за последние 24ч на момент load
+        self.recent = {name: 0 for name in COUNTERS}
+
+        self.snapshot = {}
+        self.snapshot_at = 0
+
+        self._task = None
+
+    # ---------- events ----------
+
+    def incr(self, name, n=1):
+        if name not in self.pending:
+            logging.warning(f"⚠️ UNKNOWN STAT COUNTER: {name}")
+            return
+
+        self.pending[name] += n
+
+    # ---------- read ----------
+
+    def total(self, name):
+        return self.persisted.get(name, 0) + self.pending.get(name, 0)
+
+    def last_24h(self, name):
+        return self.recent.get(name, 0) + self.pending.get(name, 0)
+
+    # ---------- lifecycle ----------
+
+    async def start(self, pool):
+        self.pool = pool
+
+        async with pool.acquire() as conn:
+            await conn.execute("""
+            CREATE TABLE IF NOT EXISTS bot_stats (
+                key TEXT PRIMARY KEY,
+                value BIGINT DEFAULT 0
+            )
+            """)
+
+            await conn.execute("""
+            CREATE TABLE IF NOT EXISTS bot_stats_hourly (
+                key TEXT,
+                hour BIGINT,
+                value BIGINT DEFAULT 0,
+                PRIMARY KEY (key, hour)
+            )
+            """)
+
+            # Первый запуск: засеваем счётчики текущими суммами из users.
+            seed = await conn.fetchrow("""
+                SELECT
+                    COUNT(*) AS signups,
+                    COALESCE(SUM(image_count), 0) AS images,
+                    COALESCE(SUM(video_count), 0) AS videos,
+                    COALESCE(SUM(music_count), 0) AS music,
+                    COALESCE(SUM(chat_count), 0) AS chat
+                FROM users
+                WHERE NOT EXISTS (SELECT 1 FROM bot_stats)
+            """)
+
+            if seed and seed["signups"]:
+                await conn.executemany(
+                    """
+                    INSERT INTO bot_stats (key, value) VALUES ($1, $2)
+                    ON CONFLICT (key) DO NOTHING
+                    """,
+                    [(name, int(seed[name])) for name in seed.keys()]
+                )
+
+        await self.load()
+        await self.rollup()
+
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+        await self.flush()
+
+    async def load(self):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("SELECT key, value FROM bot_stats")
+            recent = await conn.fetch(
+                """
+                SELECT key, SUM(value) AS value
+                FROM bot_stats_hourly
+                WHERE hour > $1
+                GROUP BY key
+                """,
+                _hour(time.time()) - DAY_SECONDS
+            )
+
+        for row in rows:
+            if row["key"] in self.persisted:
+                self.persisted[row["key"]] = row["value"] or 0
+
+        self.recent = {name: 0 for name in COUNTERS}
+        for row in recent:
+            if row["key"] in self.recent:
+                self.recent[row["key"]] = int(row["value"] or 0)
+
+    async def flush(self):
+        if not self.pool:
+            return
+
+        deltas = [(k, v) for k, v in self.pending.items() if v]
+
+        if not deltas:
+            return
+
+        for name, value in deltas:
+            self.pending[name] -= value
+
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    rows = await conn.fetch(
+                        """
+                        INSERT INTO bot_stats (key, value)
+                        SELECT * FROM UNNEST($1::TEXT[], $2::BIGINT[])
+                        ON CONFLICT (key) DO UPDATE
+                        SET value = bot_stats.value + EXCLUDED.value
+                        RETURNING key, value
+                        """,
+                        [k for k, _ in deltas],
+                        [v for _, v in deltas]
+                    )
+
+                    await conn.execute(
+                        """
+                        INSERT INTO bot_stats_hourly (key, hour, value)
+                        SELECT k, $3, v FROM UNNEST($1::TEXT[], $2::BIGINT[]) AS d(k, v)
+                        ON CONFLICT (key, hour) DO UPDATE
+                        SET value = bot_stats_hourly.value + EXCLUDED.value
+                        """,
+                        [k for k, _ in deltas],
+                        [v for _, v in deltas],
+                        _hour(time.time())
+                    )
+
+        except Exception as e:
+            # Возвращаем дельты, запишем в следующий раз.
+            for name, value in deltas:
+                self.pending[name] += value
+            logging.error(f"❌ STATS FLUSH ERROR: {e}")
+            return
+
+        for row in rows:
+            self.persisted[row["key"]] = row["value"]
+
+        for name, value in deltas:
+            self.recent[name] += value
+
+    async def rollup(self):
+        """Один проход по users вместо девяти отдельных агрегатов."""
+        now = int(time.time())
+        day_ago = now - DAY_SECONDS
+
+        try:
+            async with self.pool.acquire() as conn:
+                row = await conn.fetchrow(
+                    """
+                    SELECT
+                        COUNT(*) AS total_users,
+                        COUNT(*) FILTER (WHERE created_at > $1) AS new_24h,
+                        COUNT(*) FILTER (WHERE last_active > $1) AS active_24h,
+                        COUNT(*) FILTER (WHERE premium = 1) AS premium_users,
+                        COALESCE(SUM(paid_video), 0) AS paid_video,
+                        COALESCE(SUM(paid_music), 0) AS paid_music
+                    FROM users
+                    """,
+                    day_ago
+                )
+
+                await conn.execute(
+                    "DELETE FROM bot_stats_hourly WHERE hour < $1",
+                    now - HOURLY_KEEP
+                )
+
+        except Exception as e:
+            logging.error(f"❌ STATS ROLLUP ERROR: {e}")
+            return
+
+        self.snapshot = dict(row)
+        self.snapshot_at = now
+
+    async def _loop(self):
+        last_rollup = time.time()
+
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            try:
+                await self.flush()
+                await self.load()
+
+                if time.time() - last_rollup >= self.rollup_interval:
+                    await self.rollup()
+                    last_rollup = time.time()
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                logging.error(f"❌ STATS LOOP ERROR: {e}")
+
+
+def _hour(ts):
+    return int(ts // HOUR_SECONDS) * HOUR_SECONDS
@@ -0,0 +1,221 @@
+import asyncio
+import importlib.util
+import unittest
+
+import aiohttp
+from aiohttp import web
+
+from fal_poller import FalPoller, FalPollError
+from fal_standin import FalStandIn
+from fal_webhook import FalWebhookRegistry, start_webhook_server
+
+# Быстрые интервалы опроса: тесты не должны ждать секундами.
+FAST = {
+    "first": 0.01,
+    "min": 0.01,
+    "max_queue": 0.02,
+    "per_position": 0.0,
+    "max_progress": 0.02,
+    "growth": 0.0,
+}
+PROFILES = {"image": FAST, "video": FAST, "webhook": {**FAST, "first": 5.0, "min": 5.0}}
+
+
+class StandInTestCase(unittest.IsolatedAsyncioTestCase):
+
+    standin_options = {}
+
+    async def asyncSetUp(self):
+        self.standin = FalStandIn(**self.standin_options)
+        self.base_url = await self.standin.start()
+
+        self.session = aiohttp.ClientSession()
+        self.poller = FalPoller(lambda: self.session, profiles=PROFILES)
+
+    async def asyncTearDown(self):
+        await self.poller.close()
+        await self.session.close()
+        await self.standin.close()
+
+    async def submit(self, path="fal-ai/nano-banana-2", url=None):
+        async with self.session.post(
+            url or f"{self.base_url}/{path}",
+            json={"prompt": "cat"},
+            headers={"Authorization": "Key test"}
+        ) as resp:
+            self.assertEqual(resp.status, 200)
+            return await resp.json()
+
+
+class PollingTest(StandInTestCase):
+
+    standin_options = {"queue_polls": 2, "progress_polls": 2}
+
+    async def test_completes_and_returns_result(self):
+        created = await self.submit()
+
+        status = await self.poller.wait(created["status_url"], max_wait=5)
+        self.assertEqual(status["status"], "COMPLETED")
+
+        async with self.session.get(created["response_url"]) as resp:
+            result = await resp.json()
+
+        self.assertTrue(result["images"][0]["url"].startswith(self.base_url))
+        self.assertEqual(self.standin.status_polls, 5)
+        self.assertEqual(self.standin.headers[0]["Authorization"], "Key test")
+
+    async def test_video_paths_return_video(self):
+        created = await self.submit("fal-ai/kling-video/o1/standard/video-to-video/edit")
+        self.assertIn("/fal-ai/kling-video/requests/", created["status_url"])
+
+        await self.poller.wait(created["status_url"], max_wait=5, profile="video")
+
+        async with self.session.get(created["response_url"]) as resp:
+            result = await resp.json()
+
+        self.assertIn("video", result)
+
+    async def test_timeout(self):
+        self.standin.queue_polls = 10_000
+        created = await self.submit()
+
+        with self.assertRaises(FalPollError):
+            await self.poller.wait(created["status_url"], max_wait=0.1)
+
+
+class FailureTest(StandInTestCase):
+
+    standin_options = {"fail": True}
+
+    async def test_failed_status_raises(self):
+        created = await self.submit()
+
+        with self.assertRaises(FalPollError):
+            await self.poller.wait(created["status_url"], max_wait=5)
+
+        self.assertEqual(self.poller.stats()["failed"], 1)
+
+
+class RetryTest(StandInTestCase):
+
+    standin_options = {"status_errors": 2}
+
+    async def test_5xx_is_retried(self):
+        created = await self.submit()
+
+        status = await self.poller.wait(created["status_url"], max_wait=5)
+
+        self.assertEqual(status["status"], "COMPLETED")
+        self.assertEqual(self.poller.stats()["errors"], 2)
+
+
+class WebhookTest(StandInTestCase):
+
+    standin_options = {"queue_polls": 1000}
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+
+        # приемник вебхуков вместо FastAPI endpoint: та же registry.resolve
+        self.registry = FalWebhookRegistry(public_url="http://127.0.0.1")
+
+        async def receive(request):
+            self.registry.resolve(await request.json())
+            return web.json_response({"ok": True})
+
+        app = web.Application()
+        app.router.add_post("/fal/webhook", receive)
+        self.receiver = web.AppRunner(app)
+        await self.receiver.setup()
+        site = web.TCPSite(self.receiver, "127.0.0.1", 0)
+        await site.start()
+
+        port = self.receiver.addresses[0][1]
+        self.registry.public_url = f"http://127.0.0.1:{port}"
+        self.registry.serving = True
+
+    async def asyncTearDown(self):
+        await self.receiver.cleanup()
+        await super().asyncTearDown()
+
+    async def test_webhook_resolves_without_polling_to_completion(self):
+        submit_url = self.registry.submit_url(f"{self.base_url}/fal-ai/nano-banana-2")
+        self.assertIn("fal_webhook=", submit_url)
+
+        created = await self.submit(url=submit_url)
+        hook = self.registry.register(created["request_id"])
+
+        status = await asyncio.wait_for(hook, timeout=5)
+
+        self.assertEqual(status["status"], "COMPLETED")
+        self.assertIn("images", status["webhook_payload"])
+        self.assertEqual(self.standin.result_fetches, 0)
+
+    async def test_early_webhook_is_kept(self):
+        self.standin.webhook_delay = 0
+        submit_url = self.registry.submit_url(f"{self.base_url}/fal-ai/nano-banana-2")
+
+        created = await self.submit(url=submit_url)
+
+        for _ in range(100):
+            if self.standin.webhooks_sent:
+                break
+            await asyncio.sleep(0.01)
+
+        hook = self.registry.register(created["request_id"])
+        self.assertTrue(hook.done())
+        self.assertEqual(hook.result()["status"], "COMPLETED")
+
+    async def test_failed_webhook(self):
+        self.standin.fail = True
+        submit_url = self.registry.submit_url(f"{self.base_url}/fal-ai/nano-banana-2")
+
+        created = await self.submit(url=submit_url)
+        hook = self.registry.register(created["request_id"])
+
+        with self.assertRaises(Exception):
+            await asyncio.wait_for(hook, timeout=5)
+
+    async def test_disabled_registry_leaves_url_untouched(self):
+        self.registry.serving = False
+        url = f"{self.base_url}/fal-ai/nano-banana-2"
+
+        self.assertEqual(self.registry.submit_url(url), url)
+
+
+@unittest.skipUnless(
+    importlib.util.find_spec("uvicorn") and importlib.util.find_spec("fastapi"),
+    "uvicorn / fastapi not installed"
+)
+class WebhookServerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_serving_only_after_bind(self):
+        registry = FalWebhookRegistry(public_url="http://127.0.0.1")
+        server, task = await start_webhook_server(registry, host="127.0.0.1", port=0)
+
+        try:
+            self.assertTrue(registry.serving)
+        finally:
+            server.should_exit = True
+            await task
+
+        self.assertFalse(registry.serving)
+
+    async def test_bind_failure_keeps_polling(self):
+        blocker = await asyncio.start_server(lambda r, w: None, "127.0.0.1", 0)
+        port = blocker.sockets[0].getsockname()[1]
+        registry = FalWebhookRegistry(public_url="http://127.0.0.1")
+
+        try:
+            with self.assertRaises(OSError):
+                await start_webhook_server(registry, host="127.0.0.1", port=port)
+        finally:
+            blocker.close()
+            await blocker.wait_closed()
+
+        self.assertFalse(registry.serving)
+        self.assertFalse(registry.enabled)
+
+
+if __name__ == "__main__":
+    unittest.main()
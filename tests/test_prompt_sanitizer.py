@@ -0,0 +1,50 @@
+import unittest
+
+from prompt_rules import MODE_RULES, PROMPT_RULES
+from prompt_sanitizer import PromptSanitizer
+
+
+class PromptSanitizerTest(unittest.TestCase):
+
+    def setUp(self):
+        # как PROMPT_SANITIZER в bot.py
+        self.sanitizer = PromptSanitizer(PROMPT_RULES, modes=MODE_RULES)
+
+    def test_music_keeps_battle_and_brands(self):
+        prompt = "Rap battle in Disney style, Pixar vibes"
+
+        self.assertEqual(self.sanitizer(prompt, "music"), prompt)
+
+    def test_music_still_applies_safety_rules(self):
+        self.assertEqual(
+            self.sanitizer("a song about guns and blood", "music"),
+            "a song about futuristic devices and red energy"
+        )
+
+    def test_image_applies_all_rules(self):
+        self.assertEqual(
+            self.sanitizer("rap battle, disney", "image"),
+            "rap epic cinematic scene, fantasy animation style"
+        )
+
+    def test_unknown_mode_uses_default_rules(self):
+        self.assertEqual(self.sanitizer("epic fights", "video"), "epic dynamic action sequences")
+
+    def test_inflected_forms(self):
+        self.assertEqual(self.sanitizer("man with guns", "image"), "man with futuristic devices")
+        self.assertEqual(self.sanitizer("с пистолетом", "image"), "с устройство")
+        self.assertEqual(self.sanitizer("Gunther has skill", "image"), "Gunther has skill")
+
+    def test_case_preserved(self):
+        self.assertEqual(self.sanitizer("KILL the boss"), "DEFEAT the boss")
+
+    def test_idempotent(self):
+        for mode in (None, "music"):
+            cleaned = self.sanitizer("He kills with weapons in a battle", mode)
+            fresh = PromptSanitizer(PROMPT_RULES, modes=MODE_RULES)
+
+            self.assertEqual(fresh(cleaned, mode), cleaned)
+
+
+if __name__ == "__main__":
+    unittest.main()
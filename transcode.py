@@ -0,0 +1,211 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+# ================= TRANSCODE POOL =================
+# ffmpeg больше не запускается через subprocess.run внутри обработчиков:
+# это замораживало весь event loop на время перекодирования.
+# Задачи попадают в очередь, N воркеров (по числу ядер) запускают ffmpeg
+# через asyncio.create_subprocess_exec, с таймаутом и kill на каждую задачу.
+
+STDERR_TAIL = 4000
+
+
+class TranscodeError(Exception):
+
+    def __init__(self, message, returncode=None, stderr=""):
+        super().__init__(message)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class TranscodePool:
+
+    def __init__(self, workers=None, queue_size=100, timeout=300):
+        self.workers = workers or os.cpu_count() or 2
+        self.timeout = timeout
+
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+
+    # ---------- public ----------
+
+    async def run(self, args, timeout=None):
+        """
+        Ставит команду в очередь и ждёт результат.
+        Возвращает stderr (хвост) или бросает TranscodeError.
+        """
+        self._ensure_workers()
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        try:
+            self.queue.put_nowait((list(args), timeout or self.timeout, future))
+        except asyncio.QueueFull:
+            raise TranscodeError("transcode queue is full")
+
+        return await future
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queued": self.queue.qsize(),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+        }
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # ---------- internals ----------
+
+    def _ensure_workers(self):
+        self._tasks = [task for task in self._tasks if not task.done()]
+
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def _worker(self):
+        while True:
+            args, timeout, future = await self.queue.get()
+
+            try:
+                # Вызывающий уже отменился (таймаут задачи / отмена генерации).
+                if future.done():
+                    continue
+
+                self.running += 1
+                try:
+                    stderr = await self._exec(args, timeout, future)
+                finally:
+                    self.running -= 1
+
+                if not future.done():
+                    future.set_result(stderr)
+
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+            finally:
+                self.queue.task_done()
+
+    async def _exec(self, args, timeout, future):
+        started = time.time()
+
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+
+        # Если вызывающий отменил ожидание — убиваем ffmpeg, а не ждём конца.
+        def kill_on_cancel(_):
+            if proc.returncode is None:
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+
+        future.add_done_callback(kill_on_cancel)
+
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+
+        except asyncio.TimeoutError:
+            kill_on_cancel(None)
+            await proc.wait()
+            self.timeouts += 1
+            self.failed += 1
+            raise TranscodeError(f"{args[0]} timeout after {timeout}s")
+
+        except asyncio.CancelledError:
+            kill_on_cancel(None)
+            await proc.wait()
+            raise
+
+        finally:
+            future.remove_done_callback(kill_on_cancel)
+
+        stderr_text = (stderr or b"").decode("utf-8", "replace")[-STDERR_TAIL:]
+
+        if proc.returncode != 0:
+            self.failed += 1
+            raise TranscodeError(
+                f"{args[0]} exited with code {proc.returncode}",
+                returncode=proc.returncode,
+                stderr=stderr_text
+            )
+
+        self.completed += 1
+
+        logging.info(f"🎞 TRANSCODE DONE in {time.time() - started:.1f}s")
+
+        return stderr_text
+
+
+# ================= PROBE =================
+
+async def probe_video(path, timeout=30):
+    """
+    Геометрия и кодек первой видеодорожки через ffprobe.
+    Возвращает {"width", "height", "codec", "pix_fmt"}.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "stream=codec_name,width,height,pix_fmt",
+        "-of", "json",
+        path,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+        raise
+
+    if proc.returncode != 0:
+        raise TranscodeError(
+            f"ffprobe exited with code {proc.returncode}",
+            returncode=proc.returncode,
+            stderr=(stderr or b"").decode("utf-8", "replace")[-STDERR_TAIL:]
+        )
+
+    try:
+        stream = json.loads(stdout)["streams"][0]
+    except Exception:
+        raise TranscodeError("ffprobe: no video stream")
+
+    return {
+        "width": stream.get("width"),
+        "height": stream.get("height"),
+        "codec": stream.get("codec_name"),
+        "pix_fmt": stream.get("pix_fmt"),
+    }
@@ -16,6 +16,18 @@ TEXTS = {'start': {'ru': 'Наш бот дает вам возможность 
  'already_generating': {'ru': '⏳ Ваша генерация уже выполняется', 'en': '⏳ Your generation is already running'},
  'limit_reached': {'ru': '⚠️ Лимит генераций достигнут', 'en': '⚠️ Generation limit reached'},
  'music_need_pay': {'ru': '🎵 Нужна оплата для генерации музыки', 'en': '🎵 Payment required for music generation'},
+ 'music_cache_offer': {'ru': '🎵 Такой трек уже есть — получить его сразу или создать новый?',
+                       'en': '🎵 A track for this prompt already exists. Get it instantly or create a new one?'},
+ 'music_cache_instant': {'ru': '⚡ Получить сразу', 'en': '⚡ Get it now'},
+ 'music_cache_new': {'ru': '🎲 Создать новый', 'en': '🎲 Create a new one'},
+ 'music_cache_expired': {'ru': '⚠️ Готовый трек больше недоступен, отправьте запрос еще раз',
+                         'en': '⚠️ The ready track is no longer available, please send your prompt again'},
+ 'similar_result_offer': {'ru': '✨ Похожий результат уже есть — получить его сразу или создать новый?',
+                          'en': '✨ A similar result already exists. Get it instantly or create a new one?'},
+ 'similar_result_instant': {'ru': '⚡ Получить сразу', 'en': '⚡ Get it now'},
+ 'similar_result_new': {'ru': '🎲 Создать новый', 'en': '🎲 Create a new one'},
+ 'similar_result_expired': {'ru': '⚠️ Готовый результат больше недоступен, отправьте запрос еще раз',
+                            'en': '⚠️ The ready result is no longer available, please send your prompt again'},
  'send_video_first': {'ru': '⚠️ Сначала отправьте видео', 'en': '⚠️ Please send a video first'},
  'done': {'ru': '✅ Готово', 'en': '✅ Done'},
  'lang_changed_ru': {'ru': '✅ Язык переключен на русский', 'en': '✅ Language switched to Russian'},
@@ -241,14 +253,17 @@ TEXTS = {'start': {'ru': 'Наш бот дает вам возможность 
  'repeat': {'ru': '🔁 Повторить', 'en': '🔁 Repeat'},
  'start_over': {'ru': '🆕 Начать заново', 'en': '🆕 Start over'},
  'finish': {'ru': '❌ Закончить', 'en': '❌ Finish'},
- 'queue_wait': {'ru': '⏳ Вы в очереди: {position}\n🦕 Генерация создается, немного надо подождать...',
-                'en': '⏳ You are in queue: {position}\n🦕 Generation is being created. Please wait a little...'},
- 'queue_masterpiece': {'ru': '⏳ Вы в очереди: {position}\n🦕 Шедевр создается, немного надо подождать...',
-                       'en': '⏳ You are in queue: {position}\n'
+ 'queue_wait': {'ru': '⏳ Вы в очереди: {position} (~{eta} мин)\n🦕 Генерация создается, немного надо подождать...',
+                'en': '⏳ You are in queue: {position} (~{eta} min)\n'
+                      '🦕 Generation is being created. Please wait a little...'},
+ 'queue_masterpiece': {'ru': '⏳ Вы в очереди: {position} (~{eta} мин)\n🦕 Шедевр создается, немного надо подождать...',
+                       'en': '⏳ You are in queue: {position} (~{eta} min)\n'
                              '🦕 A masterpiece is being created. Please wait a little...'},
  'no_repeat_data': {'ru': '⚠️ Нет данных для повторной генерации', 'en': '⚠️ No data for repeat generation'},
  'already_in_queue': {'ru': '⏳ Ваша генерация уже в очереди или выполняется',
                       'en': '⏳ Your generation is already queued or running'},
+ 'already_in_queue_position': {'ru': '⏳ Ваша генерация уже в очереди: {position} (~{eta} мин)',
+                               'en': '⏳ Your generation is already in queue: {position} (~{eta} min)'},
  'queue_error': {'ru': '❌ Ошибка очереди. Попробуйте позже.', 'en': '❌ Queue error. Try again later.'},
  'remix_error': {'ru': '⚠️ Ошибка remix:\n{error}', 'en': '⚠️ Remix error:\n{error}'},
  'fal_no_video': {'ru': '⚠️ FAL не вернул видео', 'en': '⚠️ FAL did not return a video'},
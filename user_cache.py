@@ -0,0 +1,200 @@
+import asyncio
+import json
+import logging
+import uuid
+
+from lru_cache import LRUCache
+
+# ================= USER CACHE =================
+# LRU + TTL кэш строк users (lru_cache.LRUCache): invalidate — после
+# изменения пользователя в БД.
+
+
+class UserCache(LRUCache):
+    pass
+
+
+# ================= SHARED (L1 + REDIS L2) =================
+# L1 — UserCache в памяти процесса, L2 — Redis, общий для всех реплик
+# bot.py / worker.py. Любая инвалидация удаляет ключ в Redis и рассылается
+# через pub/sub, чтобы остальные процессы сбросили свой L1.
+
+INVALIDATE_CHANNEL = "user_cache:invalidate"
+
+
+class TieredUserCache:
+
+    def __init__(self, l1, redis_ttl=60, prefix="user:"):
+        self.l1 = l1
+        self.redis_ttl = redis_ttl
+        self.prefix = prefix
+        self.instance_id = uuid.uuid4().hex
+
+        self.redis = None
+        self.listeners = []
+
+        self.l2_hits = 0
+        self.l2_errors = 0
+        self.remote_invalidations = 0
+
+        self._listen_task = None
+
+    # ---------- lifecycle ----------
+
+    async def start(self, redis_client):
+        """Подключает L2. Без вызова start() кэш работает только как L1."""
+        self.redis = redis_client
+        self._listen_task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listen_task:
+            self._listen_task.cancel()
+            try:
+                await self._listen_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._listen_task = None
+
+        self.redis = None
+
+    def on_invalidate(self, callback):
+        """
+        callback(user_id, scope) вызывается при любой инвалидации (своей и чужой).
+        scope="language" — у пользователя сменился язык.
+        """
+        self.listeners.append(callback)
+
+    # ---------- read / write ----------
+
+    async def get(self, user_id):
+        value = self.l1.get(user_id)
+
+        if value is not None or not self.redis:
+            return value
+
+        try:
+            raw = await self.redis.get(f"{self.prefix}{user_id}")
+        except Exception as e:
+            self.l2_errors += 1
+            logging.warning(f"⚠️ USER CACHE L2 GET ERROR: {e}")
+            return None
+
+        if not raw:
+            return None
+
+        try:
+            value = json.loads(raw)
+        except Exception:
+            return None
+
+        self.l2_hits += 1
+        self.l1.set(user_id, value)
+        return value
+
+    async def set(self, user_id, row):
+        self.l1.set(user_id, row)
+
+        if not self.redis:
+            return
+
+        try:
+            await self.redis.set(
+                f"{self.prefix}{user_id}",
+                json.dumps(dict(row)),
+                ex=self.redis_ttl
+            )
+        except Exception as e:
+            self.l2_errors += 1
+            logging.warning(f"⚠️ USER CACHE L2 SET ERROR: {e}")
+
+    async def invalidate(self, user_id, scope="row"):
+        """
+        Вызывать (с await) сразу после UPDATE users.
+        L1 сбрасывается сразу, Redis DEL + PUBLISH ждем: иначе get_user()
+        сразу после записи мог прочитать из L2 старую строку (премиум,
+        лимиты) и снова положить ее в L1.
+        """
+        self._drop_local(user_id, scope)
+
+        if not self.redis:
+            return
+
+        await self._invalidate_remote(user_id, scope)
+
+    def stats(self):
+        stats = self.l1.stats()
+        stats.update({
+            "l2": bool(self.redis),
+            "l2_hits": self.l2_hits,
+            "l2_errors": self.l2_errors,
+            "remote_invalidations": self.remote_invalidations,
+        })
+        return stats
+
+    # ---------- internals ----------
+
+    def _drop_local(self, user_id, scope):
+        self.l1.invalidate(user_id)
+
+        for callback in self.listeners:
+            try:
+                callback(user_id, scope)
+            except Exception as e:
+                logging.error(f"❌ USER CACHE LISTENER ERROR: {e}")
+
+    async def _invalidate_remote(self, user_id, scope):
+        try:
+            await self.redis.delete(f"{self.prefix}{user_id}")
+            await self.redis.publish(
+                INVALIDATE_CHANNEL,
+                f"{self.instance_id}:{user_id}:{scope}"
+            )
+        except Exception as e:
+            self.l2_errors += 1
+            logging.warning(f"⚠️ USER CACHE INVALIDATE ERROR user={user_id}: {e}")
+
+    async def _listen(self):
+        while True:
+            pubsub = None
+
+            try:
+                pubsub = self.redis.pubsub()
+                await pubsub.subscribe(INVALIDATE_CHANNEL)
+
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+
+                    data = message.get("data")
+                    if isinstance(data, bytes):
+                        data = data.decode()
+
+                    origin, _, rest = str(data).partition(":")
+                    user_id, _, scope = rest.partition(":")
+
+                    if origin == self.instance_id or not user_id:
+                        continue
+
+                    try:
+                        user_id = int(user_id)
+                    except ValueError:
+                        continue
+
+                    self.remote_invalidations += 1
+                    self._drop_local(user_id, scope or "row")
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                logging.error(f"❌ USER CACHE PUBSUB ERROR: {e}")
+                # Пока не слушаем канал, L1 мог пропустить инвалидации.
+                self.l1.clear()
+                await asyncio.sleep(1)
+
+            finally:
+                if pubsub is not None:
+                    try:
+                        await pubsub.close()
+                    except Exception:
+                        pass
@@ -0,0 +1,219 @@
+import logging
+
+import asyncpg
+
+# ================= USER QUERIES =================
+# Горячие запросы к users в одном месте:
+# - вместо SELECT * (22+ колонки) — только нужные колонки, набор задает
+#   класс записи (COLUMNS), SQL собирается из него один раз при импорте;
+# - записи — подклассы asyncpg.Record: user["x"] / user.get("x") работают
+#   как раньше, а по типу видно, какие колонки в записи есть;
+# - на каждом соединении пула запросы готовятся (PREPARE) один раз — в init
+#   пула, дальше только Bind / Execute без разбора и планирования SQL;
+# - подготовленные запросы хранятся по pid backend-а: новое соединение
+#   (переподключение пула) готовит их заново.
+
+
+class UserProfile(asyncpg.Record):
+    """Строка users для USER_CACHE и хендлеров: лимиты, премиум, язык."""
+
+    COLUMNS = (
+        "user_id",
+        "week_start",
+        "image_count",
+        "video_count",
+        "music_count",
+        "chat_count",
+        "accepted_terms",
+        "referrals",
+        "bonus_images",
+        "premium",
+        "premium_until",
+        "paid_video",
+        "paid_music",
+        "premium_images",
+        "premium_videos",
+        "premium_music",
+        "language",
+    )
+
+
+class UserLimits(asyncpg.Record):
+    """Проверка лимитов перед генерацией."""
+
+    COLUMNS = (
+        "user_id",
+        "week_start",
+        "image_count",
+        "video_count",
+        "bonus_images",
+        "premium",
+        "premium_until",
+        "paid_video",
+        "paid_music",
+    )
+
+
+class UserPremium(asyncpg.Record):
+    """Только для is_premium()."""
+
+    COLUMNS = ("premium", "premium_until")
+
+
+class UserVideoBalance(asyncpg.Record):
+    """Списание видео после отправки."""
+
+    COLUMNS = ("paid_video", "video_count")
+
+
+def _select(record_class):
+    return f"SELECT {', '.join(record_class.COLUMNS)} FROM users WHERE user_id=$1"
+
+
+# Первый /start: INSERT ... ON CONFLICT DO UPDATE last_active, начисление
+# реферала — в том же запросе через CTE (только для новой строки).
+# $1 user_id, $2 now, $3 ref_by
+ENSURE_USER = f"""
+WITH upsert AS (
+    INSERT INTO users (
+        user_id,
+        week_start,
+        image_count,
+        video_count,
+        music_count,
+        chat_count,
+        accepted_terms,
+        referrals,
+        bonus_images,
+        ref_by,
+        is_active,
+        premium,
+        premium_until,
+        paid_video,
+        paid_music,
+        premium_images,
+        premium_videos,
+        premium_music,
+        created_at,
+        last_active,
+        ref_rewarded,
+        language
+    )
+    VALUES (
+        $1, $2,
+        0, 0, 0, 0,
+        0, 0, 0,
+        $3,
+        1, 0, 0,
+        0, 0,
+        0, 0, 0,
+        $2, $2, 0,
+        'ru'
+    )
+    ON CONFLICT (user_id) DO UPDATE
+    SET last_active = EXCLUDED.last_active
+    RETURNING {', '.join(UserProfile.COLUMNS)}, (xmax = 0) AS inserted
+),
+referral AS (
+    UPDATE users
+    SET referrals = referrals + 1
+    WHERE user_id = $3::BIGINT
+      AND user_id <> $1
+      AND EXISTS (SELECT 1 FROM upsert WHERE inserted)
+)
+SELECT * FROM upsert
+"""
+
+# имя -> (SQL, класс записи)
+STATEMENTS = {
+    "user_profile": (_select(UserProfile), UserProfile),
+    "user_limits": (_select(UserLimits), UserLimits),
+    "user_premium": (_select(UserPremium), UserPremium),
+    "user_video_balance": (_select(UserVideoBalance), UserVideoBalance),
+    "user_language": ("SELECT language FROM users WHERE user_id=$1", None),
+    "ensure_user": (ENSURE_USER, UserProfile),
+}
+
+# pid, которых уже нет, не копим бесконечно
+MAX_CONNECTIONS = 256
+
+
+class UserQueries:
+
+    def __init__(self, statements=STATEMENTS):
+        self.statements = statements
+
+        # pid backend-а -> {имя: PreparedStatement}
+        self._prepared = {}
+
+        self.calls = 0
+        self.prepares = 0
+        self.reprepares = 0
+
+    async def prepare(self, conn):
+        """init= для asyncpg.create_pool: готовим все запросы на новом соединении."""
+        pid = conn.get_server_pid()
+
+        self._prepared.pop(pid, None)
+        self._prepared[pid] = {}
+
+        while len(self._prepared) > MAX_CONNECTIONS:
+            self._prepared.pop(next(iter(self._prepared)))
+
+        for name in self.statements:
+            try:
+                await self._prepare(conn, pid, name)
+            except asyncpg.PostgresError as e:
+                # первый запуск: init пула идет до CREATE / ALTER TABLE users,
+                # такой запрос подготовится при первом вызове
+                logging.info(f"PREPARE {name} DEFERRED: {e}")
+
+    async def fetchrow(self, conn, name, *args):
+        return await self._run(conn, name, "fetchrow", args)
+
+    async def fetchval(self, conn, name, *args):
+        return await self._run(conn, name, "fetchval", args)
+
+    def stats(self):
+        return {
+            "statements": len(self.statements),
+            "connections": len(self._prepared),
+            "calls": self.calls,
+            "prepares": self.prepares,
+            "reprepares": self.reprepares,
+        }
+
+    # ---------- internal ----------
+
+    async def _run(self, conn, name, method, args):
+        self.calls += 1
+
+        pid = conn.get_server_pid()
+        statement = self._prepared.get(pid, {}).get(name)
+
+        if statement is None:
+            statement = await self._prepare(conn, pid, name)
+
+        try:
+            return await getattr(statement, method)(*args)
+
+        except asyncpg.exceptions.InvalidSQLStatementNameError:
+            # запрос сброшен на сервере (DEALLOCATE, пулер) — готовим заново
+            self.reprepares += 1
+            logging.warning(f"⚠️ PREPARED STATEMENT LOST: {name}")
+
+            statement = await self._prepare(conn, pid, name)
+            return await getattr(statement, method)(*args)
+
+    async def _prepare(self, conn, pid, name):
+        sql, record_class = self.statements[name]
+
+        if record_class is None:
+            statement = await conn.prepare(sql)
+        else:
+            statement = await conn.prepare(sql, record_class=record_class)
+
+        self._prepared.setdefault(pid, {})[name] = statement
+        self.prepares += 1
+
+        return statement
@@ -1,7 +1,7 @@
 import asyncio
-import json
 import logging
 import os
+import signal
 import sys
 
 # ================= PATH FIX =================
@@ -11,8 +11,24 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import redis.asyncio as redis
 from telegram import Bot
 
+import bot as core
+
 # ===== ИМПОРТ ТВОЕЙ ЛОГИКИ ИЗ BOT.PY =====
-from bot import handle_generation_job, init_db
+from bot import (
+    init_db,
+    init_stats,
+    init_redis as init_shared_cache,
+    init_job_queue,
+    close_job_queue,
+    restore_job,
+    run_generation_job,
+    STATS,
+    USER_CACHE,
+    FAL_POLLER,
+    PROGRESS,
+    HTTP,
+    TRANSCODER
+)
 
 logging.basicConfig(level=logging.INFO)
 
@@ -20,17 +36,33 @@ logging.basicConfig(level=logging.INFO)
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 TG_TOKEN = os.getenv("TG_TOKEN")
 
-# ===== REDIS QUEUES =====
-QUEUE_IMAGE = "queue:image"
-QUEUE_VIDEO = "queue:video"
-QUEUE_MUSIC = "queue:music"
+# ===== REDIS QUEUES (потоки job_queue.py, их же наполняет bot.py) =====
+QUEUE_IMAGE = "image"
+QUEUE_VIDEO = "video"
+QUEUE_MUSIC = "music"
 
 # ===== GLOBALS =====
 redis_client = None
 bot = None
+jobs = None
+
+# ===== ЕМКОСТЬ =====
+# одновременных задач на очередь в этом процессе
+QUEUE_CONCURRENCY = {
+    QUEUE_IMAGE: int(os.getenv("WORKER_IMAGE_CONCURRENCY", "5")),
+    QUEUE_VIDEO: int(os.getenv("WORKER_VIDEO_CONCURRENCY", "2")),
+    QUEUE_MUSIC: int(os.getenv("WORKER_MUSIC_CONCURRENCY", "1")),
+}
+# сколько задач на очередь можно забрать заранее, сверх выполняемых
+PREFETCH = int(os.getenv("WORKER_PREFETCH", "1"))
+# сколько ждать текущие задачи при SIGTERM
+DRAIN_TIMEOUT = int(os.getenv("WORKER_DRAIN_TIMEOUT", "600"))
+FETCH_BLOCK_MS = 5000
 
-# ограничение одновременных задач (очень важно)
-GLOBAL_SEMAPHORE = asyncio.Semaphore(10)
+# ограничение одновременных задач на весь процесс (очень важно)
+GLOBAL_SEMAPHORE = asyncio.Semaphore(int(os.getenv("WORKER_MAX_JOBS", "10")))
+
+stopping = asyncio.Event()
 
 
 # ================= INIT =================
@@ -46,60 +78,153 @@ async def init_redis():
 async def init_bot():
     global bot
     bot = Bot(token=TG_TOKEN)
+    await bot.initialize()
     logging.info("✅ Telegram Bot инициализирован")
 
 
-# ================= WORKER LOOP =================
-async def worker_loop(queue_name):
+# ================= CONSUMERS =================
+# Воркер берет задачу из Redis только когда у очереди есть свободный слот:
+# слотов = concurrency (выполняются) + prefetch (уже забраны, ждут).
+# Поэтому в памяти никогда не больше concurrency + prefetch задач на очередь,
+# сколько бы их ни лежало в Redis, а при падении теряется не больше этого
+# (и то — их заберут другие воркеры после visibility timeout).
 
-    logging.info(f"🚀 Worker запущен: {queue_name}")
+class QueueConsumer:
 
-    while True:
-        try:
-            # ждём задачу
-            _, job_data = await redis_client.brpop(queue_name)
+    def __init__(self, name, concurrency, prefetch):
+        self.name = name
+        self.concurrency = concurrency
+        self.prefetch = prefetch
+
+        self.slots = asyncio.Semaphore(concurrency + prefetch)
+        self.buffer = asyncio.Queue()
+        self.active = set()
+
+        self._fetchers = []
+        self._executors = []
+
+    def start(self):
+        self._fetchers.append(asyncio.create_task(self.fetch_loop()))
+
+        for _ in range(self.concurrency):
+            self._executors.append(asyncio.create_task(self.exec_loop()))
+
+        logging.info(
+            f"🚀 Worker запущен: {self.name} "
+            f"concurrency={self.concurrency} prefetch={self.prefetch}"
+        )
+
+    async def fetch_loop(self):
+        while not stopping.is_set():
+            # сначала емкость, потом задача
+            await self.slots.acquire()
+
+            if stopping.is_set():
+                self.slots.release()
+                break
+
+            try:
+                entry = await jobs.get(self.name, block=FETCH_BLOCK_MS)
+
+            except asyncio.CancelledError:
+                self.slots.release()
+                raise
+
+            except Exception as e:
+                self.slots.release()
+                logging.error(f"❌ Worker fetch error {self.name}: {e}")
+                await asyncio.sleep(1)
+                continue
 
-            job = json.loads(job_data)
+            if entry is None:
+                self.slots.release()
+                continue
+
+            entry_id, job = entry
 
             logging.info(
                 f"🔥 JOB | mode={job.get('mode')} | user={job.get('user_id')}"
             )
 
-            # запускаем обработку
-            asyncio.create_task(process_job(job))
+            self.buffer.put_nowait(entry)
 
-        except Exception as e:
-            logging.error(f"❌ Worker loop error: {e}")
-            await asyncio.sleep(1)
+    async def exec_loop(self):
+        while True:
+            entry_id, job = await self.buffer.get()
+
+            task = asyncio.create_task(process_job(self.name, entry_id, job))
+            self.active.add(task)
+
+            try:
+                await asyncio.shield(task)
+            finally:
+                self.active.discard(task)
+                self.slots.release()
+
+    async def drain(self, timeout):
+        """
+        SIGTERM: больше не берем задачи, неначатые возвращаем в Redis,
+        выполняемые дожидаемся (до timeout), остальные бросаем без ack.
+        """
+        for task in self._fetchers:
+            task.cancel()
+
+        returned = 0
+
+        while not self.buffer.empty():
+            entry_id, job = self.buffer.get_nowait()
+
+            try:
+                await jobs.release(self.name, entry_id, job)
+                returned += 1
+            except Exception as e:
+                # без ack задачу все равно заберут после visibility timeout
+                logging.error(f"❌ Worker release error {self.name}: {e}")
+
+        if self.active:
+            logging.info(f"⏳ {self.name}: ждем {len(self.active)} задач (до {timeout}s)")
+            await asyncio.wait(set(self.active), timeout=timeout)
+
+        abandoned = len(self.active)
+
+        for task in self._executors + list(self.active):
+            task.cancel()
+
+        await asyncio.gather(*self._fetchers, *self._executors, *self.active, return_exceptions=True)
+
+        logging.info(
+            f"🛑 {self.name}: возвращено в очередь {returned}, брошено {abandoned}"
+        )
 
 
 # ================= JOB PROCESS =================
-async def process_job(job):
+async def process_job(queue_name, entry_id, job):
 
     async with GLOBAL_SEMAPHORE:
 
-        try:
-            user_id = job.get("user_id")
-            chat_id = job.get("chat_id")
+        chat_id = job.get("chat_id")
 
+        try:
             if not chat_id:
                 logging.error("❌ Нет chat_id в job")
+                await jobs.ack(queue_name, entry_id, job)
                 return
 
-            # ===== прокидываем bot внутрь =====
-            job["bot"] = bot
-
-            # ⚠️ убираем update/context
-            job["update"] = None
-            job["context"] = None
-
             # ===== ВАЖНО: лог старта =====
             await safe_send(chat_id, "⏳ Генерация началась...")
 
-            await handle_generation_job(job)
+            # update/context/status восстанавливаются по id из задачи,
+            # ack — после обработки (иначе задачу заберет другой воркер)
+            await jobs.run(
+                queue_name,
+                entry_id,
+                job,
+                lambda j: run_generation_job(restore_job(j, bot))
+            )
 
         except asyncio.CancelledError:
             logging.warning("⛔ Job cancelled")
+            raise
 
         except Exception as e:
             logging.error(f"❌ Job error: {e}")
@@ -122,34 +247,89 @@ async def safe_send(chat_id, text):
 
 
 # ================= WORKERS =================
-async def start_workers():
-
-    await asyncio.gather(
-        # IMAGE (основная нагрузка)
-        worker_loop(QUEUE_IMAGE),
-        worker_loop(QUEUE_IMAGE),
-        worker_loop(QUEUE_IMAGE),
-        worker_loop(QUEUE_IMAGE),
-        worker_loop(QUEUE_IMAGE),
-
-        # VIDEO
-        worker_loop(QUEUE_VIDEO),
-        worker_loop(QUEUE_VIDEO),
-
-        # MUSIC
-        worker_loop(QUEUE_MUSIC),
-    )
+def start_workers():
+    consumers = [
+        QueueConsumer(name, QUEUE_CONCURRENCY[name], PREFETCH)
+        for name in (QUEUE_IMAGE, QUEUE_VIDEO, QUEUE_MUSIC)
+        if QUEUE_CONCURRENCY[name] > 0
+    ]
+
+    for consumer in consumers:
+        consumer.start()
+
+    return consumers
 
 
 # ================= MAIN =================
 async def main():
+    global jobs
+
     await init_redis()
     await init_bot()
     await init_db()
 
+    # общий с bot.py кэш пользователей: L2 + инвалидации через pub/sub
+    await init_shared_cache(redis_client)
+
+    # счётчики /stats из этого процесса тоже пишутся в bot_stats
+    await init_stats()
+
+    jobs = await init_job_queue()
+
+    if jobs is None:
+        raise Exception("❌ Очередь задач недоступна: нужен REDIS_URL и JOB_QUEUE=redis")
+
+    loop = asyncio.get_running_loop()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    consumers = start_workers()
+
     logging.info("🚀 Worker готов к работе")
 
-    await start_workers()
+    try:
+        await stopping.wait()
+
+        logging.info("🛑 Остановка: дорабатываем текущие задачи")
+
+        await asyncio.gather(*(c.drain(DRAIN_TIMEOUT) for c in consumers))
+
+    finally:
+        await shutdown()
+
+
+async def shutdown():
+    # те же шаги, что post_shutdown в bot.py: дописываем счетчики /stats,
+    # закрываем сессии и пулы
+    for name, close in (
+        ("stats", STATS.stop),
+        ("user cache", USER_CACHE.stop),
+        ("job queue", close_job_queue),
+        ("fal poller", FAL_POLLER.close),
+        ("progress", PROGRESS.close),
+        ("http", HTTP.close),
+        ("transcoder", TRANSCODER.close),
+    ):
+        try:
+            await close()
+        except Exception as e:
+            logging.error(f"❌ SHUTDOWN {name} ERROR: {e}")
+
+    if bot:
+        try:
+            await bot.shutdown()
+        except Exception:
+            pass
+
+    if core.db_pool:
+        await core.db_pool.close()
+
+    if redis_client:
+        try:
+            await redis_client.close()
+        except Exception:
+            pass
 
 
 if __name__ == "__main__":